@@ -0,0 +1,4 @@
+# loaded with Django so @shared_task binds to the project's Celery app
+from .celery import app as celery_app
+
+__all__ = ('celery_app',)
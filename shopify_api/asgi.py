@@ -3,14 +3,51 @@ ASGI config for shopify_api project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+WhiteNoise's middleware is sync only and would push every request, the async
+views included, through a thread, so it is left out under ASGI (DJANGO_ASGI,
+see settings). StaticFilesApplication runs WhiteNoise as a WSGI app in front of
+Django instead, only requests under STATIC_URL take the thread.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
 import os
 
+from asgiref.wsgi import WsgiToAsgi
 from django.core.asgi import get_asgi_application
+from whitenoise.base import WhiteNoise
+from whitenoise.middleware import WhiteNoiseMiddleware
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'shopify_api.settings')
+os.environ.setdefault('DJANGO_ASGI', 'True')
+
+
+def not_found(environ, start_response):
+    start_response('404 Not Found', [('Content-Type', 'text/plain')])
+    return [b'Not Found']
+
+
+class StaticFiles(WhiteNoiseMiddleware):
+    # the middleware's settings, hashed file names and finders, answering as WhiteNoise's plain WSGI app
+    __call__ = WhiteNoise.__call__
+    serve = staticmethod(WhiteNoise.serve)
+
+    def __init__(self):
+        super().__init__()
+        self.application = not_found
+
+
+class StaticFilesApplication:
+    def __init__(self, application):
+        self.application = application
+        self.static_files = StaticFiles()
+        self.serve = WsgiToAsgi(self.static_files)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'].startswith(self.static_files.static_prefix):
+            return await self.serve(scope, receive, send)
+        return await self.application(scope, receive, send)
+
 
-application = get_asgi_application()
+application = StaticFilesApplication(get_asgi_application())
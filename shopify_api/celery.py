@@ -0,0 +1,46 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from celery import Celery  # type: ignore
+from django.conf import settings  # type: ignore
+from django.db import connections  # type: ignore
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'shopify_api.settings')
+
+app = Celery('shopify_api')
+# every CELERY_* setting in settings.py configures the app
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
+
+logger = logging.getLogger(__name__)
+executor = None
+
+
+def has_broker():
+    return not app.conf.broker_url.startswith('memory://')
+
+
+def run_in_background(task, args):
+    try:
+        result = task.apply(args=args)
+        if result.failed():
+            logger.error('Task %s%r failed:\n%s', task.name, tuple(args), result.traceback)
+    finally:
+        # the pool's threads would otherwise each keep a connection open
+        connections.close_all()
+
+
+def enqueue(task, *args):
+    """
+    Queue task for a Celery worker. Without a broker nothing would ever pick it up, it runs on
+    a small pool of threads in this process instead (BACKGROUND_TASK_THREADS), still outside the request.
+    """
+    global executor
+    if app.conf.task_always_eager or has_broker():
+        return task.delay(*args)
+    if executor is None:
+        logger.warning(
+            'CELERY_BROKER_URL is not set, tasks run on %s threads of the web process.', settings.BACKGROUND_TASK_THREADS)
+        executor = ThreadPoolExecutor(settings.BACKGROUND_TASK_THREADS, thread_name_prefix='tasks')
+    return executor.submit(run_in_background, task, args)
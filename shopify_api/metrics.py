@@ -0,0 +1,209 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async  # type: ignore
+from django.conf import settings  # type: ignore
+from django.core.exceptions import MiddlewareNotUsed  # type: ignore
+from django.db import connections  # type: ignore
+from django.http import HttpResponse  # type: ignore
+from rest_framework import permissions  # type: ignore
+from rest_framework.decorators import api_view, permission_classes  # type: ignore
+
+# upper bounds of the histogram buckets, in seconds for timings and in queries for query counts
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+METRICS = (
+    ('http_view_duration_seconds', 'Wall time spent handling the request', TIME_BUCKETS),
+    ('http_view_sql_duration_seconds', 'Time spent executing SQL', TIME_BUCKETS),
+    ('http_view_serialize_duration_seconds', 'Time spent turning objects into serializer data', TIME_BUCKETS),
+    ('http_view_render_duration_seconds', 'Time spent rendering the response body', TIME_BUCKETS),
+    ('http_view_queries', 'Number of SQL queries executed', QUERY_BUCKETS),
+)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class MetricsRegistry:
+    """In-process histograms keyed by (view name, method), rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self, view, method, values):
+        with self.lock:
+            for (name, _, buckets), value in zip(METRICS, values):
+                key = (name, view, method)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(buckets)
+                self.histograms[key].observe(value)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, description, _ in METRICS:
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} histogram')
+                for (metric, view, method), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    labels = f'view="{view}",method="{method}"'
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{{labels}}} {histogram.sum:.6f}')
+                    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class RequestTimings:
+    def __init__(self):
+        self.queries = 0
+        self.sql = 0.0
+        self.serializing = False
+        self.serialize = 0.0
+        self.render_started = None
+        self.render = 0.0
+
+
+# the timings of the request being handled, copied into the threads sync_to_async runs the ORM in
+current_timings = ContextVar('current_timings', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    timings = current_timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.sql += time.perf_counter() - started
+        timings.queries += 1
+
+
+def install_query_recorder():
+    # left on the connections of the calling thread for good, it only counts while a request has set its timings.
+    # Concurrent async requests share those connections, so they can't each add and remove a wrapper of their own
+    for connection in connections.all():
+        if record_query not in connection.execute_wrappers:
+            connection.execute_wrappers.append(record_query)
+
+
+@contextmanager
+def timed_serialization():
+    """Add the time spent inside to the request's serialize timing, nested serializers are counted once."""
+    timings = current_timings.get()
+    if timings is None or timings.serializing:
+        yield
+        return
+    timings.serializing = True
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.serialize += time.perf_counter() - started
+        timings.serializing = False
+
+
+class RequestMetricsMiddleware:
+    """
+    Records query count, SQL time, serialization time, render time and wall time for every view.
+
+    The numbers are sent back in a Server-Timing header and collected into the
+    histograms served by /api/_metrics/. Turned off unless REQUEST_METRICS_ENABLED
+    is set, in which case Django drops the middleware entirely. It runs in either
+    mode, so the async views aren't pushed through a thread by it under ASGI.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_METRICS_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        install_query_recorder()
+        started, token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.finish(request, response, started)
+
+    async def __acall__(self, request):
+        # the async ORM queries in the thread sync_to_async keeps for it
+        await sync_to_async(install_query_recorder)()
+        started, token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.finish(request, response, started)
+
+    def start(self, request):
+        request.metrics_timings = RequestTimings()
+        return time.perf_counter(), current_timings.set(request.metrics_timings)
+
+    def finish(self, request, response, started):
+        timings = request.metrics_timings
+        total = time.perf_counter() - started
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        registry.observe(
+            view, request.method, (total, timings.sql, timings.serialize, timings.render, timings.queries))
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={timings.sql * 1000:.2f};desc="{timings.queries} queries"',
+            f'serialize;dur={timings.serialize * 1000:.2f}',
+            f'render;dur={timings.render * 1000:.2f}',
+            f'total;dur={total * 1000:.2f}',
+        ])
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this hook, the callback marks the end of rendering
+        timings = request.metrics_timings
+        timings.render_started = time.perf_counter()
+
+        def rendered(response):
+            timings.render = time.perf_counter() - timings.render_started
+        response.add_post_render_callback(rendered)
+        return response
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def metrics_view(request):
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -33,9 +33,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'shopify_api.metrics.RequestMetricsMiddleware',
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
-    "whitenoise.middleware.WhiteNoiseMiddleware",
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -44,6 +44,16 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# set by asgi.py, WhiteNoise's middleware is sync only and would run every request in a thread under ASGI,
+# asgi.py puts WhiteNoise in front of Django for the static files there instead
+ASGI = config('DJANGO_ASGI', default=False, cast=bool)
+if not ASGI:
+    MIDDLEWARE.insert(MIDDLEWARE.index('django.middleware.security.SecurityMiddleware') + 1,
+                      'whitenoise.middleware.WhiteNoiseMiddleware')
+
+# per-view query count and timing histograms, served to staff at /api/_metrics/
+REQUEST_METRICS_ENABLED = config('REQUEST_METRICS_ENABLED', default=False, cast=bool)
+
 CORS_ALLOWED_ORIGINS = [
     'http://localhost:5173'
 ]
@@ -88,6 +98,39 @@ else:
         }
     }
 
+# locmem per process by default, point REDIS_URL at a Redis server to share the cache between workers
+if 'REDIS_URL' in os.environ:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'shopify-api',
+        }
+    }
+
+# seconds a cached category list lives even without invalidation
+CATEGORY_CACHE_TIMEOUT = 300
+
+# product images are resized to these widths in every format by a background task
+PRODUCT_IMAGE_WIDTHS = (320, 640, 1280)
+PRODUCT_IMAGE_FORMATS = ('webp', 'jpeg')
+PRODUCT_IMAGE_QUALITY = 80
+
+# work after checkout runs on Celery workers, set CELERY_BROKER_URL to the broker they read from
+CELERY_BROKER_URL = config('CELERY_BROKER_URL', default='memory://')
+# without a broker the tasks run on this many threads of the web process, see shopify_api.celery.enqueue
+BACKGROUND_TASK_THREADS = config('BACKGROUND_TASK_THREADS', default=2, cast=int)
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_TASK_ACKS_LATE = True
+
+EMAIL_BACKEND = config('EMAIL_BACKEND', default='django.core.mail.backends.console.EmailBackend')
+DEFAULT_FROM_EMAIL = config('DEFAULT_FROM_EMAIL', default='orders@shopify.local')
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -120,14 +163,35 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# orjson renders and parses the API's JSON several times faster, store.renderers has the details
+FAST_JSON = config('FAST_JSON', default=False, cast=bool)
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework_simplejwt.authentication.JWTAuthentication',
         'rest_framework.authentication.BasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-    ]
+    ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'store.renderers.ORJSONRenderer' if FAST_JSON else 'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'store.renderers.ORJSONParser' if FAST_JSON else 'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
+# how long an item added to a cart holds its stock before the reaper gives it back
+CART_RESERVATION_TTL = timedelta(minutes=15)
+
+# how long the response of a checkout sent with an Idempotency-Key is replayed to retries
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+# a retry takes over a key whose first request hasn't answered within this long, its worker is taken to be gone.
+# Keep it above the longest a request may run (gunicorn kills workers after 30 seconds by default)
+IDEMPOTENCY_KEY_LEASE = timedelta(seconds=60)
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=7),
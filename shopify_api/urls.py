@@ -3,6 +3,7 @@ from django.urls import path, include #type: ignore
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView # type: ignore 
 from django.conf import settings
 from django.conf.urls.static import static
+from .metrics import metrics_view
 
 # Import for Swagger
 from rest_framework import permissions
@@ -25,6 +26,7 @@ schema_view = get_schema_view(
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('api/_metrics/', metrics_view, name='metrics'),
     path('api/', include('store.urls')),
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair_view'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh_view'),
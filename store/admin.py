@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import User, Category, Product, ProductImage, Address, Order, OrderItem, Cart, CartItem, Review
+from .models import User, Category, Product, ProductImage, Address, Order, OrderItem, Cart, CartItem, Review, StockReservation, IdempotencyKey, DailySales, DailyCategorySales, DailyProductSales
 
 admin.site.register(User)
 admin.site.register(Category)
@@ -10,4 +10,9 @@ admin.site.register(Order)
 admin.site.register(OrderItem)
 admin.site.register(Cart)
 admin.site.register(CartItem)
-admin.site.register(Review)
\ No newline at end of file
+admin.site.register(Review)
+admin.site.register(StockReservation)
+admin.site.register(IdempotencyKey)
+admin.site.register(DailySales)
+admin.site.register(DailyCategorySales)
+admin.site.register(DailyProductSales)
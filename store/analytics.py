@@ -0,0 +1,129 @@
+"""
+Daily sales rollups, per day, per category and per product.
+
+record_sales adds an order to the rows of the day it was placed and takes it
+away again when it is cancelled, once each thanks to Order.sales_recorded,
+rebuild recomputes a range of days from the orders themselves. The staff analytics endpoints only ever read the rollups.
+"""
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import transaction  # type: ignore
+from django.db.models import Count, DecimalField, F, Sum  # type: ignore
+from django.db.models.functions import TruncDate  # type: ignore
+from django.utils import timezone  # type: ignore
+from .models import DailyCategorySales, DailyProductSales, DailySales, Order, OrderItem
+
+TOTALS = ('orders', 'units', 'revenue')
+
+
+def day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def record_sales(order_id, sign=1):
+    """
+    Add an order to the rollups, or take it away with sign=-1. False when it has no items or
+    when that was already done, the order's sales_recorded flag is flipped in the same transaction.
+    """
+    with transaction.atomic():
+        # tasks are acknowledged late, a redelivered one must not count the order twice
+        flip = Order.objects.filter(pk=order_id, sales_recorded=sign < 0)
+        if sign > 0:
+            # cancelled before its order was recorded, the tasks ran out of order and there is nothing to add
+            flip = flip.exclude(order_status='cancelled')
+        if not flip.update(sales_recorded=sign > 0):
+            return False
+        rows = list(
+            OrderItem.objects.filter(order_id=order_id)
+            .values_list('order__created_at', 'product_id', 'product__category_id', 'quantity', 'price')
+        )
+        if not rows:
+            return False
+        day = timezone.localdate(rows[0][0])
+        # an order holds each product once, but a category can come up several times
+        products, categories = {}, {}
+        for _, product_id, category_id, quantity, price in rows:
+            products[product_id] = (1, quantity, quantity * price)
+            _, units, revenue = categories.get(category_id, (1, 0, 0))
+            categories[category_id] = (1, units + quantity, revenue + quantity * price)
+        total = (1, sum(units for _, units, _ in products.values()), sum(revenue for _, _, revenue in products.values()))
+        DailySales.add(day, {None: total}, sign)
+        DailyCategorySales.add(day, categories, sign)
+        DailyProductSales.add(day, products, sign)
+    return True
+
+
+def rebuild(start=None, end=None, batch_size=1000):
+    """Recompute the rollups of the days from start to end (both optional and included), returns rows per table."""
+    items = OrderItem.objects.exclude(order__order_status='cancelled').order_by()
+    if start:
+        items = items.filter(order__created_at__gte=day_start(start))
+    if end:
+        items = items.filter(order__created_at__lt=day_start(end + timedelta(days=1)))
+    totals = {
+        'orders': Count('order_id', distinct=True),
+        'units': Sum('quantity'),
+        'revenue': Sum(F('price') * F('quantity'), output_field=DecimalField(max_digits=14, decimal_places=2)),
+    }
+    groups = {
+        DailySales: items.values(day=TruncDate('order__created_at')),
+        DailyCategorySales: items.values(day=TruncDate('order__created_at'), category_id=F('product__category_id')),
+        DailyProductSales: items.values('product_id', day=TruncDate('order__created_at')),
+    }
+
+    orders = Order.objects.all()
+    if start:
+        orders = orders.filter(created_at__gte=day_start(start))
+    if end:
+        orders = orders.filter(created_at__lt=day_start(end + timedelta(days=1)))
+
+    rebuilt = {}
+    with transaction.atomic():
+        # the rebuilt days count every order that isn't cancelled, the tasks still on their way skip them
+        orders.exclude(order_status='cancelled').update(sales_recorded=True)
+        orders.filter(order_status='cancelled').update(sales_recorded=False)
+        for model, rows in groups.items():
+            stale = model.objects.all()
+            if start:
+                stale = stale.filter(day__gte=start)
+            if end:
+                stale = stale.filter(day__lte=end)
+            stale.delete()
+            created = model.objects.bulk_create(
+                [model(**row) for row in rows.annotate(**totals)], batch_size=batch_size)
+            rebuilt[model._meta.model_name] = len(created)
+    return rebuilt
+
+
+def daily(start, end, category_id=None):
+    """Totals of every day from start to end, days without sales included as zeros."""
+    if category_id is None:
+        rows = DailySales.objects.all()
+    else:
+        rows = DailyCategorySales.objects.filter(category_id=category_id)
+    found = {
+        row['day']: row
+        for row in rows.filter(day__range=(start, end)).values('day', *TOTALS)
+    }
+    days = []
+    for offset in range((end - start).days + 1):
+        day = start + timedelta(days=offset)
+        days.append(found.get(day, {'day': day, 'orders': 0, 'units': 0, 'revenue': Decimal('0.00')}))
+    return days
+
+
+def ranking(model, start, end, order_by, limit):
+    """The best limit categories or products of model by order_by over the days from start to end."""
+    key = f'{model.key}_id'
+    # the sums can't take the names of the rollup's own fields, they're renamed back afterwards
+    rows = (
+        model.objects.filter(day__range=(start, end))
+        .values(key, name=F(f'{model.key}__name'))
+        .annotate(**{f'total_{name}': Sum(name) for name in TOTALS})
+        .order_by(f'-total_{order_by}', key)[:limit]
+    )
+    return [
+        {key: row[key], 'name': row['name'], **{name: row[f'total_{name}'] for name in TOTALS}}
+        for row in rows
+    ]
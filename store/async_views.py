@@ -0,0 +1,213 @@
+"""
+Async versions of the read-only catalog endpoints, mounted under /api/async/.
+
+They answer like their DRF counterparts, the viewsets still build the filtered
+queryset but the queries run through Django's async ORM. Under an ASGI server a
+worker keeps serving other requests while one of them waits on the database,
+under WSGI they still work, one request at a time. Everything that writes or
+needs a user stays on the regular views.
+"""
+import math
+from functools import wraps
+
+from asgiref.sync import sync_to_async  # type: ignore
+from django.db.models import prefetch_related_objects  # type: ignore
+from django.http import Http404, HttpResponse  # type: ignore
+from django.utils.cache import get_conditional_response  # type: ignore
+from django_filters import rest_framework as django_filters  # type: ignore
+from rest_framework.exceptions import APIException, NotFound  # type: ignore
+from rest_framework.request import Request  # type: ignore
+from rest_framework.settings import api_settings  # type: ignore
+from rest_framework.utils.urls import remove_query_param, replace_query_param  # type: ignore
+
+from .cache import aget_categories, aget_category_version
+from .models import Product, Review
+from .serializers import CategorySerializer, ProductSerializer, ReviewSerializer
+from .views import (
+    CategoryViewSet, ProductViewSet, ReviewViewSet,
+    VERSION_AGGREGATES, cache_validators, requested_fields, set_cache_validators, stats_version,
+)
+
+
+# the default filters for foreign keys validate the id with a synchronous query, these only compare it
+class ProductFilter(django_filters.FilterSet):
+    category = django_filters.NumberFilter(field_name='category_id')
+
+    class Meta:
+        model = Product
+        fields = ProductViewSet.filterset_fields
+
+
+class ReviewFilter(django_filters.FilterSet):
+    product = django_filters.NumberFilter(field_name='product_id')
+
+    class Meta:
+        model = Review
+        fields = ReviewViewSet.filterset_fields
+
+
+class AsyncProductViewSet(ProductViewSet):
+    filterset_class = ProductFilter
+
+
+class AsyncReviewViewSet(ReviewViewSet):
+    filterset_class = ReviewFilter
+
+    # an expanded product needs its images prefetched, which async iteration can't do
+    def expanded_fields(self):
+        return set()
+
+
+def api_view(view):
+    # the DRF request only parses the query string here, nobody is authenticated on these endpoints
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        request = Request(request)
+        try:
+            return await view(request, *args, **kwargs)
+        except Http404 as exc:
+            return render({'detail': NotFound(*exc.args).detail}, status=404)
+        except APIException as exc:
+            # the same body DRF's exception handler sends
+            detail = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+            return render(detail, status=exc.status_code)
+    return wrapper
+
+
+# the JSON renderer the DRF views use, DRF's own or orjson's with FAST_JSON
+JSON_RENDERER = next(renderer for renderer in api_settings.DEFAULT_RENDERER_CLASSES if renderer.format == 'json')
+
+
+def render(data, status=200):
+    return HttpResponse(JSON_RENDERER().render(data), status=status, content_type='application/json')
+
+
+def filtered_queryset(viewset_class, request, action, **kwargs):
+    """The queryset the DRF view would serve, building it doesn't touch the database."""
+    view = viewset_class(request=request, action=action, args=(), kwargs=kwargs, format_kwarg=None)
+    return view.filter_queryset(view.get_queryset())
+
+
+async def queryset_version(queryset, *extra):
+    return stats_version(await queryset.order_by().aaggregate(**VERSION_AGGREGATES), extra)
+
+
+async def conditional_response(request, version, render_response):
+    etag, timestamp = cache_validators(version)
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = await render_response()
+    return set_cache_validators(response, etag, timestamp)
+
+
+async def paginate(request, queryset, pagination_class):
+    """One page of queryset and a function wrapping results in the page number pagination envelope."""
+    paginator = pagination_class()
+    page_size = paginator.get_page_size(request)
+    count = await queryset.acount()
+    last_page = max(math.ceil(count / page_size), 1)
+    page_param = paginator.page_query_param
+    page_number = request.query_params.get(page_param) or 1
+    if page_number in paginator.last_page_strings:
+        page_number = last_page
+    try:
+        page_number = int(page_number)
+    except ValueError:
+        raise NotFound(paginator.invalid_page_message)
+    if not 1 <= page_number <= last_page:
+        raise NotFound(paginator.invalid_page_message)
+
+    url = request.build_absolute_uri()
+    next_url = replace_query_param(url, page_param, page_number + 1) if page_number < last_page else None
+    if page_number == 1:
+        previous_url = None
+    elif page_number == 2:
+        previous_url = remove_query_param(url, page_param)
+    else:
+        previous_url = replace_query_param(url, page_param, page_number - 1)
+
+    def envelope(results):
+        return {'count': count, 'next': next_url, 'previous': previous_url, 'results': results}
+
+    offset = (page_number - 1) * page_size
+    return queryset[offset:offset + page_size], envelope
+
+
+def wants_images(request):
+    fields = requested_fields(request)
+    return fields is None or 'images' in fields
+
+
+async def fetch_products(queryset, images=True):
+    # prefetch_related isn't supported with async iteration on this Django version,
+    # the images are prefetched onto the fetched products in one query instead
+    products = [product async for product in queryset.prefetch_related(None)]
+    if images:
+        await sync_to_async(prefetch_related_objects)(products, 'images')
+    return products
+
+
+async def serialize_products(request, products, **kwargs):
+    # the columns ?fields= leaves out are deferred by the viewset, they must not be serialized
+    serializer = ProductSerializer(products, context={'request': request}, fields=requested_fields(request), **kwargs)
+    # the category of every product is read from the cache, fetched here so serializing doesn't query
+    rows = products if kwargs.get('many') else [products]
+    serializer._cached_categories = await aget_categories(required={product.category_id for product in rows})
+    return serializer.data
+
+
+@api_view
+async def product_list(request):
+    queryset = filtered_queryset(AsyncProductViewSet, request, 'list')
+    version = await queryset_version(queryset, await aget_category_version())
+
+    async def render_page():
+        page, envelope = await paginate(request, queryset, AsyncProductViewSet.pagination_class)
+        products = await fetch_products(page, images=wants_images(request))
+        return render(envelope(await serialize_products(request, products, many=True)))
+    return await conditional_response(request, version, render_page)
+
+
+@api_view
+async def product_detail(request, pk):
+    queryset = filtered_queryset(AsyncProductViewSet, request, 'retrieve', pk=pk)
+    products = await fetch_products(queryset.filter(pk=pk), images=wants_images(request))
+    if not products:
+        raise Http404('No Product matches the given query.')
+    return render(await serialize_products(request, products[0]))
+
+
+@api_view
+async def product_reviews(request, pk):
+    product = await filtered_queryset(AsyncProductViewSet, request, 'reviews', pk=pk).filter(pk=pk).afirst()
+    if product is None:
+        raise Http404('No Product matches the given query.')
+    reviews = product.reviews.select_related('user', 'product')
+    version = await queryset_version(reviews, (str(product.updated_at), product.updated_at))
+
+    async def render_reviews():
+        reviews_data = ReviewSerializer([review async for review in reviews], many=True, fields=requested_fields(request))
+        return render(reviews_data.data)
+    return await conditional_response(request, version, render_reviews)
+
+
+@api_view
+async def category_list(request):
+    version = await aget_category_version()
+
+    async def render_page():
+        queryset = filtered_queryset(CategoryViewSet, request, 'list')
+        page, envelope = await paginate(request, queryset, CategoryViewSet.pagination_class)
+        categories = [category async for category in page]
+        serializer = CategorySerializer(categories, many=True, fields=requested_fields(request))
+        serializer._cached_categories = await aget_categories(required={category.pk for category in categories})
+        return render(envelope(serializer.data))
+    return await conditional_response(request, version, render_page)
+
+
+@api_view
+async def review_list(request):
+    queryset = filtered_queryset(AsyncReviewViewSet, request, 'list')
+    page, envelope = await paginate(request, queryset, AsyncReviewViewSet.pagination_class)
+    serializer = ReviewSerializer([review async for review in page], many=True, fields=requested_fields(request))
+    return render(envelope(serializer.data))
@@ -0,0 +1,68 @@
+from asgiref.sync import sync_to_async  # type: ignore
+from django.conf import settings  # type: ignore
+from django.core.cache import cache  # type: ignore
+from django.db import transaction  # type: ignore
+from django.db.models import Count, Max, Q  # type: ignore
+from hashlib import md5
+from .models import Category, Product
+
+CATEGORY_CACHE_KEY = 'store:categories'
+CATEGORY_VERSION_CACHE_KEY = 'store:categories:version'
+
+
+def build_categories():
+    from .serializers import CategorySerializer
+    queryset = Category.objects.annotate(
+        product_total=Count('products', filter=Q(products__is_available=True)))
+    categories = {category.pk: dict(CategorySerializer(category).data) for category in queryset}
+    # product totals move with the products, so they count towards the last modification too
+    last_modified = max(
+        filter(None, (
+            Category.objects.aggregate(last=Max('updated_at'))['last'],
+            Product.objects.aggregate(last=Max('updated_at'))['last'],
+        )),
+        default=None,
+    )
+    version = (md5(repr(sorted(categories.items())).encode()).hexdigest(), last_modified)
+    timeout = getattr(settings, 'CATEGORY_CACHE_TIMEOUT', 300)
+    cache.set_many({CATEGORY_CACHE_KEY: categories, CATEGORY_VERSION_CACHE_KEY: version}, timeout)
+    return categories, version
+
+
+def get_categories():
+    """Serialized categories with their available product totals, keyed by category id."""
+    categories = cache.get(CATEGORY_CACHE_KEY)
+    if categories is None:
+        categories, _ = build_categories()
+    return categories
+
+
+def get_category_version():
+    """Hash of the cached categories and the time any category or product last changed."""
+    version = cache.get(CATEGORY_VERSION_CACHE_KEY)
+    if version is None:
+        _, version = build_categories()
+    return version
+
+
+async def aget_categories(required=()):
+    """get_categories for async views, rebuilt when one of the required category ids is missing."""
+    categories = await cache.aget(CATEGORY_CACHE_KEY)
+    if categories is None or any(pk not in categories for pk in required):
+        categories, _ = await sync_to_async(build_categories)()
+    return categories
+
+
+async def aget_category_version():
+    version = await cache.aget(CATEGORY_VERSION_CACHE_KEY)
+    if version is None:
+        _, version = await sync_to_async(build_categories)()
+    return version
+
+
+def invalidate_categories():
+    # dropped now and again once the transaction commits, so a rebuild
+    # that raced with the write can't keep uncommitted counts around
+    keys = [CATEGORY_CACHE_KEY, CATEGORY_VERSION_CACHE_KEY]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
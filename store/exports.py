@@ -0,0 +1,79 @@
+"""
+Order history as CSV or NDJSON, produced row by row for a StreamingHttpResponse.
+
+Orders are read with iterator(chunk_size), which keeps a server-side cursor open on
+PostgreSQL and prefetches the items of one chunk at a time, so memory stays flat
+however long the history is.
+"""
+import csv
+import json
+
+from django.db.models import Prefetch  # type: ignore
+from .models import OrderItem
+
+CHUNK_SIZE = 500
+
+ORDER_COLUMNS = (
+    'order_number', 'created_at', 'username', 'order_status', 'payment_status',
+    'subtotal', 'shipping_cost', 'total',
+)
+ITEM_COLUMNS = ('product_id', 'product_name', 'quantity', 'price', 'subtotal')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class Echo:
+    # csv.writer writes into this and gets the line back instead of buffering it
+    def write(self, value):
+        return value
+
+
+def export_queryset(queryset):
+    items = OrderItem.objects.select_related('product').only(
+        'order_id', 'product_id', 'product__name', 'quantity', 'price').order_by('id')
+    return (
+        queryset.select_related('user').only(
+            'order_number', 'created_at', 'user__username', 'order_status', 'payment_status',
+            'subtotal', 'shipping_cost', 'total',
+        )
+        .prefetch_related(Prefetch('items', queryset=items))
+        .order_by('created_at', 'id')
+    )
+
+
+def order_values(order):
+    return (
+        order.order_number, order.created_at.isoformat(), order.user.username, order.order_status,
+        order.payment_status, str(order.subtotal), str(order.shipping_cost), str(order.total),
+    )
+
+
+def item_values(item):
+    return (item.product_id, item.product.name, item.quantity, str(item.price), str(item.subtotal))
+
+
+def csv_rows(queryset):
+    """One line per order item, the order columns repeated on each."""
+    writer = csv.writer(Echo())
+    yield writer.writerow(ORDER_COLUMNS + tuple(f'item_{column}' for column in ITEM_COLUMNS))
+    for order in export_queryset(queryset).iterator(chunk_size=CHUNK_SIZE):
+        values = order_values(order)
+        for item in order.items.all():
+            yield writer.writerow(values + item_values(item))
+
+
+def ndjson_rows(queryset):
+    """One JSON object per order, with its items nested."""
+    for order in export_queryset(queryset).iterator(chunk_size=CHUNK_SIZE):
+        row = dict(zip(ORDER_COLUMNS, order_values(order)))
+        row['items'] = [dict(zip(ITEM_COLUMNS, item_values(item))) for item in order.items.all()]
+        yield json.dumps(row) + '\n'
+
+
+EXPORTERS = {
+    'csv': csv_rows,
+    'ndjson': ndjson_rows,
+}
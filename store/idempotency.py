@@ -0,0 +1,78 @@
+"""
+Idempotency-Key support for the endpoints that place orders.
+
+A client sends a unique Idempotency-Key header with a request and the same key
+with every retry of it. The first request claims the key and runs, and its
+successful response is stored in the same transaction as the order. Retries then
+get that response back with an Idempotent-Replayed header and no new order.
+A retry that arrives while the first request is still running gets a 409. A
+failed request lets go of its key, so it can be retried, and a retry takes over
+a key whose request never answered once IDEMPOTENCY_KEY_LEASE has passed.
+"""
+import hashlib
+import json
+from functools import wraps
+
+from django.db import transaction  # type: ignore
+from rest_framework import status  # type: ignore
+from rest_framework.renderers import JSONRenderer  # type: ignore
+from rest_framework.response import Response  # type: ignore
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = IdempotencyKey._meta.get_field('key').max_length
+
+
+def fingerprint(request):
+    data = request.data
+    # form bodies come as QueryDicts, all values of a field count
+    if hasattr(data, 'lists'):
+        data = dict(data.lists())
+    body = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(f'{request.method} {request.path}\n{body}'.encode()).hexdigest()
+
+
+def idempotent(view):
+    """Make a viewset method replay its response to retries sent with the same Idempotency-Key."""
+    @wraps(view)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return view(self, request, *args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return Response(
+                {'error': f'{HEADER} must be between 1 and {MAX_KEY_LENGTH} characters.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        digest = fingerprint(request)
+        record, claimed = IdempotencyKey.claim(request.user, key, digest)
+        if not claimed:
+            if record is not None and record.fingerprint != digest:
+                return Response(
+                    {'error': f'This {HEADER} was already used for a different request.'},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY
+                )
+            if record is None or record.status_code is None:
+                return Response(
+                    {'error': f'A request with this {HEADER} is still being processed, retry later.'},
+                    status=status.HTTP_409_CONFLICT
+                )
+            response = Response(record.response, status=record.status_code)
+            response['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            with transaction.atomic():
+                response = view(self, request, *args, **kwargs)
+                if status.is_success(response.status_code):
+                    # kept as the JSON that was sent, so a replay renders exactly the same body
+                    IdempotencyKey.objects.filter(pk=record.pk).update(
+                        status_code=response.status_code, response=json.loads(JSONRenderer().render(response.data)))
+        except Exception:
+            record.delete()
+            raise
+        if not status.is_success(response.status_code):
+            record.delete()
+        return response
+    return wrapper
@@ -0,0 +1,92 @@
+"""
+Resized WebP/JPEG copies of product images.
+
+Every width in PRODUCT_IMAGE_WIDTHS narrower than the upload is encoded in every
+format of PRODUCT_IMAGE_FORMATS and stored next to the original as
+<name>_<width>w.<ext>. The paths are kept on ProductImage.renditions and served
+as srcset strings by ProductImageSerializer.
+"""
+import os
+from io import BytesIO
+
+from django.conf import settings  # type: ignore
+from django.core.files.base import ContentFile  # type: ignore
+from PIL import Image, ImageOps  # type: ignore
+
+PILLOW_FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+
+
+def rendition_name(name, width, image_format):
+    root, _ = os.path.splitext(name)
+    return f'{root}_{width}w.{EXTENSIONS[image_format]}'
+
+
+def load(file):
+    """The upload upright and in RGB, transparent images are flattened onto white."""
+    with Image.open(file) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            flattened = Image.new('RGB', image.size, 'white')
+            flattened.paste(image, mask=image.getchannel('A'))
+            return flattened
+        return image.convert('RGB')
+
+
+def rendition_widths(image):
+    # never upscaled, an upload narrower than every width is only re-encoded
+    return sorted({width for width in settings.PRODUCT_IMAGE_WIDTHS if width < image.width} or {image.width})
+
+
+def encode(image, width, image_format, quality=None):
+    """image scaled to width and encoded in image_format, as bytes."""
+    quality = quality or settings.PRODUCT_IMAGE_QUALITY
+    if width < image.width:
+        image = image.resize((width, max(round(image.height * width / image.width), 1)), Image.LANCZOS)
+    if image_format == 'jpeg':
+        options = {'optimize': True, 'progressive': True}
+    else:
+        options = {'method': 4}
+    buffer = BytesIO()
+    image.save(buffer, PILLOW_FORMATS[image_format], quality=quality, **options)
+    return buffer.getvalue()
+
+
+def generate_renditions(product_image):
+    """Write every rendition of the image to its storage, returns the renditions map."""
+    field = product_image.image
+    storage = field.storage
+    with storage.open(field.name) as file:
+        image = load(file)
+    renditions = {'source': field.name}
+    for image_format in settings.PRODUCT_IMAGE_FORMATS:
+        renditions[image_format] = {}
+        for width in rendition_widths(image):
+            name = rendition_name(field.name, width, image_format)
+            # replaced rather than saved under a new random suffix
+            if storage.exists(name):
+                storage.delete(name)
+            renditions[image_format][str(width)] = storage.save(
+                name, ContentFile(encode(image, width, image_format)))
+    return renditions
+
+
+def srcset(product_image, request=None):
+    """{format: 'url 320w, url 640w'} for the current upload, empty until its renditions exist."""
+    renditions = product_image.renditions or {}
+    if not product_image.image or renditions.get('source') != product_image.image.name:
+        return {}
+    storage = product_image.image.storage
+    sources = {}
+    for image_format in settings.PRODUCT_IMAGE_FORMATS:
+        widths = renditions.get(image_format) or {}
+        candidates = []
+        for width, name in sorted(widths.items(), key=lambda item: int(item[0])):
+            url = storage.url(name)
+            if request is not None:
+                url = request.build_absolute_uri(url)
+            candidates.append(f'{url} {width}w')
+        if candidates:
+            sources[image_format] = ', '.join(candidates)
+    return sources
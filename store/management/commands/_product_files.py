@@ -0,0 +1,35 @@
+"""Shared by import_products and export_products."""
+import contextlib
+import resource
+import sys
+
+from django.core.management.base import CommandError  # type: ignore
+
+COLUMNS = ('id', 'name', 'description', 'price', 'stock', 'is_available', 'category')
+FORMATS = ('csv', 'jsonl')
+EXTENSIONS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+
+def file_format(path, chosen):
+    if chosen:
+        return chosen
+    for extension, name in EXTENSIONS.items():
+        if path.lower().endswith(extension):
+            return name
+    raise CommandError(f'Can not tell the format of {path}, pass --format.')
+
+
+@contextlib.contextmanager
+def open_file(path, mode):
+    # - is stdin or stdout, left open for whoever owns it
+    if path == '-':
+        yield sys.stdin if 'r' in mode else sys.stdout
+        return
+    with open(path, mode, newline='', encoding='utf-8') as file:
+        yield file
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
@@ -0,0 +1,110 @@
+import asyncio
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from store.models import Product
+
+# each endpoint is served by the DRF view under gunicorn's sync workers and by its async copy under uvicorn workers
+ENDPOINTS = {
+    'products': '/api/{prefix}products/',
+    'product': '/api/{prefix}products/{pk}/',
+    'reviews': '/api/{prefix}products/{pk}/reviews/',
+    'categories': '/api/{prefix}categories/',
+}
+
+SERVERS = (
+    ('gunicorn sync', 'shopify_api.wsgi:application', [], ''),
+    ('gunicorn uvicorn', 'shopify_api.asgi:application', ['--worker-class', 'uvicorn.workers.UvicornWorker'], 'async/'),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Start the API under gunicorn sync workers and under uvicorn workers on the database of the current '
+        'settings, then compare requests/sec and latency of a catalog endpoint at a given concurrency.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoint', choices=sorted(ENDPOINTS), default='products')
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--concurrency', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=2)
+
+    def handle(self, *args, **options):
+        product = Product.objects.order_by('pk').first()
+        if product is None:
+            raise CommandError('There are no products to request, seed the database first.')
+
+        self.stdout.write(f"{'server':<18} {'req/s':>9} {'p50 (ms)':>10} {'p99 (ms)':>10} {'errors':>7}")
+        for name, app, worker_args, prefix in SERVERS:
+            path = ENDPOINTS[options['endpoint']].format(prefix=prefix, pk=product.pk)
+            port = self.free_port()
+            server = subprocess.Popen(
+                [sys.executable, '-m', 'gunicorn', app, '--bind', f'127.0.0.1:{port}',
+                 '--workers', str(options['workers']), '--log-level', 'warning', *worker_args],
+            )
+            try:
+                self.wait_for(port, server)
+                # a short warm-up so every worker has its connections and caches ready
+                asyncio.run(self.load(port, path, options['workers'] * 10, options['concurrency']))
+                elapsed, latencies, errors = asyncio.run(
+                    self.load(port, path, options['requests'], options['concurrency']))
+            finally:
+                server.terminate()
+                server.wait()
+            latencies.sort()
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0
+            self.stdout.write(
+                f'{name:<18} {options["requests"] / elapsed:>9.1f} '
+                f'{statistics.median(latencies or [0]):>10.2f} {p99:>10.2f} {errors:>7}'
+            )
+
+    def free_port(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    def wait_for(self, port, server, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError('The server exited before it started listening.')
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError(f'Nothing listened on port {port} after {timeout} seconds.')
+
+    async def load(self, port, path, total, concurrency):
+        """Send total GETs with at most concurrency in flight, returns (seconds, latencies in ms, errors)."""
+        latencies = []
+        errors = 0
+        semaphore = asyncio.Semaphore(concurrency)
+        request = f'GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'.encode()
+
+        async def fetch():
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                    writer.write(request)
+                    await writer.drain()
+                    response = await reader.read()
+                    writer.close()
+                except OSError:
+                    errors += 1
+                    return
+                if not response.startswith((b'HTTP/1.1 200', b'HTTP/1.0 200')):
+                    errors += 1
+                    return
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(fetch() for _ in range(total)))
+        return time.perf_counter() - started, latencies, errors
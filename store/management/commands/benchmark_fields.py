@@ -0,0 +1,59 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from django.db import connection  # type: ignore
+from django.test.utils import CaptureQueriesContext  # type: ignore
+from rest_framework.test import APIClient  # type: ignore
+from store.models import User
+
+ENDPOINTS = {
+    'products': ('/api/products/', 'id,name,price'),
+    'orders': ('/api/orders/', 'id,order_number,order_status,total'),
+    'reviews': ('/api/reviews/', 'id,rating,title'),
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare queries, response size and latency of a full page and a page pruned with ?fields=.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoint', choices=sorted(ENDPOINTS), default='products')
+        parser.add_argument('--fields', help='the ?fields= to compare with, a short list per endpoint by default')
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--user', help='username to authenticate as, needed for orders')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        client = APIClient(HTTP_HOST='localhost')
+        if options['user']:
+            client.force_authenticate(User.objects.get(username=options['user']))
+        url, fields = ENDPOINTS[options['endpoint']]
+        params = {'page_size': options['page_size']}
+
+        rows = [
+            ('full', self.measure(client, url, params, options['repeat'])),
+            (f"fields={options['fields'] or fields}",
+             self.measure(client, url, {**params, 'fields': options['fields'] or fields}, options['repeat'])),
+        ]
+
+        width = max(len(name) for name, _ in rows)
+        self.stdout.write(f"{'response':<{width}} {'queries':>8} {'bytes':>10} {'median (ms)':>12}")
+        for name, (queries, size, median) in rows:
+            self.stdout.write(f'{name:<{width}} {queries:>8} {size:>10} {median:>12.2f}')
+
+    def measure(self, client, url, params, repeat):
+        # warmed up first, so neither side pays for filling the caches
+        client.get(url, params)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url, params)
+        # counted now, every request clears the query log when DEBUG is on
+        query_count = len(queries)
+        if response.status_code != 200:
+            raise CommandError(f'{url} answered {response.status_code}.')
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            client.get(url, params)
+            timings.append((time.perf_counter() - started) * 1000)
+        return query_count, len(response.content), statistics.median(timings)
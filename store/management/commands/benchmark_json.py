@@ -0,0 +1,64 @@
+import statistics
+import time
+from io import BytesIO
+
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from django.db.models import Prefetch  # type: ignore
+from rest_framework.parsers import JSONParser  # type: ignore
+from rest_framework.renderers import JSONRenderer  # type: ignore
+from store.models import Order, OrderItem, Product
+from store.renderers import ORJSONParser, ORJSONRenderer
+from store.serializers import OrderSerializer, ProductSerializer
+
+
+class Command(BaseCommand):
+    help = "Compare rendering and parsing serialized products and orders with DRF's JSON classes and orjson's."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100, help='products in the product payload')
+        parser.add_argument('--orders', type=int, default=100, help='orders in the order payload')
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        products = Product.objects.select_related('category').prefetch_related('images').order_by('id')
+        items = OrderItem.objects.select_related('product', 'productimage').order_by('id')
+        orders = (
+            Order.objects.select_related('user', 'shipping_address', 'billing_address')
+            .prefetch_related(Prefetch('items', queryset=items)).order_by('id')
+        )
+        # serialized once up front, only turning the data into JSON and back is timed
+        payloads = {
+            'products': ProductSerializer(products[:options['products']], many=True).data,
+            'orders': OrderSerializer(orders[:options['orders']], many=True).data,
+        }
+        if not any(payloads.values()):
+            raise CommandError('There are no products or orders to serialize.')
+
+        self.stdout.write(
+            f"{'payload':<9} {'step':<7} {'bytes':>9} {'drf (ms)':>9} {'orjson (ms)':>12} {'speedup':>8} {'orjson MB/s':>12}")
+        for name, data in payloads.items():
+            if not data:
+                continue
+            content = JSONRenderer().render(data)
+            steps = (
+                ('render', JSONRenderer().render, ORJSONRenderer().render, data),
+                ('parse', lambda body: JSONParser().parse(BytesIO(body)),
+                 lambda body: ORJSONParser().parse(BytesIO(body)), content),
+            )
+            for step, drf, fast, argument in steps:
+                if drf(argument) != fast(argument):
+                    raise CommandError(f"orjson's {step} of {name} differs from DRF's.")
+                drf_ms = self.time(drf, argument, options['repeat'])
+                fast_ms = self.time(fast, argument, options['repeat'])
+                throughput = len(content) / fast_ms / 1000
+                self.stdout.write(
+                    f'{name:<9} {step:<7} {len(content):>9} {drf_ms:>9.3f} {fast_ms:>12.3f}'
+                    f' {drf_ms / fast_ms:>7.1f}x {throughput:>12.1f}')
+
+    def time(self, function, argument, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            function(argument)
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
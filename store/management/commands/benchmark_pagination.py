@@ -0,0 +1,57 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from rest_framework.test import APIClient  # type: ignore
+from store.models import User
+
+ENDPOINTS = {
+    'products': '/api/products/',
+    'orders': '/api/orders/',
+    'reviews': '/api/reviews/',
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare the latency of the first and a deep page with page number and cursor pagination.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoint', choices=sorted(ENDPOINTS), default='products')
+        parser.add_argument('--page', type=int, default=1000)
+        parser.add_argument('--user', help='username to authenticate as, needed for orders')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        client = APIClient(HTTP_HOST='localhost')
+        if options['user']:
+            client.force_authenticate(User.objects.get(username=options['user']))
+        url = ENDPOINTS[options['endpoint']]
+        deep = options['page']
+
+        rows = [
+            ('page number', self.time(client, f'{url}?page=1', options['repeat']),
+             self.time(client, f'{url}?page={deep}', options['repeat'])),
+        ]
+
+        # cursors can't jump, so the deep page is reached by following the next links
+        first = f'{url}?pagination=cursor'
+        last = first
+        for _ in range(deep - 1):
+            last = client.get(last).data['next']
+            if last is None:
+                raise CommandError(f'There are fewer than {deep} pages.')
+        rows.append(('cursor', self.time(client, first, options['repeat']), self.time(client, last, options['repeat'])))
+
+        self.stdout.write(f"{'pagination':<12} {'page 1 (ms)':>12} {f'page {deep} (ms)':>16}")
+        for name, page_one, page_deep in rows:
+            self.stdout.write(f'{name:<12} {page_one:>12.2f} {page_deep:>16.2f}')
+
+    def time(self, client, url, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            response = client.get(url)
+            timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                raise CommandError(f'{url} answered {response.status_code}.')
+        return statistics.median(timings)
@@ -0,0 +1,79 @@
+import statistics
+import time
+from io import BytesIO
+from pathlib import Path
+
+from django.conf import settings  # type: ignore
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from PIL import Image  # type: ignore
+from store.images import encode, load, rendition_widths
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure how fast product images are resized and encoded in every configured width and format, '
+        'and how many image bytes a product listing page downloads with originals versus renditions.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', help='directory of sample photos, synthetic images are used otherwise')
+        parser.add_argument('--images', type=int, default=10)
+        parser.add_argument('--size', default='3000x2000', help='width x height of the synthetic images')
+        parser.add_argument('--page-size', type=int, default=10, help='images shown on one listing page')
+
+    def handle(self, *args, **options):
+        originals = self.originals(options)
+        images = [load(BytesIO(original)) for original in originals]
+
+        rows = []
+        thumbnails = {}
+        for image_format in settings.PRODUCT_IMAGE_FORMATS:
+            for width in sorted({width for image in images for width in rendition_widths(image)}):
+                timings, sizes = [], []
+                for image in images:
+                    if width not in rendition_widths(image):
+                        continue
+                    started = time.perf_counter()
+                    sizes.append(len(encode(image, width, image_format)))
+                    timings.append(time.perf_counter() - started)
+                rows.append((image_format, width, len(timings) / sum(timings), statistics.mean(sizes)))
+                thumbnails.setdefault(image_format, statistics.mean(sizes))
+
+        self.stdout.write(f"{'format':<8} {'width':>6} {'images/s':>10} {'avg KB':>10}")
+        for image_format, width, rate, size in rows:
+            self.stdout.write(f'{image_format:<8} {width:>6} {rate:>10.1f} {size / 1024:>10.1f}')
+
+        # a listing grid only needs the smallest rendition of every product image
+        page = options['page_size']
+        original_bytes = statistics.mean(len(original) for original in originals) * page
+        self.stdout.write('')
+        self.stdout.write(f"{'listing page':<22} {'image KB':>10} {'saved':>8}")
+        self.stdout.write(f"{'originals':<22} {original_bytes / 1024:>10.1f} {'':>8}")
+        for image_format, size in thumbnails.items():
+            total = size * page
+            self.stdout.write(
+                f"{f'smallest {image_format}':<22} {total / 1024:>10.1f} {1 - total / original_bytes:>8.1%}")
+
+    def originals(self, options):
+        """Encoded sample uploads, read from --source or made up as camera-sized JPEGs."""
+        if options['source']:
+            paths = sorted(p for p in Path(options['source']).iterdir() if p.is_file())[:options['images']]
+            if not paths:
+                raise CommandError(f"No files in {options['source']}.")
+            return [path.read_bytes() for path in paths]
+        try:
+            width, height = (int(part) for part in options['size'].lower().split('x'))
+        except ValueError:
+            raise CommandError('--size must look like 3000x2000.')
+        originals = []
+        for i in range(options['images']):
+            # gradients with a little noise compress roughly like a product photo, flat colours would flatter the encoder
+            base = Image.merge('RGB', (
+                Image.linear_gradient('L').rotate(i * 37).resize((width, height)),
+                Image.radial_gradient('L').resize((width, height)),
+                Image.effect_noise((width, height), 24 + i),
+            ))
+            buffer = BytesIO()
+            base.save(buffer, 'JPEG', quality=92)
+            originals.append(buffer.getvalue())
+        return originals
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand  # type: ignore
+from store.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = 'Delete the stored responses of Idempotency-Keys older than IDEMPOTENCY_KEY_TTL.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        deleted = IdempotencyKey.delete_expired(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired idempotency keys.'))
@@ -0,0 +1,54 @@
+import csv
+import json
+import time
+
+from django.core.management.base import BaseCommand  # type: ignore
+from store.models import Product
+from ._product_files import COLUMNS, FORMATS, file_format, open_file, peak_rss_mb
+
+
+class Command(BaseCommand):
+    help = (
+        'Write every product to a CSV or JSON Lines file that import_products reads back. '
+        'Rows are streamed from the database in chunks, memory stays flat however big the catalog is.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='file to write, - for stdout')
+        parser.add_argument('--format', choices=FORMATS, help='taken from the file extension by default')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='rows fetched from the database at a time')
+        parser.add_argument('--category', help='only the products of the category with this name')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        fmt = file_format(options['path'], options['format'])
+        queryset = Product.objects.order_by('pk')
+        if options['category']:
+            queryset = queryset.filter(category__name=options['category'])
+        # on PostgreSQL iterator() reads through a server-side cursor
+        rows = queryset.values_list(
+            'pk', 'name', 'description', 'price', 'stock', 'is_available', 'category__name',
+        ).iterator(chunk_size=options['chunk_size'])
+
+        exported = 0
+        with open_file(options['path'], 'w') as file:
+            if fmt == 'csv':
+                writer = csv.writer(file)
+                writer.writerow(COLUMNS)
+                for row in rows:
+                    writer.writerow(row)
+                    exported += 1
+            else:
+                for row in rows:
+                    row = dict(zip(COLUMNS, row))
+                    row['price'] = str(row['price'])
+                    file.write(json.dumps(row) + '\n')
+                    exported += 1
+
+        elapsed = time.perf_counter() - started
+        # the summary goes to stderr when the rows themselves are on stdout
+        out = self.stderr if options['path'] == '-' else self.stdout
+        out.write(self.style.SUCCESS(
+            f'Exported {exported} products in {elapsed:.1f}s ({exported / max(elapsed, 1e-9):.0f} rows/s), '
+            f'peak RSS {peak_rss_mb():.0f} MB.'
+        ))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from shopify_api.celery import has_broker
+from store.models import ProductImage
+from store.tasks import generate_image_renditions
+
+
+class Command(BaseCommand):
+    help = 'Create the resized copies of product images uploaded before the renditions existed or whose settings changed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='regenerate images that already have renditions')
+        parser.add_argument('--queue', action='store_true', help='hand the images to the Celery workers instead of resizing here')
+
+    def handle(self, *args, **options):
+        # without a broker the queued images would sit in this process's memory and go when it exits
+        if options['queue'] and not has_broker():
+            raise CommandError('--queue needs CELERY_BROKER_URL pointing at the broker the workers read from.')
+        generated = skipped = 0
+        for image_id, name, renditions in ProductImage.objects.order_by('pk').values_list('pk', 'image', 'renditions').iterator():
+            if not options['force'] and (renditions or {}).get('source') == name:
+                continue
+            if options['queue']:
+                generate_image_renditions.delay(image_id)
+                generated += 1
+            elif generate_image_renditions(image_id):
+                generated += 1
+            else:
+                skipped += 1
+
+        verb = 'Queued' if options['queue'] else 'Generated renditions for'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {generated} images, {skipped} could not be read.'))
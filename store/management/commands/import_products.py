@@ -0,0 +1,128 @@
+import csv
+import json
+import time
+from itertools import islice
+
+from django.conf import settings  # type: ignore
+from django.core.management.base import BaseCommand  # type: ignore
+from django.db import reset_queries, transaction  # type: ignore
+from django.utils import timezone  # type: ignore
+from rest_framework.exceptions import ValidationError  # type: ignore
+from store.cache import invalidate_categories
+from store.models import Category, Product
+from store.serializers import ProductImportSerializer
+from ._product_files import FORMATS, file_format, open_file, peak_rss_mb
+
+
+class Command(BaseCommand):
+    help = (
+        'Create and update products from a CSV or JSON Lines file with the columns of export_products. '
+        'Rows with an id update that product, rows without one are created. The file is streamed and '
+        'every batch is validated with the ProductSerializer rules and written in its own transaction.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='file to read, - for stdin')
+        parser.add_argument('--format', choices=FORMATS, help='taken from the file extension by default')
+        parser.add_argument('--batch-size', type=int, default=1000, help='rows per transaction')
+        parser.add_argument('--max-errors', type=int, default=20, help='invalid rows to print, all are counted')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        fmt = file_format(options['path'], options['format'])
+        self.categories = dict(Category.objects.values_list('name', 'id'))
+        self.serializer = ProductImportSerializer()
+        created = updated = invalid = 0
+
+        with open_file(options['path'], 'r') as file:
+            rows = self.read_csv(file) if fmt == 'csv' else self.read_jsonl(file)
+            while True:
+                batch = list(islice(rows, options['batch_size']))
+                if not batch:
+                    break
+                batch_created, batch_updated, errors = self.import_batch(batch)
+                # with DEBUG on every INSERT would be kept in connection.queries
+                if settings.DEBUG:
+                    reset_queries()
+                created += batch_created
+                updated += batch_updated
+                for line, error in errors:
+                    if invalid < options['max_errors']:
+                        self.stderr.write(f'line {line}: {json.dumps(error)}')
+                    invalid += 1
+
+        # bulk writes send no signals, the category totals are dropped once at the end
+        invalidate_categories()
+        elapsed = time.perf_counter() - started
+        rows = created + updated + invalid
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {created}, updated {updated}, skipped {invalid} invalid rows '
+            f'in {elapsed:.1f}s ({rows / elapsed:.0f} rows/s), peak RSS {peak_rss_mb():.0f} MB.'
+        ))
+
+    def read_csv(self, file):
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+
+    def read_jsonl(self, file):
+        for line, text in enumerate(file, start=1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError as exc:
+                row = {'_error': f'Invalid JSON: {exc}'}
+            yield line, row if isinstance(row, dict) else {'_error': 'Each line must be a JSON object.'}
+
+    def import_batch(self, batch):
+        """Validate and write one batch, returns (created, updated, [(line, errors)])."""
+        errors = []
+        valid = []
+        for line, row in batch:
+            try:
+                valid.append((line, *self.validate_row(row)))
+            except ValidationError as exc:
+                errors.append((line, exc.detail))
+
+        # descriptions are unique, checked against the file so far and the table in one query
+        seen = {}
+        for line, pk, data in valid:
+            seen.setdefault(data['description'], []).append((line, pk))
+        owners = dict(Product.objects.filter(description__in=seen).values_list('description', 'pk'))
+        existing = set(Product.objects.filter(pk__in={pk for _, pk, _ in valid if pk}).values_list('pk', flat=True))
+
+        creates, updates = [], {}
+        now = timezone.now()
+        for line, pk, data in valid:
+            owner = owners.get(data['description'], pk)
+            if pk and pk not in existing:
+                errors.append((line, {'id': [f'No product with id {pk}.']}))
+            elif owner != pk or seen[data['description']][0][0] != line:
+                errors.append((line, {'description': ['product with this description already exists.']}))
+            elif pk:
+                # a row only writes the columns it has, the rest keep their values instead of the model defaults
+                updates.setdefault(tuple(sorted(data)), []).append(Product(pk=pk, updated_at=now, **data))
+            else:
+                creates.append(Product(**data))
+
+        with transaction.atomic():
+            Product.objects.bulk_create(creates)
+            for fields, products in updates.items():
+                Product.objects.bulk_update(products, [*fields, 'updated_at'])
+        return len(creates), sum(map(len, updates.values())), sorted(errors, key=lambda error: error[0])
+
+    def validate_row(self, row):
+        if '_error' in row:
+            raise ValidationError({'non_field_errors': [row['_error']]})
+        row = {key: value for key, value in row.items() if key is not None}
+        pk = row.pop('id', None)
+        try:
+            pk = int(pk) if pk not in (None, '') else None
+        except (TypeError, ValueError):
+            raise ValidationError({'id': ['A valid integer is required.']})
+        category = row.pop('category', None)
+        if category not in self.categories:
+            raise ValidationError({'category': [f'Unknown category "{category}".']})
+        row['category_id'] = self.categories[category]
+        return pk, self.serializer.run_validation(row)
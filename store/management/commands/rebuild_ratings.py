@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand  # type: ignore
+from django.db import transaction  # type: ignore
+from django.db.models import Count  # type: ignore
+from django.utils import timezone  # type: ignore
+from store.models import Product, Review
+
+
+RATING_FIELDS = ['rating_sum', 'rating_count'] + [f'rating_{star}_count' for star in range(1, 6)]
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored rating totals on every product from its reviews.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        # one grouped query gives the number of reviews per (product, star)
+        histograms = {}
+        rows = Review.objects.order_by().values('product_id', 'rating').annotate(total=Count('id'))
+        for row in rows:
+            histograms.setdefault(row['product_id'], {})[row['rating']] = row['total']
+
+        products = []
+        now = timezone.now()
+        with transaction.atomic():
+            for product in Product.objects.select_for_update().only('id', 'updated_at', *RATING_FIELDS).iterator():
+                histogram = histograms.get(product.id, {})
+                for star in range(1, 6):
+                    setattr(product, f'rating_{star}_count', histogram.get(star, 0))
+                product.rating_count = sum(histogram.values())
+                product.rating_sum = sum(star * total for star, total in histogram.items())
+                product.updated_at = now
+                products.append(product)
+            Product.objects.bulk_update(products, RATING_FIELDS + ['updated_at'], batch_size=options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt ratings for {len(products)} products.'))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from django.utils.dateparse import parse_date  # type: ignore
+from store.analytics import rebuild
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the daily sales rollups from the orders, for every day or only the days between '
+        '--start and --end. Run it after loading orders in bulk or to repair the rollups.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='First day to rebuild, YYYY-MM-DD.')
+        parser.add_argument('--end', help='Last day to rebuild, YYYY-MM-DD.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        days = {}
+        for name in ('start', 'end'):
+            if options[name]:
+                try:
+                    days[name] = parse_date(options[name])
+                except ValueError:
+                    days[name] = None
+                if days[name] is None:
+                    raise CommandError(f'--{name} must be a date like 2024-11-28.')
+
+        rebuilt = rebuild(days.get('start'), days.get('end'), batch_size=options['batch_size'])
+        summary = ', '.join(f'{table} {rows} rows' for table, rows in rebuilt.items())
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt sales rollups: {summary}.'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand  # type: ignore
+from store.models import StockReservation
+
+
+class Command(BaseCommand):
+    help = 'Give the stock held by expired cart reservations back to the products.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        released = StockReservation.release_expired(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Released {released} expired reservations.'))
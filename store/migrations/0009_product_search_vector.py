@@ -0,0 +1,59 @@
+# Generated by Django 4.2.7 on 2026-10-18 01:55
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('english', coalesce({row}name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce({row}description, '')), 'B')"
+)
+
+FORWARD_SQL = [
+    f"""
+    CREATE FUNCTION store_product_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := {SEARCH_VECTOR.format(row='NEW.')};
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER store_product_search_vector
+    BEFORE INSERT OR UPDATE OF name, description ON store_product
+    FOR EACH ROW EXECUTE PROCEDURE store_product_search_vector_update()
+    """,
+    f"UPDATE store_product SET search_vector = {SEARCH_VECTOR.format(row='')}",
+    "CREATE INDEX store_product_search_vector_gin ON store_product USING gin (search_vector)",
+]
+
+BACKWARD_SQL = [
+    "DROP INDEX IF EXISTS store_product_search_vector_gin",
+    "DROP TRIGGER IF EXISTS store_product_search_vector ON store_product",
+    "DROP FUNCTION IF EXISTS store_product_search_vector_update()",
+]
+
+
+def run_on_postgresql(statements):
+    # the trigger and the GIN index only exist on PostgreSQL, other databases search with LIKE
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0008_cursor_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(run_on_postgresql(FORWARD_SQL), run_on_postgresql(BACKWARD_SQL)),
+    ]
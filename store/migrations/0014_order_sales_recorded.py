@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:13
+
+from django.db import migrations, models
+
+
+def mark_recorded(apps, schema_editor):
+    # the rollups already count every order that isn't cancelled
+    Order = apps.get_model('store', 'Order')
+    Order.objects.exclude(order_status='cancelled').update(sales_recorded=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='sales_recorded',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_recorded, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,9 @@
-from django.db import models  # type: ignore
+from django.conf import settings  # type: ignore
+from django.contrib.postgres.search import SearchVectorField  # type: ignore
+from django.db import IntegrityError, models, transaction  # type: ignore
+from django.db.models import Case, F, When  # type: ignore
+from django.utils import timezone  # type: ignore
+from datetime import timedelta
 from django.contrib.auth.models import AbstractUser  # type: ignore
 from django.core.validators import MinValueValidator, MaxValueValidator  # type: ignore
 import uuid
@@ -30,7 +35,19 @@ class Product(models.Model):
     description = models.TextField(blank=True, unique=True)
     price = models.DecimalField(max_digits=12, decimal_places=2)
     stock = models.PositiveIntegerField(default=0)
+    # units held by carts, kept in sync by StockReservation so availability never sums the holds
+    reserved_stock = models.PositiveIntegerField(default=0)
     is_available = models.BooleanField(default=True)
+    # review aggregates, kept in sync by Product.adjust_rating so listings never scan reviews
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_1_count = models.PositiveIntegerField(default=0)
+    rating_2_count = models.PositiveIntegerField(default=0)
+    rating_3_count = models.PositiveIntegerField(default=0)
+    rating_4_count = models.PositiveIntegerField(default=0)
+    rating_5_count = models.PositiveIntegerField(default=0)
+    # weighted tsvector of name and description, filled by a database trigger on PostgreSQL
+    search_vector = SearchVectorField(null=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -39,6 +56,8 @@ class Product(models.Model):
         indexes = [
             models.Index(fields=['category', 'is_available']),
             models.Index(fields=['price']),
+            # cursor pagination walks (created_at, id)
+            models.Index(fields=['created_at', 'id']),
         ]
 
     def __str__(self):
@@ -48,12 +67,38 @@ class Product(models.Model):
     def is_in_stock(self):
         return self.stock > 0
 
+    @property
+    def available_stock(self):
+        return max(self.stock - self.reserved_stock, 0)
+
+    @property
+    def average_rating(self):
+        if not self.rating_count:
+            return 0
+        return self.rating_sum / self.rating_count
+
+    @property
+    def rating_histogram(self):
+        return {star: getattr(self, f'rating_{star}_count') for star in range(1, 6)}
+
+    @classmethod
+    def adjust_rating(cls, product_id, rating, delta):
+        # delta is 1 when a review with this rating is added and -1 when it is removed
+        cls.objects.filter(pk=product_id).update(**{
+            'updated_at': timezone.now(),
+            'rating_sum': F('rating_sum') + rating * delta,
+            'rating_count': F('rating_count') + delta,
+            f'rating_{rating}_count': F(f'rating_{rating}_count') + delta,
+        })
+
 
 class ProductImage(models.Model):
     product = models.ForeignKey(
         Product, on_delete=models.CASCADE, related_name='images')
     image = models.ImageField(upload_to='products/%Y/%m/%d/')
     alt_text = models.CharField(max_length=255, blank=True, null=True)
+    # resized copies stored next to the original, {'source': image name, format: {width: path}}
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -104,6 +149,24 @@ class Order(models.Model):
         ('failed', 'Failed'),
         ('refunded', 'Refunded'),
     )
+
+    # status: the statuses it may move to, anything else is refused
+    ORDER_TRANSITIONS = {
+        'pending': ('processing', 'cancelled'),
+        'processing': ('shipped', 'cancelled'),
+        'shipped': ('delivered',),
+        'delivered': (),
+        'cancelled': (),
+    }
+    PAYMENT_TRANSITIONS = {
+        'unpaid': ('paid', 'failed'),
+        # a failed payment can be tried again
+        'failed': ('paid',),
+        'paid': ('refunded',),
+        'refunded': (),
+    }
+    TRANSITIONS = {'order_status': ORDER_TRANSITIONS, 'payment_status': PAYMENT_TRANSITIONS}
+    CANCELLABLE = tuple(status for status, targets in ORDER_TRANSITIONS.items() if 'cancelled' in targets)
     user = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name='orders')
     order_number = models.CharField(
@@ -121,6 +184,8 @@ class Order(models.Model):
         max_digits=10, decimal_places=2, default=0)
     total = models.DecimalField(max_digits=12, decimal_places=2)
     notes = models.TextField(blank=True, null=True)
+    # whether the order is counted in the sales rollups, flipped together with them so a redelivered task adds nothing
+    sales_recorded = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -129,6 +194,9 @@ class Order(models.Model):
         indexes = [
             models.Index(fields=['order_number']),
             models.Index(fields=['user', 'order_status']),
+            models.Index(fields=['user', 'created_at', 'id']),
+            # staff exports walk every user's orders by date
+            models.Index(fields=['created_at', 'id']),
         ]
 
     def __str__(self):
@@ -140,6 +208,72 @@ class Order(models.Model):
             self.order_number = uuid.uuid4().hex[:12].upper()
         super().save(*args, **kwargs)
 
+    @classmethod
+    def can_transition(cls, field, current, target):
+        return target in cls.TRANSITIONS[field][current]
+
+    @classmethod
+    def sources(cls, field, target):
+        """The statuses of field that may move to target."""
+        return tuple(status for status, targets in cls.TRANSITIONS[field].items() if target in targets)
+
+    @classmethod
+    @transaction.atomic
+    def transition(cls, order_ids, field, target):
+        """
+        Move the given orders to target on field, order_status or payment_status, where the transition table allows it.
+
+        Returns ({order id: status before}, ids moved). Cancellations go through cancel() so
+        their stock comes back, everything else is one conditional update.
+        """
+        sources = cls.sources(field, target)
+        current = dict(
+            cls.objects.select_for_update().filter(pk__in=order_ids)
+            .order_by('pk').values_list('pk', field)
+        )
+        movable = [pk for pk, status in current.items() if status in sources]
+        if field == 'order_status' and target == 'cancelled':
+            return current, cls.cancel(movable)
+        if movable:
+            cls.objects.filter(pk__in=movable, **{f'{field}__in': sources}).update(
+                **{field: target}, updated_at=timezone.now())
+        return current, movable
+
+    @classmethod
+    @transaction.atomic
+    def cancel(cls, order_ids):
+        """
+        Cancel the given orders that are still pending or processing and put their items back in stock.
+
+        Returns the ids that this call cancelled, an order that was cancelled or shipped
+        meanwhile is left alone, so its stock is never restored twice.
+        """
+        ids = list(
+            cls.objects.select_for_update()
+            .filter(pk__in=order_ids, order_status__in=cls.CANCELLABLE)
+            .order_by('pk').values_list('pk', flat=True)
+        )
+        if not ids:
+            return []
+        now = timezone.now()
+        # the status is checked again by the update itself, not only by the read above
+        cls.objects.filter(pk__in=ids, order_status__in=cls.CANCELLABLE).update(order_status='cancelled', updated_at=now)
+
+        quantities = {}
+        for product_id, quantity in OrderItem.objects.filter(order_id__in=ids).values_list('product_id', 'quantity'):
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+        if quantities:
+            # locked in id order like checkout does, then restored in one statement
+            list(Product.objects.select_for_update().filter(pk__in=quantities).order_by('pk').values_list('pk'))
+            Product.objects.filter(pk__in=quantities).update(
+                stock=Case(
+                    *(When(pk=pk, then=F('stock') + quantity) for pk, quantity in quantities.items()),
+                    output_field=models.PositiveIntegerField(),
+                ),
+                updated_at=now,
+            )
+        return ids
+
 
 class OrderItem(models.Model):
     order = models.ForeignKey(
@@ -215,6 +349,290 @@ class Review(models.Model):
     class Meta:
         unique_together = ('product', 'user')
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at', 'id']),
+            models.Index(fields=['product', 'created_at', 'id']),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.product.name} ({self.rating}/5)"
+
+
+
+class StockReservation(models.Model):
+    cart = models.ForeignKey(
+        Cart, on_delete=models.CASCADE, related_name='reservations')
+    product = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('cart', 'product')
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} held by cart {self.cart_id}"
+
+    @staticmethod
+    def ttl():
+        return getattr(settings, 'CART_RESERVATION_TTL', timedelta(minutes=15))
+
+    @classmethod
+    def reserve(cls, cart, product, quantity):
+        """Set the hold of a cart on a product to quantity, returns False when there isn't enough stock."""
+        return not cls.reserve_many(cart, {product.pk: quantity})
+
+    @classmethod
+    @transaction.atomic
+    def reserve_many(cls, cart, quantities):
+        """
+        Set the holds of a cart to {product id: quantity}, all or nothing.
+
+        Returns {product id: available units} for the products that can't cover
+        their increase, in which case no hold is changed.
+        """
+        # the product rows are locked before the reservations, the same order checkout and the reaper use
+        products = {
+            product.pk: product
+            for product in Product.objects.select_for_update().filter(pk__in=quantities).order_by('pk')
+        }
+        reservations = {
+            reservation.product_id: reservation
+            for reservation in cls.objects.select_for_update().filter(cart=cart, product_id__in=products)
+        }
+        deltas = {
+            pk: quantities[pk] - (reservations[pk].quantity if pk in reservations else 0)
+            for pk in products
+        }
+        shortages = {
+            pk: products[pk].available_stock
+            for pk, delta in deltas.items()
+            if delta > 0 and products[pk].stock - products[pk].reserved_stock < delta
+        }
+        if shortages:
+            return shortages
+
+        now = timezone.now()
+        changed = {pk: delta for pk, delta in deltas.items() if delta}
+        if changed:
+            Product.objects.filter(pk__in=changed).update(
+                reserved_stock=Case(
+                    *(When(pk=pk, then=F('reserved_stock') + delta) for pk, delta in changed.items()),
+                    output_field=models.PositiveIntegerField(),
+                ),
+                updated_at=now,
+            )
+
+        expires_at = now + cls.ttl()
+        created, updated, deleted = [], [], []
+        for pk in products:
+            reservation = reservations.get(pk)
+            if quantities[pk] <= 0:
+                if reservation:
+                    deleted.append(reservation.pk)
+            elif reservation:
+                reservation.quantity = quantities[pk]
+                reservation.expires_at = expires_at
+                reservation.updated_at = now
+                updated.append(reservation)
+            else:
+                created.append(cls(cart=cart, product_id=pk, quantity=quantities[pk], expires_at=expires_at))
+        if deleted:
+            cls.objects.filter(pk__in=deleted).delete()
+        if updated:
+            cls.objects.bulk_update(updated, ['quantity', 'expires_at', 'updated_at'])
+        if created:
+            cls.objects.bulk_create(created)
+        return {}
+
+    @classmethod
+    def release(cls, queryset):
+        """Delete the given reservations and hand their units back to the products."""
+        with transaction.atomic():
+            product_ids = sorted(set(queryset.values_list('product_id', flat=True)))
+            if not product_ids:
+                return 0
+            list(Product.objects.select_for_update().filter(pk__in=product_ids).order_by('pk').values_list('pk'))
+            # reading the holds again under the product locks, checkout may have converted some of them meanwhile
+            totals = {}
+            ids = []
+            for pk, product_id, quantity in queryset.select_for_update().values_list('pk', 'product_id', 'quantity'):
+                totals[product_id] = totals.get(product_id, 0) + quantity
+                ids.append(pk)
+            if totals:
+                Product.objects.filter(pk__in=totals).update(
+                    reserved_stock=Case(
+                        *(When(pk=product_id, then=F('reserved_stock') - quantity) for product_id, quantity in totals.items()),
+                        output_field=models.PositiveIntegerField(),
+                    ),
+                    updated_at=timezone.now(),
+                )
+            cls.objects.filter(pk__in=ids).delete()
+            return len(ids)
+
+    @classmethod
+    def release_expired(cls, batch_size=1000):
+        """Release every expired hold in batches, returns how many were released."""
+        released = 0
+        while True:
+            ids = list(
+                cls.objects.filter(expires_at__lte=timezone.now())
+                .order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if not ids:
+                return released
+            released += cls.release(cls.objects.filter(pk__in=ids, expires_at__lte=timezone.now()))
+
+
+
+class IdempotencyKey(models.Model):
+    """
+    The response of an order-creating request sent with an Idempotency-Key header.
+
+    A retry with the same key gets the stored response instead of placing the
+    order again, see store.idempotency. Keys are kept for IDEMPOTENCY_KEY_TTL.
+    """
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=255)
+    # sha256 of the method, path and body, a key can't be reused for another request
+    fingerprint = models.CharField(max_length=64)
+    # both empty while the first request is still running
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.JSONField(null=True)
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('user', 'key')
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.key} of {self.user_id} ({self.status_code or 'running'})"
+
+    @staticmethod
+    def ttl():
+        return getattr(settings, 'IDEMPOTENCY_KEY_TTL', timedelta(hours=24))
+
+    @staticmethod
+    def lease():
+        return getattr(settings, 'IDEMPOTENCY_KEY_LEASE', timedelta(seconds=60))
+
+    @classmethod
+    def claim(cls, user, key, fingerprint):
+        """
+        (record, claimed) for a request with key.
+
+        claimed is True when this request inserted the key, or took over a claim left
+        running for longer than IDEMPOTENCY_KEY_LEASE, and has to run. Otherwise record
+        is the key of an earlier or concurrent request, or None if that one failed and
+        let go of it meanwhile.
+        """
+        now = timezone.now()
+        cls.objects.filter(user=user, key=key, expires_at__lte=now).delete()
+        try:
+            # committed on its own so a concurrent retry sees the claim straight away
+            with transaction.atomic():
+                return cls.objects.create(user=user, key=key, fingerprint=fingerprint, expires_at=now + cls.ttl()), True
+        except IntegrityError:
+            record = cls.objects.filter(user=user, key=key).first()
+        if (record is None or record.status_code is not None or record.fingerprint != fingerprint
+                or record.created_at > now - cls.lease()):
+            return record, False
+        # the request that claimed the key died before it answered, this retry runs in its place.
+        # Claimed again by moving created_at, so only one of several retries takes it over
+        taken = cls.objects.filter(pk=record.pk, status_code__isnull=True, created_at=record.created_at).update(
+            created_at=now, expires_at=now + cls.ttl())
+        return record, bool(taken)
+
+    @classmethod
+    def delete_expired(cls, batch_size=1000):
+        """Delete every expired key in batches, returns how many were deleted."""
+        deleted = 0
+        while True:
+            ids = list(
+                cls.objects.filter(expires_at__lte=timezone.now())
+                .order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if not ids:
+                return deleted
+            deleted += cls.objects.filter(pk__in=ids).delete()[0]
+
+
+class SalesRollup(models.Model):
+    """
+    Orders, units and revenue of one day, so sales dashboards never scan the orders.
+
+    Rows are kept up to date by add() as orders are placed and cancelled, and can be
+    rebuilt from the orders with the rebuild_sales_rollups command. Revenue is the
+    sum of the items, shipping excluded.
+    """
+    # the foreign key the rows are split by, None for one row per day
+    key = None
+
+    day = models.DateField()
+    orders = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def add(cls, day, totals, sign=1):
+        """
+        Add {key id: (orders, units, revenue)} to the rows of day, or take it away with sign=-1.
+
+        DailySales has no key, its totals come as {None: (orders, units, revenue)}.
+        """
+        lookups = {key: {f'{cls.key}_id': key} if cls.key else {} for key in totals}
+        with transaction.atomic():
+            # the rows are created empty first, concurrent orders of the same day then only increment them
+            cls.objects.bulk_create([cls(day=day, **lookup) for lookup in lookups.values()], ignore_conflicts=True)
+            for key, (orders, units, revenue) in totals.items():
+                cls.objects.filter(day=day, **lookups[key]).update(
+                    orders=F('orders') + sign * orders,
+                    units=F('units') + sign * units,
+                    revenue=F('revenue') + sign * revenue,
+                )
+
+
+class DailySales(SalesRollup):
+    class Meta:
+        unique_together = ('day',)
+
+    def __str__(self):
+        return f"{self.day}: {self.orders} orders, {self.revenue}"
+
+
+class DailyCategorySales(SalesRollup):
+    key = 'category'
+
+    category = models.ForeignKey(
+        Category, on_delete=models.CASCADE, related_name='daily_sales')
+
+    class Meta:
+        unique_together = ('day', 'category')
+
+    def __str__(self):
+        return f"{self.day} {self.category_id}: {self.units} units, {self.revenue}"
+
+
+class DailyProductSales(SalesRollup):
+    key = 'product'
+
+    product = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name='daily_sales')
+
+    class Meta:
+        unique_together = ('day', 'product')
+
+    def __str__(self):
+        return f"{self.day} {self.product_id}: {self.units} units, {self.revenue}"
@@ -0,0 +1,59 @@
+"""
+JSON rendering and parsing with orjson.
+
+ORJSONRenderer and ORJSONParser are drop-in replacements for DRF's JSONRenderer
+and JSONParser, enabled with FAST_JSON (see REST_FRAMEWORK in settings). The
+bytes they produce are the ones DRF's renderer produces: datetimes end in Z,
+Decimals that aren't already strings become floats, UUIDs become strings and
+anything else orjson doesn't know goes through DRF's own encoder. Indented output
+is handed to DRF's implementation so its spacing stays DRF's, and so is what
+orjson can't do (non-compact or ASCII-only output, integers over 64 bits).
+
+One difference remains: orjson writes NaN and Infinity as null where DRF's
+strict renderer raises.
+"""
+import orjson  # type: ignore
+from django.conf import settings  # type: ignore
+from rest_framework.exceptions import ParseError  # type: ignore
+from rest_framework.parsers import JSONParser  # type: ignore
+from rest_framework.renderers import JSONRenderer  # type: ignore
+from rest_framework.utils.encoders import JSONEncoder  # type: ignore
+
+OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+# Decimal, lazy translations, querysets and the rest, the way DRF's encoder turns them into JSON types
+default = JSONEncoder().default
+
+
+class ORJSONRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if indent is not None or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            content = orjson.dumps(data, default=default, option=OPTIONS)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # escaped like DRF does, so the output stays a strict JavaScript subset
+        if b'\xe2\x80\xa8' in content or b'\xe2\x80\xa9' in content:
+            content = content.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return content
+
+
+class ORJSONParser(JSONParser):
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        # only DRF's parser accepts NaN and Infinity
+        if not self.strict:
+            return super().parse(stream, media_type, parser_context)
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        try:
+            body = stream.read()
+            if encoding.lower().replace('_', '-') not in ('utf-8', 'utf8'):
+                body = body.decode(encoding)
+            return orjson.loads(body)
+        except ValueError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
@@ -0,0 +1,42 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank  # type: ignore
+from django.db import connection  # type: ignore
+from django.db.models import Case, F, FloatField, Q, Value, When  # type: ignore
+from functools import reduce
+from operator import add, and_, or_
+from rest_framework import filters  # type: ignore
+
+SEARCH_CONFIG = 'english'
+
+
+class ProductSearchFilter(filters.SearchFilter):
+    """
+    Ranked full-text search over the product search_vector on PostgreSQL.
+
+    Other databases have no tsvector, there every term has to appear in one of the
+    view's search_fields and matches on the first field rank higher, like the A/B
+    weights of the vector.
+    Results are ordered by rank unless the client asks for an ordering.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+
+        if connection.vendor == 'postgresql':
+            query = SearchQuery(' '.join(terms), search_type='websearch', config=SEARCH_CONFIG)
+            queryset = queryset.filter(search_vector=query).annotate(
+                search_rank=SearchRank(F('search_vector'), query))
+        else:
+            fields = self.get_search_fields(view, request)
+            queryset = queryset.filter(reduce(and_, (
+                reduce(or_, (Q(**{f'{field}__icontains': term}) for field in fields)) for term in terms
+            ))).annotate(search_rank=reduce(add, (
+                Case(When(**{f'{fields[0]}__icontains': term}, then=Value(1.0)), default=Value(0.4), output_field=FloatField())
+                for term in terms
+            )))
+
+        ordering_param = filters.OrderingFilter.ordering_param
+        if request.query_params.get(ordering_param):
+            return queryset
+        return queryset.order_by('-search_rank', *queryset.query.order_by)
@@ -1,12 +1,89 @@
 from rest_framework import serializers #type: ignore
 from decimal import Decimal
+from functools import reduce
+from operator import or_
+from django.core.exceptions import FieldDoesNotExist # type: ignore
+from django.db import transaction # type: ignore
+from django.db.models import Case, F, PositiveIntegerField, Prefetch, Q, When, prefetch_related_objects # type: ignore
+from django.utils import timezone # type: ignore
+from shopify_api.metrics import timed_serialization
+from .cache import get_categories
+from .images import srcset
+from .tasks import order_placed
 from .models import (
     User, Category, Product, ProductImage, 
-    Address, Order, OrderItem, Cart, CartItem, Review
+    Address, Order, OrderItem, Cart, CartItem, Review, StockReservation
 )
-from django.db.models import Avg # type: ignore
 
-class UserSerializer(serializers.ModelSerializer):
+def cached_categories(field):
+    # fetched from the cache once per response, not once per object
+    root = field.root
+    if not hasattr(root, '_cached_categories'):
+        root._cached_categories = get_categories()
+    return root._cached_categories
+
+class DynamicFieldsMixin:
+    """
+    ?fields= and ?expand= for a serializer's output.
+
+    fields (a keyword argument, set by views.FieldsMixin from ?fields=id,name) keeps only
+    those fields of the top level objects, nested serializers are never pruned. Names in
+    the context's expand swap a field listed in expandable_fields for its full serializer,
+    at any depth. Only the output changes, writes still see every field.
+    """
+    # field name: serializer shown instead with ?expand=name
+    expandable_fields = {}
+    # model columns read by fields that aren't a column of the same name
+    field_columns = {}
+    
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requested_fields = set(fields) if fields else None
+        self.expanded = {}
+    
+    @property
+    def _readable_fields(self):
+        expand = self.context.get('expand', ())
+        for field in super()._readable_fields:
+            name = field.field_name
+            if self.requested_fields is not None and name not in self.requested_fields:
+                continue
+            if name in expand and name in self.expandable_fields:
+                if name not in self.expanded:
+                    self.expanded[name] = self.expandable_fields[name](read_only=True)
+                    self.expanded[name].bind(field_name=name, parent=self)
+                field = self.expanded[name]
+            yield field
+    
+    def to_representation(self, instance):
+        # reported as the request's serialize timing, a view builds serializer.data before the response renders
+        with timed_serialization():
+            return super().to_representation(instance)
+    
+    @classmethod
+    def deferrable_columns(cls, fields):
+        """The plain model columns that none of fields reads, empty when a field's columns aren't known."""
+        model = cls.Meta.model
+        declared = cls().fields
+        needed = set()
+        for name in fields:
+            if name in cls.field_columns:
+                needed.update(cls.field_columns[name])
+                continue
+            if name not in declared:
+                continue
+            source = declared[name].source.split('.')[0]
+            try:
+                needed.add(model._meta.get_field(source).name)
+            except FieldDoesNotExist:
+                # a method or a property, it could read any column
+                return set()
+        return {
+            field.name for field in model._meta.concrete_fields
+            if not field.is_relation and not field.primary_key and field.name not in needed
+        }
+
+class UserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id','username','email', 'first_name', 'last_name')
@@ -29,8 +106,9 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         user = User.objects.create_user(**validated_data)
         return user
     
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     product_total = serializers.SerializerMethodField()
+    field_columns = {'product_total': ()}
     
     class Meta:
         model = Category
@@ -38,17 +116,31 @@ class CategorySerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'created_at', 'updated_at')
     
     def get_product_total(self, obj):
+        # annotated when the category cache is built, read from the cache otherwise
+        product_total = getattr(obj, 'product_total', None)
+        if product_total is not None:
+            return product_total
+        cached = cached_categories(self).get(obj.pk)
+        if cached is not None:
+            return cached['product_total']
         return obj.products.filter(is_available=True).count()
     
-class ProductImageSerializer(serializers.ModelSerializer):
+class ProductImageSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     image = serializers.ImageField(use_url=True)
+    # resized copies per format, ready for <source srcset>, empty until the background task made them
+    srcset = serializers.SerializerMethodField()
+    field_columns = {'srcset': ('image', 'renditions')}
+    
     class Meta:
         model = ProductImage
-        fields = ('id', 'image', 'alt_text', 'created_at')
+        fields = ('id', 'image', 'srcset', 'alt_text', 'created_at')
         read_only_fields = ('id','created_at')
+    
+    def get_srcset(self, obj):
+        return srcset(obj, self.context.get('request'))
 
-class ProductSerializer(serializers.ModelSerializer):
-    category = CategorySerializer(read_only = True)
+class ProductSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    category = serializers.SerializerMethodField()
     category_id = serializers.PrimaryKeyRelatedField(
         queryset=Category.objects.all(), 
         source='category', 
@@ -56,25 +148,37 @@ class ProductSerializer(serializers.ModelSerializer):
     )
     images = ProductImageSerializer(many=True, read_only=True)
     average_rating = serializers.SerializerMethodField()
-    review_count = serializers.SerializerMethodField()
+    review_count = serializers.IntegerField(source='rating_count', read_only=True)
+    rating_histogram = serializers.ReadOnlyField()
+    
+    field_columns = {
+        'category': (),
+        'available_stock': ('stock', 'reserved_stock'),
+        'is_in_stock': ('stock',),
+        'average_rating': ('rating_sum', 'rating_count'),
+        'rating_histogram': tuple(f'rating_{star}_count' for star in range(1, 6)),
+    }
     
     class Meta:
         model = Product
         fields = (
-            'id', 'name', 'description', 'price', 'stock', 
+            'id', 'name', 'description', 'price', 'stock', 'available_stock',
             'is_available', 'is_in_stock', 'category', 'category_id',
-            'images', 'average_rating', 'review_count',
+            'images', 'average_rating', 'review_count', 'rating_histogram',
             'created_at', 'updated_at'
         )
         read_only_fields = ('id', 'created_at', 'updated_at')
     
-    #below is the function to calculate the average of all reviews, or return 0 if there are none
-    def get_average_rating(self, obj):
-        result = obj.reviews.aggregate(Avg('rating'))
-        return result['rating__avg'] or 0
+    #the nested category is the cached CategorySerializer output
+    def get_category(self, obj):
+        category = cached_categories(self).get(obj.category_id)
+        if category is None:
+            return CategorySerializer(obj.category, context=self.context).data
+        return category
     
-    def get_review_count(self, obj):
-        return obj.reviews.count()
+    #below is the function to return the average of all reviews from the stored totals, or 0 if there are none
+    def get_average_rating(self, obj):
+        return obj.average_rating
     
     def validate_price(self, value):
         if value <= 0:
@@ -85,8 +189,40 @@ class ProductSerializer(serializers.ModelSerializer):
         if value < 0:
             raise serializers.ValidationError('Stock can not be negative')
         return value
+    
+    #only the edited columns are written, holds and review totals change under the edit through F() updates
+    def update(self, instance, validated_data):
+        for field, value in validated_data.items():
+            setattr(instance, field, value)
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        return instance
+        
+class ProductImportSerializer(ProductSerializer):
+    """
+    The ProductSerializer rules for one imported row, without a query per row:
+    import_products resolves the category by name and checks that descriptions
+    are unique once per batch.
+    """
+    category_id = serializers.IntegerField(write_only=True)
+    
+    class Meta(ProductSerializer.Meta):
+        fields = ('name', 'description', 'price', 'stock', 'is_available', 'category_id')
+        extra_kwargs = {'description': {'validators': []}}
         
-class AddressSerializer(serializers.ModelSerializer):
+class ProductBulkUpdateSerializer(ProductSerializer):
+    """One row of products/bulk_update/, the ProductSerializer rules for the fields it may change."""
+    id = serializers.IntegerField()
+    
+    class Meta(ProductSerializer.Meta):
+        fields = ('id', 'price', 'stock', 'is_available')
+        extra_kwargs = {'price': {'required': False}, 'stock': {'required': False}, 'is_available': {'required': False}}
+    
+    def validate(self, data):
+        if len(data) == 1:
+            raise serializers.ValidationError('Give at least one of price, stock or is_available.')
+        return data
+        
+class AddressSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Address
         fields = (
@@ -95,10 +231,11 @@ class AddressSerializer(serializers.ModelSerializer):
         )
         read_only_fields = ('id', 'created_at', 'updated_at')
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     product_name = serializers.CharField(source='product.name', read_only = True)
     # subtotal = serializers.ReadOnlyField()
     productimage = ProductImageSerializer(read_only=True)
+    expandable_fields = {'product': ProductSerializer}
     
     class Meta:
         model = OrderItem
@@ -110,9 +247,19 @@ class OrderItemSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError('Quantity must be more than 0')
         return value
         
-class OrderSerializer(serializers.ModelSerializer):
+class OrderLineSerializer(serializers.Serializer):
+    # products are plain ids here, create looks them all up with the one query that locks them
+    product = serializers.IntegerField()
+    quantity = serializers.IntegerField()
+    
+    def validate_quantity(self, value):
+        if value <= 0:
+            raise serializers.ValidationError('Quantity must be more than 0')
+        return value
+        
+class OrderSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
-    items_data = OrderItemSerializer(many=True,write_only= True, source ='items')
+    items_data = OrderLineSerializer(many=True,write_only= True, source ='items')
     shipping_address = AddressSerializer(read_only=True)
     billing_address = AddressSerializer(read_only=True)
     shipping_address_id = serializers.PrimaryKeyRelatedField(
@@ -130,6 +277,7 @@ class OrderSerializer(serializers.ModelSerializer):
     )
     user_info = UserSerializer(source='user',read_only=True)
     item_count = serializers.SerializerMethodField(read_only=True)
+    field_columns = {'item_count': ()}
     
     class Meta:
         model = Order
@@ -143,6 +291,9 @@ class OrderSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'order_number', 'subtotal', 'total', 'created_at', 'updated_at', 'user_info')
     
     def get_item_count(self, obj):
+        # annotated by OrderViewSet, counted for an order that was just created
+        if hasattr(obj, 'item_count'):
+            return obj.item_count
         return obj.items.count()
     
     def validate_items_data(self, value):
@@ -150,25 +301,84 @@ class OrderSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError('Order must include at least one item')
         return value
     
+    def validate(self, data):
+        # an existing order only moves along Order.TRANSITIONS
+        if self.instance is not None:
+            errors = {}
+            for field in Order.TRANSITIONS:
+                current, target = getattr(self.instance, field), data.get(field)
+                if target is None or target == current:
+                    continue
+                if target == 'cancelled':
+                    errors[field] = 'Use the cancel endpoint to cancel an order.'
+                elif not Order.can_transition(field, current, target):
+                    errors[field] = f'An order can not go from {current} to {target}.'
+            if errors:
+                raise serializers.ValidationError(errors)
+        return data
+    
+    @transaction.atomic
     def create(self, validated_data):
         items_data = validated_data.pop('items')
         user = self.context['request'].user
         
-        #below i'm calculating the subtotal
-        subtotal = Decimal('0.00')
+        #merging repeated lines for the same product, an order holds each product once
+        quantities = {}
         for item in items_data:
-            product = item['product']
-            quantity = item['quantity']
-            
+            quantities[item['product']] = quantities.get(item['product'], 0) + item['quantity']
+        
+        #locking every product in one query, always in id order so concurrent checkouts can't deadlock
+        products = list(
+            Product.objects.select_for_update()
+            .filter(pk__in=quantities)
+            .order_by('pk')
+        )
+        missing = sorted(set(quantities) - {product.pk for product in products})
+        if missing:
+            raise serializers.ValidationError(
+                {'items_data': [f'Invalid pk "{pk}" - object does not exist.' for pk in missing]})
+        
+        #units the cart already holds are converted into the order, everything else must come from unreserved stock
+        held = {}
+        cart = self.context.get('cart')
+        if cart is not None:
+            reservations = StockReservation.objects.select_for_update().filter(cart=cart, product_id__in=quantities)
+            held = dict(reservations.values_list('product_id', 'quantity'))
+        
+        #below i'm calculating the subtotal from the locked rows
+        subtotal = Decimal('0.00')
+        for product in products:
+            quantity = quantities[product.pk]
+            available = product.stock - product.reserved_stock + held.get(product.pk, 0)
             
             #checking if stock quantity ordered is available
-            if product.stock < quantity:
+            if available < quantity:
                 raise serializers.ValidationError(
-                    f"Insufficient stock for {product.name}, Available: {product.stock}"
+                    f"Insufficient stock for {product.name}, Available: {max(available, 0)}"
                 )
                 
             subtotal = subtotal + (product.price * quantity)
         
+        #updating the stock of every product in a single statement, only rows that still have enough stock are touched
+        updated = Product.objects.filter(reduce(or_, (
+            Q(pk=pk, stock__gte=F('reserved_stock') - held.get(pk, 0) + quantity)
+            for pk, quantity in quantities.items()
+        ))).update(
+            stock=Case(
+                *(When(pk=pk, then=F('stock') - quantity) for pk, quantity in quantities.items()),
+                output_field=PositiveIntegerField(),
+            ),
+            reserved_stock=Case(
+                *(When(pk=pk, then=F('reserved_stock') - held.get(pk, 0)) for pk in quantities),
+                output_field=PositiveIntegerField(),
+            ),
+            updated_at=timezone.now(),
+        )
+        if updated != len(quantities):
+            raise serializers.ValidationError('Stock changed while placing the order, please try again.')
+        if held:
+            reservations.delete()
+        
         #calculating total price
         shipping_cost = validated_data.get('shipping_cost', Decimal('0.00'))
         total = subtotal + shipping_cost
@@ -187,33 +397,52 @@ class OrderSerializer(serializers.ModelSerializer):
             **validated_data
         )
         
-        #creating the order items and updating stock
-        for item in items_data:
-            product = item['product']
-            quantity = item['quantity']
-                     
-            primary_image = product.images.first()   
-            
-            OrderItem.objects.create(
+        #creating all the order items at once, their images are snapshotted by a task after the commit
+        OrderItem.objects.bulk_create([
+            OrderItem(
                 order=order,
                 product=product,
-                quantity=quantity,
+                quantity=quantities[product.pk],
                 price=product.price,
-                productimage=primary_image
             )
-            
-            product.stock = product.stock - quantity
-            product.save(update_fields=['stock'])
+            for product in products
+        ])
+        #the response shows the items, loaded once with what they show
+        prefetch_related_objects([order], Prefetch(
+            'items', queryset=OrderItem.objects.select_related('product', 'productimage').order_by('id')))
+        order_placed(order)
         return order
     
-class CartItemSerializer(serializers.ModelSerializer):
-    product = ProductSerializer(read_only=True)
+class OrderBulkTransitionSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=5000)
+    order_status = serializers.ChoiceField(choices=Order.ORDER_STATUS, required=False)
+    payment_status = serializers.ChoiceField(choices=Order.PAYMENT_STATUS, required=False)
+    
+    def validate(self, data):
+        fields = [field for field in Order.TRANSITIONS if field in data]
+        if len(fields) != 1:
+            raise serializers.ValidationError('Give exactly one of order_status or payment_status.')
+        data['field'] = fields[0]
+        data['target'] = data.pop(fields[0])
+        return data
+    
+class CartProductSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    # just what a cart line shows, ?expand=product swaps in the full ProductSerializer
+    class Meta:
+        model = Product
+        fields = ('id', 'name', 'price', 'is_available', 'available_stock')
+        read_only_fields = fields
+
+class CartItemSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    product = CartProductSerializer(read_only=True)
     product_id = serializers.PrimaryKeyRelatedField(
         queryset=Product.objects.all(),
         source='product',
         write_only=True
     )
     subtotal = serializers.ReadOnlyField()
+    expandable_fields = {'product': ProductSerializer}
+    field_columns = {'subtotal': ('quantity',)}
     
     class Meta:
         model = CartItem
@@ -232,26 +461,77 @@ class CartItemSerializer(serializers.ModelSerializer):
         if product and quantity:
             if not product.is_available:
                 raise serializers.ValidationError("This product is not available.")
-            if product.stock < quantity:
+            if product.available_stock < quantity:
                 raise serializers.ValidationError(
-                    f"Insufficient stock. Available: {product.stock}"
+                    f"Insufficient stock. Available: {product.available_stock}"
                 )
         
         return data 
    
-class CartSerializer(serializers.ModelSerializer):
+class CartAddItemSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1, default=1)
+
+class CartUpdateItemSerializer(serializers.Serializer):
+    item_id = serializers.IntegerField()
+    #zero or less removes the item
+    quantity = serializers.IntegerField()
+
+class CartOperationSerializer(serializers.Serializer):
+    OPS = ('add', 'update', 'remove')
+    op = serializers.ChoiceField(choices=OPS)
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=0, required=False)
+    
+    def validate(self, data):
+        if data['op'] == 'update' and 'quantity' not in data:
+            raise serializers.ValidationError('update needs a quantity.')
+        if data['op'] == 'add' and data.get('quantity', 1) <= 0:
+            raise serializers.ValidationError('Quantity must be greater than zero.')
+        return data
+
+class CartBatchSerializer(serializers.Serializer):
+    operations = CartOperationSerializer(many=True, allow_empty=False, max_length=100)
+    
+    def get_quantities(self, current):
+        """Replays the operations over {product id: quantity} of the cart, returns the final quantities."""
+        quantities = dict(current)
+        for operation in self.validated_data['operations']:
+            product_id = operation['product_id']
+            if operation['op'] == 'add':
+                quantities[product_id] = quantities.get(product_id, 0) + operation.get('quantity', 1)
+            elif operation['op'] == 'update':
+                quantities[product_id] = operation['quantity']
+            else:
+                quantities[product_id] = 0
+        return quantities
+
+class CartSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     items = CartItemSerializer(many=True, read_only=True)
-    total_items = serializers.ReadOnlyField()
-    total_price = serializers.ReadOnlyField()
+    total_items = serializers.SerializerMethodField()
+    total_price = serializers.SerializerMethodField()
+    field_columns = {'total_items': (), 'total_price': ()}
     
     class Meta:
         model = Cart
         fields = ('id', 'items', 'total_items', 'total_price', 'created_at', 'updated_at')
         read_only_fields = ('id', 'created_at', 'updated_at')
+    
+    #CartViewSet annotates the totals in SQL, the model properties are the fallback
+    def get_total_items(self, obj):
+        if hasattr(obj, 'items_quantity'):
+            return obj.items_quantity
+        return obj.total_items
+    
+    def get_total_price(self, obj):
+        if hasattr(obj, 'items_price'):
+            return obj.items_price
+        return obj.total_price
         
-class ReviewSerializer(serializers.ModelSerializer):
+class ReviewSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     user_info = UserSerializer(source='user', read_only=True)
     product_name = serializers.CharField(source= 'product.name', read_only = True)
+    expandable_fields = {'product': ProductSerializer}
     
     class Meta:
         model = Review
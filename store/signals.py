@@ -0,0 +1,33 @@
+from django.db import transaction  # type: ignore
+from django.db.models.signals import post_delete, post_save, pre_delete  # type: ignore
+from django.dispatch import receiver  # type: ignore
+from django.utils import timezone  # type: ignore
+from shopify_api.celery import enqueue
+from .cache import invalidate_categories
+from .models import Cart, Category, Product, ProductImage, StockReservation
+from .tasks import generate_image_renditions
+
+
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_category_cache(sender, **kwargs):
+    invalidate_categories()
+
+
+@receiver([post_save, post_delete], sender=ProductImage)
+def touch_product(sender, instance, **kwargs):
+    # images are part of the product payload, so they count as a change to the product
+    Product.objects.filter(pk=instance.product_id).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=ProductImage)
+def queue_renditions(sender, instance, **kwargs):
+    # new and replaced uploads are resized by a background task once they are committed
+    if instance.image and instance.renditions.get('source') != instance.image.name:
+        transaction.on_commit(lambda: enqueue(generate_image_renditions, instance.pk))
+
+
+@receiver(pre_delete, sender=Cart)
+def release_cart_holds(sender, instance, **kwargs):
+    # the holds would go with the cart through the cascade and keep their units reserved for good
+    StockReservation.release(instance.reservations.all())
@@ -0,0 +1,98 @@
+"""
+Work that follows an order or an upload but doesn't have to hold up the response.
+
+order_placed and orders_cancelled queue the tasks once the order's transaction
+commits, so a worker never sees a change that was rolled back, new uploads are
+queued the same way by a ProductImage save signal. Without a broker the tasks run on
+background threads of the web process, see shopify_api.celery.enqueue.
+"""
+from celery import shared_task  # type: ignore
+from django.core.mail import send_mail  # type: ignore
+from django.db import transaction  # type: ignore
+from django.template.loader import render_to_string  # type: ignore
+from django.utils import timezone  # type: ignore
+from PIL import UnidentifiedImageError  # type: ignore
+from shopify_api.celery import enqueue
+from .analytics import record_sales
+from .images import generate_renditions
+from .models import Order, OrderItem, Product, ProductImage
+
+
+def order_placed(order):
+    """Queue the follow-up work of a new order, called inside the transaction that created it."""
+    order_id = order.pk
+
+    def queue_tasks():
+        enqueue(snapshot_order_images, order_id)
+        enqueue(send_order_confirmation, order_id)
+        enqueue(record_order, order_id)
+    transaction.on_commit(queue_tasks)
+
+
+def orders_cancelled(order_ids):
+    """Queue the work that follows cancellations, called inside the transaction that cancelled the orders."""
+    order_ids = list(order_ids)
+
+    transaction.on_commit(lambda: enqueue(record_cancellations, order_ids))
+
+
+@shared_task
+def snapshot_order_images(order_id):
+    """Point every order item without an image at the first image of its product."""
+    items = list(OrderItem.objects.filter(order_id=order_id, productimage__isnull=True))
+    if not items:
+        return 0
+    first_images = {}
+    for product_id, image_id in (
+        ProductImage.objects.filter(product_id__in={item.product_id for item in items})
+        .order_by('product_id', 'created_at', 'id').values_list('product_id', 'id')
+    ):
+        first_images.setdefault(product_id, image_id)
+    items = [item for item in items if item.product_id in first_images]
+    for item in items:
+        item.productimage_id = first_images[item.product_id]
+    OrderItem.objects.bulk_update(items, ['productimage'])
+    return len(items)
+
+
+# smtp errors are OSErrors, the mail is tried again later
+@shared_task(autoretry_for=(OSError,), retry_backoff=True, max_retries=5)
+def send_order_confirmation(order_id):
+    order = Order.objects.select_related('user', 'shipping_address').get(pk=order_id)
+    if not order.user.email:
+        return False
+    body = render_to_string('store/order_confirmation.txt', {
+        'order': order,
+        'items': order.items.select_related('product').order_by('id'),
+    })
+    send_mail(f'Order {order.order_number} confirmed', body, None, [order.user.email])
+    return True
+
+
+@shared_task
+def record_order(order_id):
+    """Add the order to the sales rollups of the day it was placed."""
+    return record_sales(order_id)
+
+
+@shared_task
+def record_cancellations(order_ids):
+    """Take cancelled orders back out of the sales rollups."""
+    return sum(record_sales(order_id, sign=-1) for order_id in order_ids)
+
+
+@shared_task
+def generate_image_renditions(image_id):
+    """Resize an uploaded product image into every configured width and format."""
+    image = ProductImage.objects.filter(pk=image_id).first()
+    if image is None or not image.image:
+        return False
+    try:
+        renditions = generate_renditions(image)
+    except (FileNotFoundError, UnidentifiedImageError):
+        # nothing usable to resize, the original keeps being served alone
+        return False
+    # a direct update so the save signals don't queue the task again, skipped if the upload was replaced meanwhile
+    updated = ProductImage.objects.filter(pk=image_id, image=image.image.name).update(renditions=renditions)
+    Product.objects.filter(pk=image.product_id).update(updated_at=timezone.now())
+    return bool(updated)
@@ -1,3 +1,2053 @@
-from django.test import TestCase #type: ignore
+from django.contrib.auth.hashers import make_password #type: ignore
+from django.core import mail #type: ignore
+from django.core.cache import cache #type: ignore
+from django.core.handlers import base as handlers_base #type: ignore
+from asgiref.testing import ApplicationCommunicator #type: ignore
+from django.core.handlers.asgi import ASGIHandler #type: ignore
+from django.core.management import CommandError, call_command #type: ignore
+from django.db import connection, connections, transaction #type: ignore
+from django.conf import settings #type: ignore
+from django.core.files.uploadedfile import SimpleUploadedFile #type: ignore
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature #type: ignore
+from django.test.utils import CaptureQueriesContext #type: ignore
+from rest_framework.test import APIClient, APIRequestFactory #type: ignore
+from rest_framework.exceptions import ParseError, ValidationError #type: ignore
+from rest_framework.parsers import JSONParser #type: ignore
+from rest_framework.renderers import JSONRenderer #type: ignore
+from rest_framework.test import force_authenticate #type: ignore
+from django.utils.translation import gettext_lazy #type: ignore
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import AsyncMock, Mock, patch
+import csv
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from datetime import date, datetime, time as clock, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from io import BytesIO, StringIO
+from PIL import Image as PILImage #type: ignore
+from django.db.models import F #type: ignore
+from django.utils import timezone #type: ignore
+from .models import User, Category, Product, ProductImage, Address, Order, OrderItem, Cart, CartItem, Review, StockReservation, IdempotencyKey, DailySales, DailyCategorySales, DailyProductSales
+from .renderers import ORJSONParser, ORJSONRenderer
+from .serializers import OrderSerializer, ProductImageSerializer
+from .tasks import generate_image_renditions, record_cancellations, record_order
+from .urls import router
+from .views import ProductViewSet
+from shopify_api.celery import app as celery_app, enqueue
+from shopify_api.metrics import registry
 
-# Create your tests here.
+# outside the tests a broker's workers or the background threads run the tasks, here they run in process
+celery_app.conf.task_always_eager = True
+
+
+class ProductListQueryTests(TestCase):
+    """The product list must cost the same number of queries whatever the page size."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Shoes', description='All shoes')
+        users = [User.objects.create_user(username=f'user{i}', password='password123') for i in range(3)]
+        for i in range(30):
+            product = Product.objects.create(
+                category=cls.category,
+                name=f'Product {i}',
+                description=f'Description {i}',
+                price=Decimal('10.00') + i,
+                stock=5,
+            )
+            ProductImage.objects.create(product=product, image=f'products/{i}.jpg')
+            for rating, user in enumerate(users, start=3):
+                Review.objects.create(product=product, user=user, rating=rating, title='ok', comment='ok')
+        call_command('rebuild_ratings', stdout=StringIO())
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def count_list_queries(self, page_size):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/products/', {'page_size': page_size})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), page_size)
+        return len(queries)
+
+    def test_query_count_is_constant(self):
+        # the ETag aggregate, one COUNT for pagination, one annotated product query and one image prefetch,
+        # categories are cached
+        self.client.get('/api/categories/')
+        self.assertEqual(self.count_list_queries(5), 4)
+        self.assertEqual(self.count_list_queries(30), 4)
+
+    def test_annotated_values(self):
+        response = self.client.get('/api/products/', {'page_size': 1})
+        product = response.data['results'][0]
+        self.assertEqual(product['average_rating'], 4)
+        self.assertEqual(product['review_count'], 3)
+        self.assertEqual(product['category']['product_total'], 30)
+        self.assertEqual(len(product['images']), 1)
+        self.assertEqual(product['rating_histogram'], {1: 0, 2: 0, 3: 1, 4: 1, 5: 1})
+
+
+class ReviewRatingTotalsTests(TestCase):
+    """Writing reviews through the API keeps the stored product totals in step."""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Hats', description='All hats')
+        self.product = Product.objects.create(
+            category=category, name='Cap', description='A cap', price=Decimal('5.00'), stock=3)
+        self.user = User.objects.create_user(username='reviewer', password='password123')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assertTotals(self, rating_sum, rating_count, histogram):
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.rating_sum, rating_sum)
+        self.assertEqual(self.product.rating_count, rating_count)
+        self.assertEqual(self.product.rating_histogram, histogram)
+
+    def test_create_update_delete(self):
+        response = self.client.post('/api/reviews/', {
+            'product': self.product.id, 'rating': 4, 'title': 'Nice', 'comment': 'Fits well'})
+        self.assertEqual(response.status_code, 201)
+        self.assertTotals(4, 1, {1: 0, 2: 0, 3: 0, 4: 1, 5: 0})
+
+        review_id = response.data['id']
+        response = self.client.patch(f'/api/reviews/{review_id}/', {'rating': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertTotals(2, 1, {1: 0, 2: 1, 3: 0, 4: 0, 5: 0})
+
+        response = self.client.delete(f'/api/reviews/{review_id}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertTotals(0, 0, {1: 0, 2: 0, 3: 0, 4: 0, 5: 0})
+
+    def test_rebuild_command(self):
+        Review.objects.create(product=self.product, user=self.user, rating=5, title='a', comment='a')
+        self.assertTotals(0, 0, {1: 0, 2: 0, 3: 0, 4: 0, 5: 0})
+        call_command('rebuild_ratings', stdout=StringIO())
+        self.assertTotals(5, 1, {1: 0, 2: 0, 3: 0, 4: 0, 5: 1})
+        self.assertEqual(self.product.average_rating, 5)
+
+    def test_ordering_by_rating(self):
+        other = Product.objects.create(
+            category=self.product.category, name='Beanie', description='A beanie',
+            price=Decimal('4.00'), stock=3, rating_sum=9, rating_count=2)
+        response = self.client.get('/api/products/', {'ordering': '-rating'})
+        self.assertEqual([p['id'] for p in response.data['results']], [other.id, self.product.id])
+        self.assertEqual(response.data['results'][0]['average_rating'], 4.5)
+
+    def test_editing_the_product_keeps_reviews_posted_meanwhile(self):
+        def review_meanwhile(serializer, value):
+            # a review lands after the edit read the product
+            self.client.post('/api/reviews/', {'product': self.product.id, 'rating': 3, 'title': 'Ok', 'comment': 'Ok'})
+            return value
+        with patch('store.serializers.ProductSerializer.validate_stock', review_meanwhile):
+            response = self.client.patch(f'/api/products/{self.product.pk}/', {'stock': 8}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTotals(3, 1, {1: 0, 2: 0, 3: 1, 4: 0, 5: 0})
+        self.assertEqual(self.product.stock, 8)
+
+
+def create_address(user):
+    return Address.objects.create(
+        user=user, address_type='shipping', phone_number='0800000000', full_address='1 Main Street',
+        city='Lagos', state='Lagos', postal_code='100001', country='Nigeria')
+
+
+class CheckoutTests(TestCase):
+    """Checkout locks, decrements and inserts in bulk whatever the size of the cart."""
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Books', description='All books')
+        self.user = User.objects.create_user(username='buyer', password='password123')
+        self.address = create_address(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def fill_cart(self, lines):
+        cart, _ = Cart.objects.get_or_create(user=self.user)
+        for i in range(lines):
+            product = Product.objects.create(
+                category=self.category, name=f'Book {lines}-{i}', description=f'Book {lines}-{i}',
+                price=Decimal('3.50'), stock=10)
+            ProductImage.objects.create(product=product, image=f'products/book{i}.jpg')
+            CartItem.objects.create(cart=cart, product=product, quantity=2)
+
+    def checkout_queries(self, lines):
+        self.fill_cart(lines)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/cart/checkout/', {'shipping_address_id': self.address.id})
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(len(response.data['items']), lines)
+        return queries
+
+    def test_checkout_creates_order_and_decrements_stock(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.checkout_queries(3)
+        order = Order.objects.get(user=self.user)
+        self.assertEqual(order.subtotal, Decimal('21.00'))
+        self.assertFalse(CartItem.objects.exists())
+        for item in order.items.all():
+            self.assertEqual(item.product.stock, 8)
+            # set by the snapshot task once the order committed
+            self.assertIsNotNone(item.productimage)
+
+    def test_queries_do_not_grow_with_cart(self):
+        small = self.checkout_queries(2)
+        large = self.checkout_queries(12)
+        self.assertEqual(len(small), len(large), [q['sql'] for q in large])
+
+    def test_unknown_products_are_rejected(self):
+        request = APIRequestFactory().post('/api/orders/')
+        request.user = self.user
+        serializer = OrderSerializer(data={
+            'shipping_address_id': self.address.id,
+            'items_data': [{'product': 0, 'quantity': 1}],
+        }, context={'request': request})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        with self.assertRaises(ValidationError) as raised:
+            serializer.save()
+        self.assertIn('items_data', raised.exception.detail)
+        self.assertFalse(Order.objects.exists())
+
+    def test_stale_stock_is_rejected(self):
+        self.fill_cart(1)
+        product = Product.objects.get()
+        request = APIRequestFactory().post('/api/orders/')
+        request.user = self.user
+        serializer = OrderSerializer(data={
+            'shipping_address_id': self.address.id,
+            'items_data': [{'product': product.id, 'quantity': 10}],
+        }, context={'request': request})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        # someone else buys while this request is between validation and save
+        Product.objects.filter(pk=product.pk).update(stock=4)
+        with self.assertRaises(ValidationError):
+            serializer.save()
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 4)
+        self.assertFalse(Order.objects.exists())
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentCheckoutTests(TransactionTestCase):
+    """Many buyers racing for the last units never push stock below zero."""
+
+    buyers = 8
+    stock = 5
+
+    def setUp(self):
+        category = Category.objects.create(name='Games', description='All games')
+        self.product = Product.objects.create(
+            category=category, name='Console', description='A console', price=Decimal('300.00'), stock=self.stock)
+        self.users = [User.objects.create_user(username=f'racer{i}', password='password123') for i in range(self.buyers)]
+        self.addresses = [create_address(user) for user in self.users]
+
+    def place_order(self, index):
+        client = APIClient()
+        client.force_authenticate(self.users[index])
+        try:
+            response = client.post('/api/orders/', {
+                'shipping_address_id': self.addresses[index].id,
+                'items_data': [{'product': self.product.id, 'quantity': 1}],
+            }, format='json')
+            return response.status_code
+        finally:
+            connections.close_all()
+
+    def test_stock_never_goes_negative(self):
+        with ThreadPoolExecutor(max_workers=self.buyers) as pool:
+            statuses = list(pool.map(self.place_order, range(self.buyers)))
+        self.product.refresh_from_db()
+        self.assertEqual(statuses.count(201), self.stock)
+        self.assertEqual(self.product.stock, 0)
+        self.assertEqual(Order.objects.count(), self.stock)
+
+
+class StockReservationTests(TestCase):
+    """Adding to a cart holds stock until checkout, removal or expiry."""
+
+    def setUp(self):
+        category = Category.objects.create(name='Phones', description='All phones')
+        self.product = Product.objects.create(
+            category=category, name='Phone', description='A phone', price=Decimal('99.00'), stock=5)
+        self.user = User.objects.create_user(username='holder', password='password123')
+        self.other = User.objects.create_user(username='latecomer', password='password123')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add(self, user, quantity):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post('/api/cart/add_item/', {'product_id': self.product.id, 'quantity': quantity}, format='json')
+
+    def assertHeld(self, reserved_stock, stock=5):
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.reserved_stock, reserved_stock)
+        self.assertEqual(self.product.stock, stock)
+
+    def test_hold_blocks_other_carts(self):
+        self.assertEqual(self.add(self.user, 2).status_code, 200)
+        self.assertEqual(self.add(self.user, 2).status_code, 200)
+        self.assertHeld(4)
+        self.assertEqual(StockReservation.objects.get().quantity, 4)
+        response = self.add(self.other, 2)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Insufficient stock. Available: 1')
+
+    def test_deleting_the_cart_or_user_releases_the_hold(self):
+        self.add(self.user, 2)
+        self.add(self.other, 1)
+        self.assertHeld(3)
+        Cart.objects.get(user=self.other).delete()
+        self.assertHeld(2)
+        self.user.delete()
+        self.assertHeld(0)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_quantities_are_validated(self):
+        self.assertEqual(self.add(self.user, '2').status_code, 200)
+        self.assertHeld(2)
+        for quantity in ('two', 0, -1, None):
+            response = self.add(self.user, quantity)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('quantity', response.data)
+        item_id = CartItem.objects.get().id
+        response = self.client.patch('/api/cart/update_item/', {'item_id': item_id, 'quantity': 'three'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertHeld(2)
+
+    def test_update_and_remove_move_the_hold(self):
+        self.add(self.user, 2)
+        item_id = CartItem.objects.get().id
+        self.assertEqual(self.client.patch('/api/cart/update_item/', {'item_id': item_id, 'quantity': 5}, format='json').status_code, 200)
+        self.assertHeld(5)
+        self.assertEqual(self.client.patch('/api/cart/update_item/', {'item_id': item_id, 'quantity': 6}, format='json').status_code, 400)
+        self.assertHeld(5)
+        self.assertEqual(self.client.delete('/api/cart/remove_item/', {'item_id': item_id}, format='json').status_code, 200)
+        self.assertHeld(0)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_checkout_converts_the_hold(self):
+        self.add(self.user, 3)
+        self.add(self.other, 2)
+        address = create_address(self.user)
+        response = self.client.post('/api/cart/checkout/', {'shipping_address_id': address.id})
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertHeld(2, stock=2)
+        self.assertFalse(StockReservation.objects.filter(cart__user=self.user).exists())
+
+    def test_expired_holds_are_released(self):
+        self.add(self.user, 3)
+        self.add(self.other, 1)
+        StockReservation.objects.filter(cart__user=self.user).update(expires_at=timezone.now() - timedelta(seconds=1))
+        call_command('release_expired_reservations', stdout=StringIO())
+        self.assertHeld(1)
+        self.assertEqual(StockReservation.objects.get().cart.user, self.other)
+
+    def test_editing_the_product_keeps_holds_placed_meanwhile(self):
+        def hold_meanwhile(serializer, value):
+            # another shopper's hold lands after the edit read the product
+            self.add(self.other, 2)
+            return value
+        with patch('store.serializers.ProductSerializer.validate_price', hold_meanwhile):
+            response = self.client.patch(f'/api/products/{self.product.pk}/', {'price': '89.00'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertHeld(2)
+        self.assertEqual(self.product.price, Decimal('89.00'))
+
+
+class StockReservationContentionTests(TestCase):
+    """More shoppers than units: the losers are turned away at the cart, never at checkout."""
+
+    shoppers = 12
+    stock = 5
+
+    def setUp(self):
+        category = Category.objects.create(name='Drops', description='Limited drops')
+        self.product = Product.objects.create(
+            category=category, name='Sneaker', description='A limited sneaker', price=Decimal('150.00'), stock=self.stock)
+        self.shoppers = []
+        for i in range(self.__class__.shoppers):
+            user = User.objects.create_user(username=f'shopper{i}', password='password123')
+            client = APIClient()
+            client.force_authenticate(user)
+            self.shoppers.append((client, create_address(user)))
+
+    def test_flash_sale(self):
+        carted = [
+            (client, address) for client, address in self.shoppers
+            if client.post('/api/cart/add_item/', {'product_id': self.product.id, 'quantity': 1}, format='json').status_code == 200
+        ]
+        self.assertEqual(len(carted), self.stock)
+
+        statuses, query_counts = [], []
+        for client, address in carted:
+            with CaptureQueriesContext(connection) as queries:
+                statuses.append(client.post('/api/cart/checkout/', {'shipping_address_id': address.id}).status_code)
+            query_counts.append(len(queries))
+
+        # every shopper who got a hold checks out, at the same cost
+        self.assertEqual(statuses, [201] * self.stock)
+        self.assertEqual(len(set(query_counts)), 1)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.reserved_stock), (0, 0))
+
+
+@override_settings(REQUEST_METRICS_ENABLED=True)
+class RequestMetricsTests(TestCase):
+    """Every view reports its cost in Server-Timing and in the staff-only metrics endpoint."""
+
+    def setUp(self):
+        registry.reset()
+        self.staff = User.objects.create_user(username='staff', password='password123', is_staff=True)
+        self.client = APIClient()
+
+    def test_server_timing_and_histograms(self):
+        response = self.client.get('/api/categories/')
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('total;dur=', response['Server-Timing'])
+        Category.objects.create(name='Lamps', description='Lamps')
+        serialize = self.client.get('/api/categories/')['Server-Timing'].split(', ')[1]
+        self.assertTrue(serialize.startswith('serialize;dur='))
+        self.assertGreater(float(serialize.split('=')[1]), 0)
+
+        self.client.force_authenticate(self.staff)
+        body = self.client.get('/api/_metrics/').content.decode()
+        self.assertIn('http_view_queries_count{view="category-list",method="GET"} 2', body)
+        self.assertIn('http_view_render_duration_seconds_bucket{view="category-list",method="GET",le="+Inf"} 2', body)
+        self.assertIn('http_view_serialize_duration_seconds_count{view="category-list",method="GET"} 2', body)
+
+    async def test_async_views_under_asgi(self):
+        # AsyncClient goes through the ASGI handler, where the middleware runs in async mode
+        await Category.objects.acreate(name='Lamps', description='Lamps')
+        response = await AsyncClient().get('/api/async/categories/')
+        self.assertEqual(response.status_code, 200)
+        db, serialize = response['Server-Timing'].split(', ')[:2]
+        self.assertNotIn('desc="0 queries"', db)
+        self.assertGreater(float(serialize.split('=')[1]), 0)
+
+    def test_metrics_are_staff_only(self):
+        self.client.force_authenticate(User.objects.create_user(username='customer', password='password123'))
+        self.assertEqual(self.client.get('/api/_metrics/').status_code, 403)
+
+    @override_settings(REQUEST_METRICS_ENABLED=False)
+    def test_disabled(self):
+        response = self.client.get('/api/categories/')
+        self.assertFalse(response.has_header('Server-Timing'))
+
+
+def seed_store(products=2000, reviewers=50, orders=200):
+    """Bulk-load a catalog with images, reviews and a shopper who has a cart, addresses and an order history."""
+    password = make_password('password123')
+    users = User.objects.bulk_create([
+        User(username=f'seeduser{i}', email=f'seeduser{i}@example.com', password=password) for i in range(reviewers)
+    ])
+    shopper = users[0]
+    categories = Category.objects.bulk_create([
+        Category(name=f'Category {i}', description=f'Everything in category {i}') for i in range(20)
+    ])
+    catalog = Product.objects.bulk_create([
+        Product(
+            category=categories[i % len(categories)], name=f'Seed product {i}',
+            description=f'Seed product {i} description', price=Decimal('5.00') + i % 300, stock=1000,
+        )
+        for i in range(products)
+    ])
+    ProductImage.objects.bulk_create([
+        ProductImage(product=product, image=f'products/seed/{product.pk}-{n}.jpg')
+        for product in catalog for n in range(2)
+    ])
+    Review.objects.bulk_create([
+        Review(product=product, user=users[(i + n) % reviewers], rating=(i + n) % 5 + 1, title='Seeded', comment='Seeded review')
+        for i, product in enumerate(catalog) for n in range(3)
+    ])
+    call_command('rebuild_ratings', stdout=StringIO())
+
+    addresses = [create_address(shopper), create_address(shopper)]
+    history = Order.objects.bulk_create([
+        Order(
+            user=shopper, order_number=uuid.uuid4().hex[:12].upper(), shipping_address=addresses[0],
+            billing_address=addresses[1], subtotal=Decimal('30.00'), total=Decimal('30.00'),
+        )
+        for _ in range(orders)
+    ])
+    images = {image.product_id: image for image in ProductImage.objects.filter(product__in=catalog[:10])}
+    OrderItem.objects.bulk_create([
+        OrderItem(order=order, product=product, quantity=1, price=product.price, productimage=images[product.pk])
+        for i, order in enumerate(history) for product in catalog[i % 7:i % 7 + 3]
+    ])
+    cart = Cart.objects.create(user=shopper)
+    CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=2) for product in catalog[20:30]])
+    return shopper, catalog
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Query budgets for every route of the store router, measured against a seeded catalog.
+
+    Set QUERY_BUDGET_SCALE to grow the dataset and QUERY_BUDGET_REPORT to a file path to get
+    a JSON report with query counts, response bytes and median/p95 latencies that can be diffed
+    between commits. Routes suffixed with :304 revalidate with the ETag of a previous response.
+    """
+
+    repeat = 5
+
+    # route name: (method, maximum number of queries)
+    budgets = {
+        'api-root': ('get', 0),
+        'user-list': ('get', 1),
+        'user-detail': ('get', 1),
+        'user-me': ('get', 0),
+        'category-list': ('get', 2),
+        'category-detail': ('get', 1),
+        'product-list': ('get', 4),
+        'product-detail': ('get', 2),
+        'product-featured': ('get', 2),
+        'product-reviews': ('get', 3),
+        'product-bulk-update': ('post', 4),
+        'productimage-list': ('get', 1),
+        'productimage-detail': ('get', 1),
+        'address-list': ('get', 1),
+        'address-detail': ('get', 1),
+        'review-list': ('get', 2),
+        'review-detail': ('get', 1),
+        'cart-my-cart': ('get', 3),
+        'cart-add-item': ('post', 14),
+        'cart-update-item': ('patch', 13),
+        'cart-remove-item': ('delete', 11),
+        'cart-clear': ('delete', 9),
+        'cart-batch': ('post', 15),
+        'order-list': ('get', 3),
+        'order-detail': ('get', 2),
+        'order-cancel': ('patch', 10),
+        'order-export': ('get', 2),
+        'order-bulk-transition': ('post', 10),
+        'cart-checkout': ('post', 17),
+        'analytics-sales': ('get', 1),
+        'analytics-categories': ('get', 1),
+        'analytics-top-products': ('get', 1),
+        'category-list:304': ('get', 0),
+        'product-list:304': ('get', 1),
+        'product-reviews:304': ('get', 2),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        scale = float(os.environ.get('QUERY_BUDGET_SCALE', 1))
+        cls.shopper, catalog = seed_store(
+            products=int(2000 * scale), reviewers=50, orders=int(200 * scale))
+        cls.product = catalog[0]
+        cls.image = cls.product.images.first()
+        cls.review = Review.objects.filter(user=cls.shopper).first()
+        cls.order = cls.shopper.orders.first()
+        cls.address = cls.shopper.addresses.first()
+        cls.cart_item = cls.shopper.cart.items.first()
+        # staff so the analytics routes answer too, nothing else looks at it
+        cls.shopper.is_staff = True
+        cls.shopper.save(update_fields=['is_staff'])
+        call_command('rebuild_sales_rollups', stdout=StringIO())
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.report = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        path = os.environ.get('QUERY_BUDGET_REPORT')
+        if path and cls.report:
+            with open(path, 'w') as report:
+                json.dump(cls.report, report, indent=2, sort_keys=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.shopper)
+
+    def route_request(self, name):
+        """URL and body for one request to the named route."""
+        requests = {
+            'api-root': ('/api/', None),
+            'user-list': ('/api/users/', None),
+            'user-detail': (f'/api/users/{self.shopper.pk}/', None),
+            'user-me': ('/api/users/me/', None),
+            'category-list': ('/api/categories/', None),
+            'category-detail': (f'/api/categories/{self.product.category_id}/', None),
+            'product-list': ('/api/products/', None),
+            'product-detail': (f'/api/products/{self.product.pk}/', None),
+            'product-featured': ('/api/products/featured/', None),
+            'product-reviews': (f'/api/products/{self.product.pk}/reviews/', None),
+            'product-bulk-update': ('/api/products/bulk_update/', [
+                {'id': product.pk, 'price': '19.99', 'stock': 7} for product in Product.objects.order_by('pk')[:100]
+            ]),
+            'productimage-list': ('/api/product-images/', None),
+            'productimage-detail': (f'/api/product-images/{self.image.pk}/', None),
+            'address-list': ('/api/addresses/', None),
+            'address-detail': (f'/api/addresses/{self.address.pk}/', None),
+            'review-list': ('/api/reviews/', None),
+            'review-detail': (f'/api/reviews/{self.review.pk}/', None),
+            'order-list': ('/api/orders/?page_size=50', None),
+            'order-detail': (f'/api/orders/{self.order.pk}/', None),
+            'order-cancel': (f'/api/orders/{self.order.pk}/cancel/', None),
+            'order-export': ('/api/orders/export/?output=ndjson', None),
+            'order-bulk-transition': ('/api/orders/bulk_transition/', {
+                'ids': list(self.shopper.orders.values_list('pk', flat=True)[:100]), 'order_status': 'cancelled',
+            }),
+            'cart-my-cart': ('/api/cart/my_cart/', None),
+            'cart-add-item': ('/api/cart/add_item/', {'product_id': self.product.pk, 'quantity': 1}),
+            'cart-update-item': ('/api/cart/update_item/', {'item_id': self.cart_item.pk, 'quantity': 3}),
+            'cart-remove-item': ('/api/cart/remove_item/', {'item_id': self.cart_item.pk}),
+            'cart-clear': ('/api/cart/clear/', None),
+            'cart-batch': ('/api/cart/batch/', {'operations': [
+                {'op': 'add', 'product_id': self.product.pk, 'quantity': 1},
+                {'op': 'update', 'product_id': self.cart_item.product_id, 'quantity': 3},
+            ]}),
+            'cart-checkout': ('/api/cart/checkout/', {'shipping_address_id': self.address.pk}),
+            'analytics-sales': ('/api/analytics/sales/', None),
+            'analytics-categories': ('/api/analytics/categories/', None),
+            'analytics-top-products': ('/api/analytics/top_products/', None),
+        }
+        return requests[name]
+
+    def measure(self, name, method):
+        route, _, expected_status = name.partition(':')
+        url, data = self.route_request(route)
+        headers = {}
+        if expected_status == '304':
+            headers['HTTP_IF_NONE_MATCH'] = self.client.get(url)['ETag']
+        timings, counts = [], set()
+        # one untimed run first so caches are warm
+        for run in range(self.repeat + 1):
+            # every run is rolled back so writes see the same data each time
+            with transaction.atomic():
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    response = getattr(self.client, method)(url, data, format='json', **headers)
+                    # streamed responses only run their queries while they are read
+                    content = b''.join(response.streaming_content) if response.streaming else response.content
+                    elapsed = (time.perf_counter() - started) * 1000
+                transaction.set_rollback(True)
+            if expected_status:
+                self.assertEqual(response.status_code, int(expected_status))
+            else:
+                self.assertLess(response.status_code, 300, f'{name}: {response.status_code} {getattr(response, "data", "")}')
+            if run:
+                timings.append(elapsed)
+                counts.add(len(queries))
+        return max(counts), timings, len(content)
+
+    def test_every_route_has_a_budget(self):
+        names = {pattern.name for pattern in router.urls}
+        self.assertEqual(names - set(self.budgets), set())
+
+    def test_query_budgets(self):
+        for name, (method, budget) in self.budgets.items():
+            with self.subTest(route=name):
+                queries, timings, size = self.measure(name, method)
+                self.report[name] = {
+                    'method': method.upper(),
+                    'queries': queries,
+                    'bytes': size,
+                    'budget': budget,
+                    'median_ms': round(statistics.median(timings), 2),
+                    'p95_ms': round(statistics.quantiles(timings, n=20)[-1], 2),
+                }
+                self.assertLessEqual(queries, budget, f'{name} ran {queries} queries, its budget is {budget}')
+
+
+class CategoryCacheTests(TestCase):
+    """Categories and their product totals are served from the cache until a category or product changes."""
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Toys', description='All toys')
+        self.product = Product.objects.create(
+            category=self.category, name='Kite', description='A kite', price=Decimal('12.00'), stock=4)
+        self.client = APIClient()
+
+    def test_cached_totals_are_invalidated(self):
+        self.assertEqual(self.client.get('/api/categories/').data['results'][0]['product_total'], 1)
+        with self.assertNumQueries(2):
+            self.client.get('/api/categories/')
+        with self.assertNumQueries(4):
+            # the nested category costs nothing once cached
+            self.assertEqual(self.client.get('/api/products/').data['results'][0]['category']['name'], 'Toys')
+
+        self.product.is_available = False
+        self.product.save()
+        self.assertEqual(self.client.get('/api/categories/').data['results'][0]['product_total'], 0)
+
+        self.category.name = 'Games'
+        self.category.save()
+        self.assertEqual(self.client.get('/api/products/').data['results'][0]['category']['name'], 'Games')
+
+
+class ConditionalGetTests(TestCase):
+    """Catalog lists answer 304 until something they show changes."""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Lamps', description='All lamps')
+        self.product = Product.objects.create(
+            category=category, name='Lamp', description='A lamp', price=Decimal('20.00'), stock=9)
+        self.user = User.objects.create_user(username='critic', password='password123')
+        self.client = APIClient()
+
+    def revalidate(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_products_and_categories(self):
+        for url in ('/api/products/', '/api/categories/'):
+            response = self.revalidate(url)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b'')
+
+        etag = self.client.get('/api/products/')['ETag']
+        self.product.price = Decimal('25.00')
+        self.product.save()
+        self.assertEqual(self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        etag = self.client.get('/api/categories/')['ETag']
+        self.product.is_available = False
+        self.product.save()
+        self.assertEqual(self.client.get('/api/categories/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_filtered_lists_have_their_own_etag(self):
+        self.assertNotEqual(
+            self.client.get('/api/products/')['ETag'],
+            self.client.get('/api/products/', {'price__gte': 100})['ETag'])
+
+    def test_reviews_and_last_modified(self):
+        url = f'/api/products/{self.product.id}/reviews/'
+        self.assertEqual(self.revalidate(url).status_code, 304)
+        last_modified = self.client.get(url)['Last-Modified']
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        etag = self.client.get(url)['ETag']
+        Review.objects.create(product=self.product, user=self.user, rating=3, title='Fine', comment='Fine')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class CursorPaginationTests(TestCase):
+    """?pagination=cursor switches lists to keyset pages, page numbers stay the default."""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Pens', description='All pens')
+        Product.objects.bulk_create([
+            Product(category=category, name=f'Pen {i}', description=f'Pen {i}', price=Decimal('1.00'), stock=1)
+            for i in range(25)
+        ])
+        self.client = APIClient()
+
+    def walk(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            ids += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def test_cursor_pages_cover_every_row_once(self):
+        ids = self.walk('/api/products/?pagination=cursor')
+        self.assertEqual(ids, list(Product.objects.order_by('-created_at', '-id').values_list('id', flat=True)))
+
+    def test_cursor_follows_ordering_param(self):
+        ids = self.walk('/api/products/?pagination=cursor&ordering=name&page_size=7')
+        self.assertEqual(ids, list(Product.objects.order_by('name', 'id').values_list('id', flat=True)))
+
+    def test_page_numbers_are_the_default(self):
+        response = self.client.get('/api/products/', {'page': 2})
+        self.assertEqual(response.data['count'], 25)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_cursor_on_orders_skips_the_count(self):
+        user = User.objects.create_user(username='pager', password='password123')
+        self.client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/orders/', {'pagination': 'cursor'})
+        self.assertEqual(response.status_code, 200)
+        # the item_count annotation is a COUNT too, the paginator's would be a COUNT(*)
+        self.assertFalse(any('COUNT(*)' in query['sql'] for query in queries))
+
+
+class ProductSearchTests(TestCase):
+    """Every search term must match and name matches come before description matches."""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Audio', description='All audio')
+        self.speaker = Product.objects.create(
+            category=category, name='Wireless speaker', description='Loud and portable', price=Decimal('40.00'), stock=2)
+        self.headphones = Product.objects.create(
+            category=category, name='Headphones', description='Wireless, with a portable speaker case', price=Decimal('60.00'), stock=2)
+        Product.objects.create(
+            category=category, name='Turntable', description='Plays records', price=Decimal('90.00'), stock=2)
+        self.client = APIClient()
+
+    def search(self, **params):
+        return [row['id'] for row in self.client.get('/api/products/', params).data['results']]
+
+    def test_ranked_by_relevance(self):
+        self.assertEqual(self.search(search='wireless speaker'), [self.speaker.id, self.headphones.id])
+        self.assertEqual(self.search(search='portable records'), [])
+
+    def test_explicit_ordering_wins(self):
+        self.assertEqual(self.search(search='speaker', ordering='-price'), [self.headphones.id, self.speaker.id])
+
+
+class CartReadTests(TestCase):
+    """Cart responses cost the same number of queries however many lines the cart has."""
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Snacks', description='All snacks')
+        self.user = User.objects.create_user(username='snacker', password='password123')
+        self.cart = Cart.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_lines(self, count):
+        for i in range(count):
+            product = Product.objects.create(
+                category=self.category, name=f'Snack {i}', description=f'Snack {self.cart.items.count()}',
+                price=Decimal('1.50'), stock=10)
+            ProductImage.objects.create(product=product, image=f'products/snack{product.id}.jpg')
+            CartItem.objects.create(cart=self.cart, product=product, quantity=2)
+
+    def count_queries(self, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/cart/my_cart/', params)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.data
+
+    def test_lean_cart(self):
+        self.add_lines(2)
+        small, data = self.count_queries()
+        self.assertEqual(data['total_items'], 4)
+        self.assertEqual(data['total_price'], Decimal('6.00'))
+        self.assertEqual(set(data['items'][0]['product']), {'id', 'name', 'price', 'is_available', 'available_stock'})
+        self.add_lines(8)
+        self.assertEqual(self.count_queries()[0], small)
+
+    def test_expanded_cart(self):
+        self.add_lines(2)
+        small, data = self.count_queries({'expand': 'product'})
+        self.assertEqual(len(data['items'][0]['product']['images']), 1)
+        self.add_lines(8)
+        self.assertEqual(self.count_queries({'expand': 'product'})[0], small)
+
+    def test_empty_cart_totals(self):
+        _, data = self.count_queries()
+        self.assertEqual((data['total_items'], data['total_price']), (0, 0))
+
+
+class CartBatchTests(TestCase):
+    """cart/batch/ applies every operation or none and costs the same however many it carries."""
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Snacks', description='All snacks')
+        self.products = [
+            Product.objects.create(
+                category=self.category, name=f'Snack {i}', description=f'Snack {i}',
+                price=Decimal('2.00'), stock=5)
+            for i in range(12)
+        ]
+        self.user = User.objects.create_user(username='snacker', password='password123')
+        self.cart = Cart.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def batch(self, *operations):
+        return self.client.post('/api/cart/batch/', {'operations': list(operations)}, format='json')
+
+    def held(self):
+        return dict(self.cart.reservations.values_list('product_id', 'quantity'))
+
+    def test_operations_are_replayed_in_order(self):
+        first, second, third = self.products[:3]
+        self.batch({'op': 'add', 'product_id': third.pk, 'quantity': 1})
+        response = self.batch(
+            {'op': 'add', 'product_id': first.pk, 'quantity': 2},
+            {'op': 'add', 'product_id': first.pk},
+            {'op': 'update', 'product_id': second.pk, 'quantity': 4},
+            {'op': 'remove', 'product_id': third.pk},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total_items'], 7)
+        self.assertEqual(dict(self.cart.items.values_list('product_id', 'quantity')), {first.pk: 3, second.pk: 4})
+        self.assertEqual(self.held(), {first.pk: 3, second.pk: 4})
+        third.refresh_from_db()
+        self.assertEqual(third.reserved_stock, 0)
+
+    def test_one_shortage_rejects_the_whole_batch(self):
+        first, second = self.products[:2]
+        response = self.batch(
+            {'op': 'add', 'product_id': first.pk, 'quantity': 2},
+            {'op': 'update', 'product_id': second.pk, 'quantity': 6},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['errors'], {second.pk: 'Insufficient stock. Available: 5'})
+        self.assertFalse(self.cart.items.exists())
+        self.assertEqual(self.held(), {})
+        self.assertEqual(Product.objects.filter(reserved_stock__gt=0).count(), 0)
+
+    def test_unknown_product(self):
+        response = self.batch({'op': 'add', 'product_id': 0})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['errors'], {0: 'Product not found.'})
+
+    def test_query_count_does_not_grow_with_the_batch(self):
+        def count(products):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.batch(*({'op': 'add', 'product_id': product.pk} for product in products))
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        small = count(self.products[:2])
+        self.assertEqual(count(self.products[2:12]), small)
+
+
+class AsyncCatalogTests(TestCase):
+    """The async catalog views answer exactly like the DRF views they mirror."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.shopper, cls.catalog = seed_store(products=40, reviewers=5, orders=1)
+        cls.product = cls.catalog[3]
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def assertSameAnswer(self, path, params=None):
+        expected = self.client.get(f'/api/{path}', params, format='json')
+        actual = self.client.get(f'/api/async/{path}', params)
+        self.assertEqual(actual.status_code, expected.status_code)
+        # only the next/previous links differ, they point at the async path
+        self.assertEqual(json.loads(actual.content.replace(b'/api/async/', b'/api/')), json.loads(expected.content))
+        return actual
+
+    def test_same_answers(self):
+        category = self.product.category_id
+        self.assertSameAnswer('products/')
+        self.assertSameAnswer('products/', {'page': 3, 'page_size': 7})
+        self.assertSameAnswer('products/', {'category': category, 'ordering': 'price', 'price__gte': 10})
+        self.assertSameAnswer('products/', {'search': 'product 12', 'is_available': 'true'})
+        self.assertSameAnswer('products/', {'page': 99})
+        self.assertSameAnswer(f'products/{self.product.pk}/')
+        self.assertSameAnswer('products/0/')
+        self.assertSameAnswer(f'products/{self.product.pk}/reviews/')
+        self.assertSameAnswer('categories/', {'page': 2})
+        self.assertSameAnswer('reviews/', {'product': self.product.pk})
+        self.assertSameAnswer('reviews/', {'rating': 4, 'ordering': 'rating'})
+
+    def test_conditional_get(self):
+        response = self.client.get('/api/async/products/')
+        self.assertEqual(response['ETag'], self.client.get('/api/products/')['ETag'])
+        revalidated = self.client.get('/api/async/products/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_asgi_stack_has_no_sync_middleware(self):
+        # the stack asgi.py runs, WhiteNoise is left out there
+        middleware = [path for path in settings.MIDDLEWARE if 'whitenoise' not in path]
+        with override_settings(MIDDLEWARE=middleware, REQUEST_METRICS_ENABLED=True), \
+                patch.object(handlers_base.logger, 'debug') as debug:
+            ASGIHandler()
+        self.assertEqual([call.args for call in debug.call_args_list if 'adapted' in call.args[0]], [])
+
+    async def test_asgi_serves_static_files_with_whitenoise(self):
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root)
+        with open(os.path.join(static_root, 'site.css'), 'w') as file:
+            file.write('body {}')
+        django_application = AsyncMock()
+        with patch.dict(os.environ), override_settings(STATIC_ROOT=static_root):
+            from shopify_api.asgi import StaticFilesApplication
+            application = StaticFilesApplication(django_application)
+
+        async def get(path):
+            communicator = ApplicationCommunicator(application, {
+                'type': 'http', 'http_version': '1.1', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': [],
+                'root_path': '', 'scheme': 'http', 'server': ('testserver', 80)})
+            await communicator.send_input({'type': 'http.request', 'body': b''})
+            start = await communicator.receive_output()
+            body = b''
+            while True:
+                message = await communicator.receive_output()
+                body += message.get('body', b'')
+                if not message.get('more_body'):
+                    return start['status'], dict(start['headers']), body
+
+        status, headers, body = await get('/static/site.css')
+        self.assertEqual((status, body), (200, b'body {}'))
+        self.assertIn(b'max-age', headers[b'cache-control'])
+        self.assertEqual((await get('/static/missing.css'))[0], 404)
+        django_application.assert_not_called()
+        scope = {'type': 'http', 'path': '/api/async/categories/'}
+        await application(scope, None, None)
+        django_application.assert_awaited_once_with(scope, None, None)
+
+    def test_query_count_does_not_grow_with_the_page(self):
+        self.client.get('/api/async/products/')
+        with CaptureQueriesContext(connection) as small:
+            self.client.get('/api/async/products/', {'page_size': 2})
+        with CaptureQueriesContext(connection) as large:
+            self.client.get('/api/async/products/', {'page_size': 30})
+        self.assertEqual(len(small), len(large))
+
+
+class OrderTaskTests(TestCase):
+    """Checkout only queues its follow-up work, the tasks run once the order is committed."""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Tea', description='All tea')
+        self.user = User.objects.create_user(username='sipper', email='sipper@example.com', password='password123')
+        self.address = create_address(self.user)
+        cart = Cart.objects.create(user=self.user)
+        for i in range(2):
+            product = Product.objects.create(
+                category=category, name=f'Tea {i}', description=f'Tea {i}', price=Decimal('4.25'), stock=10)
+            ProductImage.objects.create(product=product, image=f'products/tea{i}.jpg')
+            CartItem.objects.create(cart=cart, product=product, quantity=3)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def checkout(self):
+        return self.client.post('/api/cart/checkout/', {'shipping_address_id': self.address.pk})
+
+    def test_nothing_runs_before_the_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.checkout()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertFalse(OrderItem.objects.filter(productimage__isnull=False).exists())
+
+    def test_tasks_after_the_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.checkout()
+        order = Order.objects.get(pk=response.data['id'])
+        self.assertFalse(order.items.filter(productimage__isnull=True).exists())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['sipper@example.com'])
+        self.assertIn(order.order_number, mail.outbox[0].body)
+        self.assertIn('3 x Tea 1', mail.outbox[0].body)
+        sales = DailySales.objects.get(day=timezone.localdate(order.created_at))
+        self.assertEqual((sales.orders, sales.units, sales.revenue), (1, 6, Decimal('25.50')))
+
+    def test_category_cache_is_left_alone(self):
+        # stock moves don't change what the category cache holds
+        categories = self.client.get('/api/categories/')
+        with patch('store.cache.build_categories') as build, self.captureOnCommitCallbacks(execute=True):
+            order_id = self.checkout().data['id']
+            self.assertEqual(self.client.patch(f'/api/orders/{order_id}/cancel/').status_code, 200)
+        build.assert_not_called()
+        self.assertEqual(self.client.get('/api/categories/')['ETag'], categories['ETag'])
+
+    def test_failed_checkout_queues_nothing(self):
+        Product.objects.update(stock=1)
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.checkout()
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(callbacks, [])
+
+    def test_without_a_broker_tasks_run_on_a_background_thread(self):
+        ran_on = []
+        celery_app.conf.task_always_eager = False
+        try:
+            with patch.object(record_order, 'apply', side_effect=lambda args: ran_on.append(threading.current_thread()) or Mock(**{'failed.return_value': False})) as apply:
+                with self.assertLogs('shopify_api.celery', 'WARNING'):
+                    enqueue(record_order, 1).result(timeout=5)
+        finally:
+            celery_app.conf.task_always_eager = True
+        apply.assert_called_once_with(args=(1,))
+        self.assertNotEqual(ran_on, [threading.current_thread()])
+
+
+class ProductImageRenditionTests(TestCase):
+    """Uploads are resized in the background and served as srcset strings."""
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        storages = {**settings.STORAGES, 'default': {**settings.STORAGES['default'], 'OPTIONS': {'location': media}}}
+        override = override_settings(MEDIA_ROOT=media, STORAGES=storages, PRODUCT_IMAGE_WIDTHS=(320, 640, 1280))
+        override.enable()
+        self.addCleanup(override.disable)
+        category = Category.objects.create(name='Lamps', description='All lamps')
+        self.product = Product.objects.create(
+            category=category, name='Lamp', description='A lamp', price=Decimal('20.00'), stock=3)
+
+    def upload(self, size, mode='RGB'):
+        buffer = BytesIO()
+        PILImage.new(mode, size, 'orange').save(buffer, 'PNG')
+        with self.captureOnCommitCallbacks(execute=True):
+            image = ProductImage.objects.create(
+                product=self.product, image=SimpleUploadedFile('lamp.png', buffer.getvalue(), 'image/png'))
+        image.refresh_from_db()
+        return image
+
+    def test_renditions_are_written_next_to_the_original(self):
+        image = self.upload((800, 600), mode='RGBA')
+        self.assertEqual(image.renditions['source'], image.image.name)
+        self.assertEqual(set(image.renditions['webp']), {'320', '640'})
+        for image_format, extension in (('webp', 'WEBP'), ('jpeg', 'JPEG')):
+            for width, name in image.renditions[image_format].items():
+                self.assertEqual(os.path.dirname(name), os.path.dirname(image.image.name))
+                with image.image.storage.open(name) as file, PILImage.open(file) as rendition:
+                    self.assertEqual((rendition.format, rendition.width), (extension, int(width)))
+                    self.assertEqual(rendition.height, int(width) * 3 // 4)
+
+    def test_srcset_in_the_api(self):
+        image = self.upload((800, 600))
+        srcset = APIClient().get(f'/api/product-images/{image.pk}/').data['srcset']
+        self.assertEqual(set(srcset), {'webp', 'jpeg'})
+        first, second = srcset['webp'].split(', ')
+        self.assertTrue(first.startswith('http://testserver/media/products/'))
+        self.assertTrue(first.endswith('_320w.webp 320w'))
+        self.assertTrue(second.endswith('_640w.webp 640w'))
+
+    def test_small_uploads_are_not_upscaled(self):
+        image = self.upload((200, 100))
+        self.assertEqual(list(image.renditions['jpeg']), ['200'])
+
+    def test_saving_without_a_new_upload_queues_nothing(self):
+        image = self.upload((800, 600))
+        image.alt_text = 'A lamp'
+        with self.captureOnCommitCallbacks() as callbacks:
+            image.save()
+        self.assertEqual(callbacks, [])
+
+    def test_unreadable_upload_keeps_the_original(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            image = ProductImage.objects.create(product=self.product, image='products/missing.jpg')
+        image.refresh_from_db()
+        self.assertEqual(image.renditions, {})
+        self.assertEqual(ProductImageSerializer(image).data['srcset'], {})
+
+    def test_upload_is_resized_outside_the_request(self):
+        buffer = BytesIO()
+        PILImage.new('RGB', (800, 600), 'orange').save(buffer, 'PNG')
+        with patch('store.signals.enqueue') as enqueue_task, self.captureOnCommitCallbacks(execute=True):
+            image = ProductImage.objects.create(
+                product=self.product, image=SimpleUploadedFile('lamp.png', buffer.getvalue(), 'image/png'))
+        enqueue_task.assert_called_once_with(generate_image_renditions, image.pk)
+
+    def test_queue_needs_a_broker(self):
+        with self.assertRaisesMessage(CommandError, 'CELERY_BROKER_URL'):
+            call_command('generate_image_renditions', '--queue', stdout=StringIO())
+
+
+class ProductImportExportTests(TestCase):
+    """Products go out and come back through files in batches of a fixed number of queries."""
+
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.shoes = Category.objects.create(name='Shoes', description='All shoes')
+        self.hats = Category.objects.create(name='Hats', description='All hats')
+        self.product = Product.objects.create(
+            category=self.shoes, name='Boot', description='A boot', price=Decimal('50.00'), stock=4)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, text):
+        with open(self.path(name), 'w') as file:
+            file.write(text)
+        return self.path(name)
+
+    def run_import(self, path, *args):
+        out, err = StringIO(), StringIO()
+        call_command('import_products', path, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_csv_round_trip(self):
+        call_command('export_products', self.path('products.csv'), stdout=StringIO())
+        with open(self.path('products.csv')) as file:
+            exported = file.read()
+        self.assertEqual(exported.splitlines(), [
+            'id,name,description,price,stock,is_available,category',
+            f'{self.product.pk},Boot,A boot,50.00,4,True,Shoes',
+        ])
+        self.write('products.csv', exported.replace('50.00,4', '45.00,9') + ',Cap,A cap,12.50,30,False,Hats\n')
+        out, err = self.run_import(self.path('products.csv'))
+        self.assertIn('Created 1, updated 1, skipped 0', out)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.price, self.product.stock), (Decimal('45.00'), 9))
+        cap = Product.objects.get(name='Cap')
+        self.assertEqual((cap.category, cap.is_available, cap.price), (self.hats, False, Decimal('12.50')))
+
+    def test_invalid_rows_are_reported_and_skipped(self):
+        path = self.write('products.jsonl', '\n'.join([
+            json.dumps({'name': 'Sandal', 'description': 'A sandal', 'price': '9.99', 'stock': 5, 'category': 'Shoes'}),
+            json.dumps({'name': 'Free', 'description': 'Free', 'price': '0', 'stock': 5, 'category': 'Shoes'}),
+            json.dumps({'name': 'Scarf', 'description': 'A scarf', 'price': '5', 'stock': 1, 'category': 'Scarves'}),
+            json.dumps({'name': 'Boot 2', 'description': 'A boot', 'price': '5', 'stock': 1, 'category': 'Shoes'}),
+            json.dumps({'id': 999999, 'name': 'Gone', 'description': 'Gone', 'price': '5', 'stock': 1, 'category': 'Shoes'}),
+            'not json',
+        ]))
+        out, err = self.run_import(path)
+        self.assertIn('Created 1, updated 0, skipped 5', out)
+        self.assertEqual([line.split(':')[0] for line in err.splitlines()], [f'line {n}' for n in range(2, 7)])
+        self.assertIn('The price of a product must be more than 0', err)
+        self.assertIn('Unknown category', err)
+        self.assertIn('already exists', err)
+        self.assertEqual(set(Product.objects.values_list('name', flat=True)), {'Boot', 'Sandal'})
+
+    def test_updates_keep_the_columns_a_row_leaves_out(self):
+        self.product.is_available = False
+        self.product.save()
+        path = self.write('products.jsonl', '\n'.join([
+            json.dumps({'id': self.product.pk, 'name': 'Boot', 'description': 'A boot', 'price': '45.00', 'category': 'Shoes'}),
+            json.dumps({'name': 'Sandal', 'description': 'A sandal', 'price': '9.99', 'category': 'Shoes'}),
+        ]))
+        out, err = self.run_import(path)
+        self.assertIn('Created 1, updated 1, skipped 0', out)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.price, self.product.stock, self.product.is_available), (Decimal('45.00'), 4, False))
+
+    def test_queries_per_batch_do_not_grow_with_the_batch(self):
+        def queries(rows, batch_size):
+            Product.objects.exclude(pk=self.product.pk).delete()
+            lines = ['name,description,price,stock,is_available,category'] + [
+                f'Shoe {i},Shoe {i},{i + 1}.00,{i},True,Shoes' for i in range(rows)]
+            path = self.write('products.csv', '\n'.join(lines))
+            with CaptureQueriesContext(connection) as captured:
+                self.run_import(path, '--batch-size', str(batch_size))
+            self.assertEqual(Product.objects.count(), rows + 1)
+            return len(captured)
+
+        self.assertEqual(queries(10, 10), queries(50, 50))
+        self.assertGreater(queries(50, 10), queries(50, 50))
+
+
+class ProductBulkUpdateTests(TestCase):
+    """products/bulk_update/ writes many products in a fixed number of statements and reports every row."""
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Pens', description='All pens')
+        self.products = [
+            Product.objects.create(
+                category=self.category, name=f'Pen {i}', description=f'Pen {i}', price=Decimal('1.00'), stock=10)
+            for i in range(30)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='stocker', password='password123', is_staff=True))
+
+    def bulk_update(self, rows):
+        return self.client.post('/api/products/bulk_update/', rows, format='json')
+
+    def test_staff_only(self):
+        self.client.force_authenticate(User.objects.create_user(username='customer', password='password123'))
+        self.assertEqual(self.bulk_update([{'id': self.products[0].pk, 'price': '0.01'}]).status_code, 403)
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).price, Decimal('1.00'))
+
+    def test_rows_get_their_own_status(self):
+        first, second, third = self.products[:3]
+        response = self.bulk_update([
+            {'id': first.pk, 'price': '2.50'},
+            {'id': second.pk, 'stock': 0, 'is_available': False},
+            {'id': third.pk, 'price': '-1'},
+            {'id': 0, 'stock': 3},
+            {'id': first.pk},
+            'nonsense',
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['updated'], response.data['failed']), (2, 4))
+        self.assertEqual(
+            [result['status'] for result in response.data['results']],
+            ['updated', 'updated', 'invalid', 'not_found', 'invalid', 'invalid'],
+        )
+        self.assertIn('price', response.data['results'][2]['errors'])
+        first.refresh_from_db()
+        second.refresh_from_db()
+        third.refresh_from_db()
+        self.assertEqual((first.price, first.stock), (Decimal('2.50'), 10))
+        self.assertEqual((second.price, second.stock, second.is_available), (Decimal('1.00'), 0, False))
+        self.assertEqual(third.price, Decimal('1.00'))
+
+    def test_updated_products_change_their_etag(self):
+        etag = self.client.get('/api/products/')['ETag']
+        self.bulk_update([{'id': self.products[0].pk, 'stock': 1}])
+        self.assertNotEqual(self.client.get('/api/products/')['ETag'], etag)
+
+    def test_category_totals_follow_availability(self):
+        self.assertEqual(self.client.get('/api/categories/').data['results'][0]['product_total'], 30)
+        self.bulk_update([{'id': product.pk, 'is_available': False} for product in self.products[:5]])
+        self.assertEqual(self.client.get('/api/categories/').data['results'][0]['product_total'], 25)
+
+    def test_statements_do_not_grow_with_the_rows(self):
+        def count(products):
+            with CaptureQueriesContext(connection) as queries:
+                self.bulk_update([{'id': product.pk, 'price': '3.00', 'stock': 4} for product in products])
+            return len(queries)
+        self.assertEqual(count(self.products[:2]), count(self.products))
+        self.assertEqual(Product.objects.filter(price=Decimal('3.00'), stock=4).count(), 30)
+
+    def test_requires_authentication(self):
+        self.client.force_authenticate(None)
+        self.assertEqual(self.bulk_update([{'id': self.products[0].pk, 'stock': 1}]).status_code, 401)
+
+
+class OrderExportTests(TestCase):
+    """Order exports stream the whole history in a number of queries that only grows with the chunks."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.shopper, cls.catalog = seed_store(products=20, reviewers=3, orders=30)
+        cls.other = User.objects.create_user(username='other', password='password123')
+        cls.staff = User.objects.create_user(username='staff', password='password123', is_staff=True)
+        Order.objects.create(
+            user=cls.other, shipping_address=create_address(cls.other),
+            subtotal=Decimal('5.00'), total=Decimal('5.00'))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.shopper)
+
+    def export(self, **params):
+        response = self.client.get('/api/orders/export/', params)
+        if response.status_code != 200:
+            return response, None
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_csv_has_a_line_per_item(self):
+        response, content = self.export()
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('attachment; filename="orders-', response['Content-Disposition'])
+        rows = list(csv.DictReader(StringIO(content)))
+        self.assertEqual(len(rows), OrderItem.objects.filter(order__user=self.shopper).count())
+        self.assertEqual({row['username'] for row in rows}, {self.shopper.username})
+        self.assertEqual(rows[0]['item_product_name'], OrderItem.objects.get(
+            order__order_number=rows[0]['order_number'], product_id=rows[0]['item_product_id']).product.name)
+
+    def test_ndjson_has_a_line_per_order(self):
+        _, content = self.export(output='ndjson')
+        orders = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(len(orders), 30)
+        self.assertEqual(len(orders[0]['items']), 3)
+        self.assertEqual(orders[0]['total'], '30.00')
+
+    def test_date_range(self):
+        old = self.shopper.orders.order_by('pk')[:10]
+        Order.objects.filter(pk__in=[order.pk for order in old]).update(created_at=timezone.now() - timedelta(days=40))
+        since = (timezone.localdate() - timedelta(days=7)).isoformat()
+        _, content = self.export(output='ndjson', created_after=since)
+        self.assertEqual(len(content.splitlines()), 20)
+        until = (timezone.localdate() - timedelta(days=30)).isoformat()
+        _, content = self.export(output='ndjson', created_before=until)
+        self.assertEqual(len(content.splitlines()), 10)
+        self.assertEqual(self.export(created_after='yesterday')[0].status_code, 400)
+
+    def test_everyone_only_for_staff(self):
+        self.assertEqual(self.export(all='true')[0].status_code, 403)
+        self.client.force_authenticate(self.staff)
+        _, content = self.export(output='ndjson', all='true')
+        self.assertEqual(len(content.splitlines()), 31)
+
+    def test_queries_grow_with_chunks_not_orders(self):
+        def queries(chunk_size):
+            with patch('store.exports.CHUNK_SIZE', chunk_size), CaptureQueriesContext(connection) as captured:
+                self.export(output='ndjson')
+            return len(captured)
+        self.assertEqual(queries(500), queries(100))
+        self.assertGreater(queries(10), queries(100))
+
+
+class OrderListQueryTests(TestCase):
+    """Orders are listed with their addresses, items and images in a fixed number of queries."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.shopper, cls.catalog = seed_store(products=20, reviewers=3, orders=60)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.shopper)
+
+    def list_orders(self, page_size):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/orders/', {'page_size': page_size})
+        self.assertEqual(response.status_code, 200)
+        return response.data['results'], len(queries)
+
+    def test_page_of_50_costs_a_constant_number_of_queries(self):
+        orders, queries = self.list_orders(50)
+        self.assertEqual(len(orders), 50)
+        # count, orders with user and addresses, items with product and image
+        self.assertEqual(queries, 3)
+        self.assertEqual(self.list_orders(5)[1], queries)
+
+    def test_item_count_and_nested_items(self):
+        orders, _ = self.list_orders(50)
+        for data in orders:
+            order = Order.objects.get(pk=data['id'])
+            self.assertEqual(data['item_count'], order.items.count())
+            self.assertEqual(
+                [(item['product'], item['product_name']) for item in data['items']],
+                [(item.product_id, item.product.name) for item in order.items.order_by('id')],
+            )
+            self.assertEqual(data['user_info']['username'], self.shopper.username)
+            self.assertIsNotNone(data['items'][0]['productimage'])
+
+
+class SalesAnalyticsTests(TestCase):
+    """Sales rollups follow orders and cancellations, and the staff endpoints answer from them."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.shopper, cls.catalog = seed_store(products=20, reviewers=3, orders=30)
+        cls.staff = User.objects.create_user(username='staff', password='password123', is_staff=True)
+        # a third of the history is from a week ago
+        cls.last_week = timezone.localdate() - timedelta(days=7)
+        Order.objects.filter(pk__in=[order.pk for order in cls.shopper.orders.order_by('pk')[:10]]).update(
+            created_at=timezone.now() - timedelta(days=7))
+        call_command('rebuild_sales_rollups', stdout=StringIO())
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def rollups(self):
+        rows = {}
+        for model in (DailySales, DailyCategorySales, DailyProductSales):
+            keys = ('day', f'{model.key}_id') if model.key else ('day',)
+            rows[model] = sorted(model.objects.values_list(*keys, 'orders', 'units', 'revenue'))
+        return rows
+
+    def test_rebuild_matches_the_orders(self):
+        today = DailySales.objects.get(day=timezone.localdate())
+        items = OrderItem.objects.filter(order__created_at__date=timezone.localdate())
+        self.assertEqual((today.orders, today.units), (20, 60))
+        self.assertEqual(today.revenue, sum(item.subtotal for item in items))
+        self.assertEqual(DailySales.objects.get(day=self.last_week).orders, 10)
+        product = self.catalog[0]
+        row = DailyProductSales.objects.get(day=timezone.localdate(), product=product)
+        self.assertEqual(row.units, OrderItem.objects.filter(
+            product=product, order__created_at__date=timezone.localdate()).count())
+
+    def test_orders_and_cancellations_are_added_incrementally(self):
+        address = self.shopper.addresses.first()
+        self.client.force_authenticate(self.shopper)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/orders/', {
+                'shipping_address_id': address.pk,
+                'items_data': [{'product': self.catalog[0].pk, 'quantity': 2}, {'product': self.catalog[1].pk, 'quantity': 1}],
+            }, format='json')
+        self.assertEqual(response.status_code, 201)
+        incremental = self.rollups()
+        call_command('rebuild_sales_rollups', stdout=StringIO())
+        self.assertEqual(incremental, self.rollups())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/orders/{response.data["id"]}/cancel/')
+        incremental = self.rollups()
+        call_command('rebuild_sales_rollups', stdout=StringIO())
+        self.assertEqual(incremental, self.rollups())
+
+    def test_redelivered_tasks_count_once(self):
+        order = self.shopper.orders.order_by('pk').last()
+        before = self.rollups()
+        # already counted by the rebuild
+        self.assertFalse(record_order(order.pk))
+        self.assertEqual(self.rollups(), before)
+
+        Order.objects.filter(pk=order.pk).update(order_status='cancelled')
+        self.assertEqual(record_cancellations([order.pk, order.pk]), 1)
+        cancelled = self.rollups()
+        self.assertNotEqual(cancelled, before)
+        self.assertEqual(record_cancellations([order.pk]), 0)
+        self.assertEqual(self.rollups(), cancelled)
+        call_command('rebuild_sales_rollups', stdout=StringIO())
+        self.assertEqual(self.rollups(), cancelled)
+
+    def test_cancellation_recorded_before_its_order(self):
+        address = self.shopper.addresses.first()
+        self.client.force_authenticate(self.shopper)
+        before = self.rollups()
+        with self.captureOnCommitCallbacks() as placed:
+            response = self.client.post('/api/orders/', {
+                'shipping_address_id': address.pk,
+                'items_data': [{'product': self.catalog[0].pk, 'quantity': 2}],
+            }, format='json')
+        self.assertEqual(response.status_code, 201)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/orders/{response.data["id"]}/cancel/')
+        # the order's own tasks only run now, after its cancellation was recorded
+        for callback in placed:
+            callback()
+        self.assertEqual(self.rollups(), before)
+        self.assertFalse(Order.objects.get(pk=response.data['id']).sales_recorded)
+
+    def test_rebuild_a_range(self):
+        DailySales.objects.update(orders=0)
+        call_command('rebuild_sales_rollups', start=self.last_week.isoformat(), end=self.last_week.isoformat(), stdout=StringIO())
+        self.assertEqual(DailySales.objects.get(day=self.last_week).orders, 10)
+        self.assertEqual(DailySales.objects.get(day=timezone.localdate()).orders, 0)
+
+    def test_sales(self):
+        response = self.client.get('/api/analytics/sales/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['days']), 30)
+        self.assertEqual(response.data['totals']['orders'], 30)
+        self.assertEqual(response.data['days'][-8]['orders'], 10)
+        self.assertEqual(response.data['days'][0]['orders'], 0)
+
+        category = self.catalog[0].category_id
+        response = self.client.get('/api/analytics/sales/', {'category': category, 'start': timezone.localdate().isoformat()})
+        self.assertEqual(len(response.data['days']), 1)
+        self.assertEqual(response.data['totals']['units'], OrderItem.objects.filter(
+            product__category_id=category, order__created_at__date=timezone.localdate()).count())
+
+    def test_rankings(self):
+        response = self.client.get('/api/analytics/top_products/', {'order_by': 'units', 'limit': 3})
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual([row['units'] for row in results], sorted((row['units'] for row in results), reverse=True))
+        best = results[0]
+        self.assertEqual(best['name'], Product.objects.get(pk=best['product_id']).name)
+        self.assertEqual(best['units'], OrderItem.objects.filter(product_id=best['product_id']).count())
+
+        response = self.client.get('/api/analytics/categories/')
+        self.assertEqual(sum(row['units'] for row in response.data['results']), 90)
+
+    def test_staff_only_and_bad_params(self):
+        self.assertEqual(self.client.get('/api/analytics/sales/', {'start': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/analytics/sales/', {'start': '2030-01-02', 'end': '2030-01-01'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/analytics/top_products/', {'order_by': 'name'}).status_code, 400)
+        self.client.force_authenticate(self.shopper)
+        self.assertEqual(self.client.get('/api/analytics/sales/').status_code, 403)
+
+    def test_dashboard_reads_only_the_rollups(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/analytics/sales/')
+            self.client.get('/api/analytics/top_products/')
+        self.assertFalse(any('store_order' in query['sql'] for query in queries))
+
+
+class IdempotencyKeyTests(TestCase):
+    """Retries sent with the same Idempotency-Key get the first order back instead of placing another."""
+
+    def setUp(self):
+        category = Category.objects.create(name='Bikes', description='All bikes')
+        self.product = Product.objects.create(
+            category=category, name='Bike', description='A bike', price=Decimal('250.00'), stock=10)
+        self.user = User.objects.create_user(username='rider', password='password123')
+        self.address = create_address(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def order(self, key, quantity=1, client=None):
+        return (client or self.client).post('/api/orders/', {
+            'shipping_address_id': self.address.pk,
+            'items_data': [{'product': self.product.pk, 'quantity': quantity}],
+        }, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retried_checkout_replays_the_order(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+        first = self.client.post('/api/cart/checkout/', {'shipping_address_id': self.address.pk}, HTTP_IDEMPOTENCY_KEY='checkout-1')
+        retry = self.client.post('/api/cart/checkout/', {'shipping_address_id': self.address.pk}, HTTP_IDEMPOTENCY_KEY='checkout-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(Order.objects.count(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 8)
+
+    def test_retried_order_replays_without_creating(self):
+        first = self.order('order-1')
+        with CaptureQueriesContext(connection) as queries:
+            retry = self.order('order-1')
+        self.assertEqual(retry.data['id'], first.data['id'])
+        self.assertFalse(any('INSERT INTO "store_order"' in query['sql'] for query in queries))
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertNotIn('Idempotent-Replayed', first)
+
+    def test_key_reused_for_another_request(self):
+        self.order('order-1')
+        self.assertEqual(self.order('order-1', quantity=2).status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_keys_are_per_user(self):
+        other = User.objects.create_user(username='other', password='password123')
+        client = APIClient()
+        client.force_authenticate(other)
+        self.order('shared')
+        self.assertNotIn('Idempotent-Replayed', self.order('shared', client=client))
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_failed_request_lets_go_of_the_key(self):
+        self.product.stock = 0
+        self.product.save()
+        self.assertEqual(self.order('order-1').status_code, 400)
+        self.product.stock = 5
+        self.product.save()
+        self.assertEqual(self.order('order-1').status_code, 201)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_abandoned_claim_is_taken_over_after_the_lease(self):
+        # the worker dies mid-request, the claim is left behind without a response
+        with patch.object(OrderSerializer, 'create', side_effect=SystemExit), self.assertRaises(SystemExit):
+            self.order('order-1')
+        self.assertEqual(self.order('order-1').status_code, 409)
+        IdempotencyKey.objects.filter(key='order-1').update(
+            created_at=timezone.now() - IdempotencyKey.lease() - timedelta(seconds=1))
+        retry = self.order('order-1')
+        self.assertEqual(retry.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', retry)
+        self.assertEqual(self.order('order-1')['Idempotent-Replayed'], 'true')
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_concurrent_duplicate_is_turned_away(self):
+        # the duplicate arrives while the first request is inside the serializer
+        duplicates = []
+        create = OrderSerializer.create
+
+        def create_with_duplicate(serializer, validated_data):
+            if not duplicates:
+                duplicates.append(self.order('order-1'))
+            return create(serializer, validated_data)
+
+        with patch.object(OrderSerializer, 'create', create_with_duplicate):
+            first = self.order('order-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(duplicates[0].status_code, 409)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.order('order-1').data['id'], first.data['id'])
+
+    def test_expired_keys(self):
+        self.order('order-1')
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        out = StringIO()
+        call_command('delete_expired_idempotency_keys', stdout=out)
+        self.assertIn('Deleted 1 expired', out.getvalue())
+        # an expired key places a new order
+        self.assertNotIn('Idempotent-Replayed', self.order('order-1'))
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_key_length(self):
+        self.assertEqual(self.order('x' * 256).status_code, 400)
+        self.assertEqual(Order.objects.count(), 0)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentIdempotencyTests(TransactionTestCase):
+    """Duplicates of one request racing each other place a single order."""
+
+    duplicates = 8
+
+    def setUp(self):
+        category = Category.objects.create(name='Bikes', description='All bikes')
+        self.product = Product.objects.create(
+            category=category, name='Bike', description='A bike', price=Decimal('250.00'), stock=10)
+        self.user = User.objects.create_user(username='rider', password='password123')
+        self.address = create_address(self.user)
+
+    def place_order(self, _):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        try:
+            response = client.post('/api/orders/', {
+                'shipping_address_id': self.address.id,
+                'items_data': [{'product': self.product.id, 'quantity': 1}],
+            }, format='json', HTTP_IDEMPOTENCY_KEY='same-order')
+            return response.status_code, response.data.get('id')
+        finally:
+            connections.close_all()
+
+    def test_one_order_for_every_duplicate(self):
+        with ThreadPoolExecutor(max_workers=self.duplicates) as pool:
+            results = list(pool.map(self.place_order, range(self.duplicates)))
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertLessEqual({status for status, _ in results}, {201, 409})
+        self.assertEqual({order_id for status, order_id in results if status == 201}, {Order.objects.get().pk})
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 9)
+
+
+class OrderCancelTests(TestCase):
+    """Cancelling puts every line back in stock with one statement, and only once."""
+
+    def setUp(self):
+        category = Category.objects.create(name='Plants', description='All plants')
+        self.user = User.objects.create_user(username='gardener', password='password123')
+        self.address = create_address(self.user)
+        self.products = [
+            Product.objects.create(
+                category=category, name=f'Plant {i}', description=f'Plant {i}', price=Decimal('12.00'), stock=20)
+            for i in range(10)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def place_order(self, products):
+        response = self.client.post('/api/orders/', {
+            'shipping_address_id': self.address.pk,
+            'items_data': [{'product': product.pk, 'quantity': 2} for product in products],
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return Order.objects.get(pk=response.data['id'])
+
+    def stock(self):
+        return list(Product.objects.order_by('pk').values_list('stock', flat=True))
+
+    def cancel(self, order):
+        return self.client.patch(f'/api/orders/{order.pk}/cancel/')
+
+    def test_stock_restored_in_constant_queries(self):
+        small, large = self.place_order(self.products[:2]), self.place_order(self.products)
+        counts = []
+        for order in (small, large):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.cancel(order)
+            self.assertEqual(response.data['order_status'], 'cancelled')
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(self.stock(), [20] * 10)
+
+    def test_double_cancel_restores_once(self):
+        order = self.place_order(self.products[:3])
+        self.cancel(order)
+        response = self.cancel(order)
+        self.assertEqual(response.data, {'message': 'Order is already cancelled.'})
+        self.assertEqual(Order.cancel([order.pk]), [])
+        self.assertEqual(self.stock(), [20] * 10)
+
+    def test_shipped_orders_keep_their_stock(self):
+        order = self.place_order(self.products[:1])
+        Order.objects.filter(pk=order.pk).update(order_status='shipped')
+        self.assertEqual(self.cancel(order).status_code, 400)
+        self.assertEqual(self.stock()[0], 18)
+
+    def test_only_cancellable_orders_of_a_batch(self):
+        orders = [self.place_order([product]) for product in self.products[:3]]
+        Order.objects.filter(pk=orders[1].pk).update(order_status='delivered')
+        self.assertEqual(Order.cancel([order.pk for order in orders]), [orders[0].pk, orders[2].pk])
+        self.assertEqual(self.stock()[:3], [20, 18, 20])
+
+    def test_stock_sold_meanwhile_is_kept(self):
+        order = self.place_order(self.products[:1])
+        cancel = Order.cancel.__func__
+
+        # another checkout takes 5 units after the view read the order and its products
+        def cancel_after_a_sale(cls, order_ids):
+            Product.objects.filter(pk=self.products[0].pk).update(stock=F('stock') - 5)
+            return cancel(cls, order_ids)
+
+        with patch.object(Order, 'cancel', classmethod(cancel_after_a_sale)):
+            self.cancel(order)
+        self.assertEqual(self.stock()[0], 15)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentCancelTests(TransactionTestCase):
+    """Cancels racing each other and checkouts never restore an order twice or lose an update."""
+
+    racers = 8
+
+    def setUp(self):
+        category = Category.objects.create(name='Plants', description='All plants')
+        self.product = Product.objects.create(
+            category=category, name='Fern', description='A fern', price=Decimal('12.00'), stock=100)
+        self.user = User.objects.create_user(username='gardener', password='password123')
+        self.address = create_address(self.user)
+        self.orders = []
+        for _ in range(self.racers):
+            order = Order.objects.create(
+                user=self.user, shipping_address=self.address, subtotal=Decimal('24.00'), total=Decimal('24.00'))
+            OrderItem.objects.create(order=order, product=self.product, quantity=2, price=Decimal('12.00'))
+            self.orders.append(order)
+        Product.objects.filter(pk=self.product.pk).update(stock=100 - 2 * self.racers)
+
+    def request(self, path, data=None):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        try:
+            if data is None:
+                return client.patch(path).status_code
+            return client.post(path, data, format='json').status_code
+        finally:
+            connections.close_all()
+
+    def test_same_order_cancelled_once(self):
+        path = f'/api/orders/{self.orders[0].pk}/cancel/'
+        with ThreadPoolExecutor(max_workers=self.racers) as pool:
+            statuses = list(pool.map(self.request, [path] * self.racers))
+        self.assertEqual(set(statuses), {200})
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 100 - 2 * self.racers + 2)
+
+    def test_cancels_and_checkouts_keep_every_update(self):
+        cancels = [(f'/api/orders/{order.pk}/cancel/', None) for order in self.orders]
+        orders = [('/api/orders/', {
+            'shipping_address_id': self.address.pk,
+            'items_data': [{'product': self.product.pk, 'quantity': 1}],
+        })] * self.racers
+        with ThreadPoolExecutor(max_workers=self.racers * 2) as pool:
+            statuses = list(pool.map(lambda request: self.request(*request), cancels + orders))
+        self.assertEqual(statuses, [200] * self.racers + [201] * self.racers)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 100 - self.racers)
+
+
+class OrderTransitionTests(TestCase):
+    """Orders only move along the transition table, one at a time or many at once."""
+
+    def setUp(self):
+        category = Category.objects.create(name='Shoes', description='All shoes')
+        self.product = Product.objects.create(
+            category=category, name='Boot', description='A boot', price=Decimal('80.00'), stock=100)
+        self.user = User.objects.create_user(username='walker', password='password123')
+        self.staff = User.objects.create_user(username='staff', password='password123', is_staff=True)
+        self.address = create_address(self.user)
+        self.orders = []
+        for _ in range(6):
+            order = Order.objects.create(
+                user=self.user, shipping_address=self.address, subtotal=Decimal('160.00'), total=Decimal('160.00'))
+            OrderItem.objects.create(order=order, product=self.product, quantity=2, price=Decimal('80.00'))
+            self.orders.append(order)
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def bulk(self, ids, **status):
+        return self.client.post('/api/orders/bulk_transition/', {'ids': ids, **status}, format='json')
+
+    def statuses(self, field='order_status'):
+        return list(Order.objects.order_by('pk').values_list(field, flat=True))
+
+    def test_update_follows_the_table(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = f'/api/orders/{self.orders[0].pk}/'
+        self.assertEqual(client.patch(url, {'order_status': 'shipped'}).status_code, 400)
+        self.assertEqual(client.patch(url, {'order_status': 'processing'}).status_code, 200)
+        self.assertEqual(client.patch(url, {'order_status': 'processing', 'notes': 'Ring twice'}).status_code, 200)
+        response = client.patch(url, {'order_status': 'cancelled'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cancel endpoint', str(response.data['order_status']))
+        self.assertEqual(client.patch(url, {'payment_status': 'refunded'}).status_code, 400)
+        self.assertEqual(client.patch(url, {'payment_status': 'paid'}).status_code, 200)
+
+    def test_bulk_results(self):
+        ids = [order.pk for order in self.orders]
+        Order.objects.filter(pk=ids[0]).update(order_status='delivered')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.bulk(ids + [ids[1], 999999], order_status='processing')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['updated'], response.data['failed']), (5, 2))
+        results = {result['id']: result for result in response.data['results']}
+        self.assertEqual(len(results), 7)
+        self.assertEqual(results[ids[0]]['status'], 'invalid')
+        self.assertEqual(results[ids[0]]['from'], 'delivered')
+        self.assertEqual(results[ids[1]], {'id': ids[1], 'status': 'updated', 'from': 'pending'})
+        self.assertEqual(results[999999]['status'], 'not_found')
+        self.assertEqual(self.statuses(), ['delivered'] + ['processing'] * 5)
+        # the locking read and the update, whatever the number of orders
+        self.assertEqual(len([query for query in queries if 'store_order"' in query['sql']]), 2)
+
+    def test_bulk_payment_status(self):
+        ids = [order.pk for order in self.orders]
+        self.bulk(ids[:3], payment_status='paid')
+        response = self.bulk(ids, payment_status='refunded')
+        self.assertEqual(response.data['updated'], 3)
+        self.assertEqual(self.statuses('payment_status'), ['refunded'] * 3 + ['unpaid'] * 3)
+
+    def test_bulk_cancel_restores_stock_once(self):
+        ids = [order.pk for order in self.orders]
+        Order.objects.filter(pk=ids[0]).update(order_status='shipped')
+        Product.objects.filter(pk=self.product.pk).update(stock=88)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.bulk(ids, order_status='cancelled')
+        self.assertEqual(response.data['updated'], 5)
+        self.assertEqual(self.bulk(ids, order_status='cancelled').data['updated'], 0)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 98)
+
+    def test_staff_only_and_validation(self):
+        ids = [order.pk for order in self.orders]
+        self.assertEqual(self.bulk(ids).status_code, 400)
+        self.assertEqual(self.bulk(ids, order_status='shipped', payment_status='paid').status_code, 400)
+        self.assertEqual(self.bulk(ids, order_status='lost').status_code, 400)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.bulk(ids, order_status='processing').status_code, 403)
+        self.assertEqual(self.statuses(), ['pending'] * 6)
+
+
+class SparseFieldsTests(TestCase):
+    """?fields= prunes responses and the columns read for them, ?expand= nests related objects in full."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.shopper, cls.catalog = seed_store(products=30, reviewers=3, orders=20)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.shopper)
+        # the category cache is filled by the first read
+        self.client.get('/api/categories/')
+
+    def get(self, path, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        return response, queries
+
+    def test_products_keep_only_the_requested_fields(self):
+        response, queries = self.get('/api/products/', {'fields': 'id,name,price'})
+        for product in response.data['results']:
+            self.assertEqual(set(product), {'id', 'name', 'price'})
+        full, full_queries = self.get('/api/products/')
+        self.assertLess(len(queries), len(full_queries))
+        self.assertLess(len(response.content), len(full.content))
+        # the page query itself leaves the unused columns out
+        page_query = next(query['sql'] for query in queries if '"store_product"."name"' in query['sql'])
+        self.assertNotIn('"store_product"."description"', page_query)
+        self.assertEqual(self.get(f'/api/products/{self.catalog[0].pk}/', {'fields': 'id,stock'})[0].data,
+                         {'id': self.catalog[0].pk, 'stock': 1000})
+
+    def test_computed_fields_still_read_their_columns(self):
+        response, _ = self.get('/api/products/', {'fields': 'id,available_stock,average_rating', 'ordering': 'id'})
+        product = Product.objects.get(pk=response.data['results'][0]['id'])
+        self.assertEqual(response.data['results'][0]['available_stock'], product.available_stock)
+        self.assertEqual(response.data['results'][0]['average_rating'], product.average_rating)
+        cursor, _ = self.get('/api/products/', {'fields': 'id', 'pagination': 'cursor', 'ordering': 'price'})
+        self.assertIsNotNone(self.get(cursor.data['next'])[0].data['results'])
+
+    def test_unknown_names_are_ignored(self):
+        response, _ = self.get('/api/categories/', {'fields': 'name,nope'})
+        self.assertEqual(set(response.data['results'][0]), {'name'})
+
+    def test_orders_skip_the_relations_they_dont_show(self):
+        response, queries = self.get('/api/orders/', {'fields': 'id,order_number,total'})
+        self.assertEqual(set(response.data['results'][0]), {'id', 'order_number', 'total'})
+        # count and orders, no items prefetch and no address joins
+        self.assertEqual(len(queries), 2)
+        self.assertFalse(any('store_address' in query['sql'] for query in queries))
+
+    def test_expand_nests_the_full_product(self):
+        response, queries = self.get('/api/orders/', {'fields': 'id,items', 'expand': 'product'})
+        item = response.data['results'][0]['items'][0]
+        self.assertEqual(item['product']['id'], OrderItem.objects.get(pk=item['id']).product_id)
+        self.assertIn('images', item['product'])
+        self.assertIn('average_rating', item['product'])
+        more, more_queries = self.get('/api/orders/', {'fields': 'id,items', 'expand': 'product', 'page_size': 20})
+        self.assertEqual(len(more_queries), len(queries))
+
+        review = self.get('/api/reviews/', {'expand': 'product', 'fields': 'id,product'})[0].data['results'][0]
+        self.assertEqual(review['product']['name'], Review.objects.get(pk=review['id']).product.name)
+        cart = self.get('/api/cart/my_cart/', {'expand': 'product'})[0].data
+        self.assertIn('name', cart['items'][0]['product'])
+
+    def test_writes_see_every_field(self):
+        Product.objects.filter(pk=self.catalog[0].pk).update(name='Old name')
+        response = self.client.patch(f'/api/products/{self.catalog[0].pk}/?fields=id', {'name': 'New name'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'id': self.catalog[0].pk})
+        self.assertEqual(Product.objects.get(pk=self.catalog[0].pk).name, 'New name')
+
+    def test_async_views_prune_alike(self):
+        for path, params in (
+            ('products/', {'fields': 'id,name,images'}),
+            ('products/', {'fields': 'id,price'}),
+            (f'products/{self.catalog[1].pk}/', {'fields': 'name'}),
+            (f'products/{self.catalog[1].pk}/reviews/', {'fields': 'rating'}),
+            ('categories/', {'fields': 'id,product_total'}),
+            ('reviews/', {'fields': 'id,title'}),
+        ):
+            expected = self.client.get(f'/api/{path}', params, format='json')
+            actual = self.client.get(f'/api/async/{path}', params)
+            self.assertEqual(json.loads(actual.content.replace(b'/api/async/', b'/api/')), json.loads(expected.content))
+
+
+class ORJSONTests(TestCase):
+    """The orjson renderer and parser send and read exactly what DRF's JSON classes do."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.shopper, cls.catalog = seed_store(products=30, reviewers=3, orders=10)
+        cls.shopper.is_staff = True
+        cls.shopper.save(update_fields=['is_staff'])
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.shopper)
+
+    def assertSameBytes(self, data, accepted_media_type=None, renderer_context=None):
+        expected = JSONRenderer().render(data, accepted_media_type, renderer_context)
+        self.assertEqual(ORJSONRenderer().render(data, accepted_media_type, renderer_context), expected)
+        return expected
+
+    def test_api_responses_render_the_same(self):
+        call_command('rebuild_sales_rollups', stdout=StringIO())
+        for path in (
+            '/api/products/', f'/api/products/{self.catalog[0].pk}/', f'/api/products/{self.catalog[0].pk}/reviews/',
+            '/api/orders/', '/api/reviews/', '/api/categories/', '/api/cart/my_cart/', '/api/analytics/sales/',
+        ):
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(ORJSONRenderer().render(response.data), response.content, path)
+
+    def test_python_types_render_the_same(self):
+        moment = datetime(2024, 5, 17, 9, 30, 15, 123456, tzinfo=dt_timezone.utc)
+        self.assertSameBytes({
+            'utc': moment, 'whole_second': moment.replace(microsecond=0), 'naive': moment.replace(tzinfo=None),
+            'offset': moment.astimezone(dt_timezone(timedelta(hours=2))), 'day': date(2024, 5, 17),
+            'time': clock(9, 30, 15, 5), 'price': Decimal('19.99'), 'uuid': uuid.uuid4(), 'lazy': gettext_lazy('Required'),
+            1: 'int key', 'text': 'caf\u00e9 \u2028 \u2029 \u2603', 'nested': [{'empty': None, 'flag': True, 'ratio': 0.1}],
+        })
+        self.assertSameBytes({'huge': 2 ** 70})
+        with patch('store.renderers.orjson.dumps') as dumps:
+            self.assertSameBytes({'a': [1, {'b': 2}, []]}, 'application/json; indent=2')
+            self.assertSameBytes({'a': [1, {'b': 2}, []]}, renderer_context={'indent': 4})
+        dumps.assert_not_called()
+        self.assertEqual(ORJSONRenderer().render(None), b'')
+
+    def test_parser(self):
+        body = '{"name": "caf\u00e9", "price": 1.5, "tags": [1, null, true]}'
+        parsed = ORJSONParser().parse(BytesIO(body.encode()))
+        self.assertEqual(parsed, JSONParser().parse(BytesIO(body.encode())))
+        self.assertEqual(ORJSONParser().parse(BytesIO(body.encode('latin-1')), parser_context={'encoding': 'latin-1'}), parsed)
+        for invalid in (b'{"name": ', b'{"price": NaN}', b'\xff'):
+            with self.assertRaises(ParseError):
+                ORJSONParser().parse(BytesIO(invalid))
+
+    def test_views_with_orjson(self):
+        product = self.catalog[0]
+        view = ProductViewSet.as_view(
+            {'get': 'retrieve', 'patch': 'partial_update'}, renderer_classes=[ORJSONRenderer], parser_classes=[ORJSONParser])
+        request = APIRequestFactory().patch(
+            f'/api/products/{product.pk}/', '{"name": "Renamed", "price": "12.50"}', content_type='application/json')
+        force_authenticate(request, self.shopper)
+        response = view(request, pk=product.pk)
+        response.render()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['price'], '12.50')
+        self.assertEqual(Product.objects.get(pk=product.pk).name, 'Renamed')
+
+        request = APIRequestFactory().patch(f'/api/products/{product.pk}/', '{"name": ', content_type='application/json')
+        force_authenticate(request, self.shopper)
+        response = view(request, pk=product.pk)
+        self.assertEqual(response.status_code, 400)
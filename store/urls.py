@@ -1,5 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter # type: ignore
+from . import async_views
 from .views import (
     UserRegisterView,
     UserViewSet,
@@ -10,6 +11,7 @@ from .views import (
     ReviewViewSet,
     OrderViewSet,
     AddressViewSet,
+    AnalyticsViewSet,
 )
 
 router = DefaultRouter()
@@ -21,9 +23,16 @@ router.register(r'cart', CartViewSet, basename='cart')
 router.register(r'orders', OrderViewSet, basename='order')
 router.register(r'addresses', AddressViewSet, basename='address')
 router.register(r'reviews', ReviewViewSet, basename='review')
+router.register(r'analytics', AnalyticsViewSet, basename='analytics')
 
 urlpatterns = [
     path('register/', UserRegisterView.as_view(), name='user-register-view'),
+    # async reads of the catalog, for deployments under an ASGI server
+    path('async/products/', async_views.product_list, name='async-product-list'),
+    path('async/products/<int:pk>/', async_views.product_detail, name='async-product-detail'),
+    path('async/products/<int:pk>/reviews/', async_views.product_reviews, name='async-product-reviews'),
+    path('async/categories/', async_views.category_list, name='async-category-list'),
+    path('async/reviews/', async_views.review_list, name='async-review-list'),
     path('', include(router.urls)),
 ]
 
@@ -1,12 +1,29 @@
 from django.shortcuts import render  # type: ignore
 from rest_framework import generics, permissions, status, viewsets, filters # type: ignore
 from rest_framework.decorators import action # type: ignore
+from rest_framework.exceptions import ValidationError # type: ignore
 from rest_framework.response import Response # type: ignore
 from rest_framework_simplejwt.tokens import RefreshToken # type: ignore
-from .serializers import UserRegistrationSerializer, UserSerializer, CategorySerializer, ProductSerializer, ReviewSerializer, ProductImageSerializer,AddressSerializer, OrderSerializer, CartSerializer
-from .models import User, Category, Cart, CartItem, Product, ProductImage, Address, Order, OrderItem, Review
-from rest_framework.pagination import PageNumberPagination # type: ignore
+from .serializers import DynamicFieldsMixin, UserRegistrationSerializer, UserSerializer, CategorySerializer, ProductSerializer, ReviewSerializer, ProductImageSerializer,AddressSerializer, OrderSerializer, CartSerializer, CartAddItemSerializer, CartUpdateItemSerializer, CartBatchSerializer, ProductBulkUpdateSerializer, OrderBulkTransitionSerializer
+from .models import User, Category, Cart, CartItem, Product, ProductImage, Address, Order, OrderItem, Review, StockReservation, DailyCategorySales, DailyProductSales
+from rest_framework.pagination import CursorPagination, PageNumberPagination # type: ignore
 from django_filters.rest_framework import DjangoFilterBackend # type: ignore
+from django.db import transaction # type: ignore
+from django.db.models import Case, Count, DecimalField, F, FloatField, Max, Prefetch, Sum, Value, When # type: ignore
+from django.db.models.functions import Cast, Coalesce, NullIf # type: ignore
+from django.http import StreamingHttpResponse # type: ignore
+from django.utils.cache import get_conditional_response # type: ignore
+from django.utils.dateparse import parse_date # type: ignore
+from django.utils.http import http_date, quote_etag # type: ignore
+from django.utils import timezone # type: ignore
+from datetime import datetime, timedelta
+from hashlib import md5
+from .cache import get_category_version, invalidate_categories
+from .search import ProductSearchFilter
+from .exports import CONTENT_TYPES, EXPORTERS
+from .idempotency import idempotent
+from .tasks import orders_cancelled
+from . import analytics
 
 def get_token_for_user(user):
     refresh = RefreshToken.for_user(user)
@@ -25,6 +42,127 @@ class ProductPagination(PageNumberPagination):
     page_size_query_param = 'page_size'
     max_page_size = 30
 
+# keyset pages over (-created_at, -id), no COUNT and no OFFSET however deep the client goes
+class ResultCursorPagination(CursorPagination):
+    page_size = 15
+    page_size_query_param = 'page_size'
+    max_page_size = 50
+    ordering = ('-created_at', '-id')
+    
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        # ties on the first field are broken by id so every row keeps one place in the sequence
+        if not any(field.lstrip('-') in ('id', 'pk') for field in ordering):
+            ordering = ordering + ('-id' if ordering[0].startswith('-') else 'id',)
+        return ordering
+
+class ProductCursorPagination(ResultCursorPagination):
+    page_size = 10
+    max_page_size = 30
+
+class CursorPaginationMixin:
+    """
+    Lets clients opt into cursor pagination with ?pagination=cursor, the returned next/previous
+    links carry a ?cursor= parameter. Without either parameter the page number pagination is used.
+    """
+    cursor_pagination_class = None
+    
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            pagination_class = self.pagination_class
+            if self.cursor_pagination_class and ('cursor' in params or params.get('pagination') == 'cursor'):
+                pagination_class = self.cursor_pagination_class
+            self._paginator = pagination_class() if pagination_class else None
+        return self._paginator
+
+def field_names(value):
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+def requested_fields(request):
+    """The names in ?fields=, None when every field is wanted."""
+    fields = request.query_params.get('fields', '') if request else ''
+    return field_names(fields) or None
+
+class FieldsMixin:
+    """
+    ?fields=id,name keeps only those fields of every object in the response and ?expand=product
+    shows a related object in full instead of its id or summary, see DynamicFieldsMixin.
+    Reads also leave out the columns nobody asked for, get_queryset uses wants() to skip
+    the joins and prefetches of fields that aren't shown.
+    """
+    
+    def requested_fields(self):
+        return requested_fields(self.request)
+    
+    def expanded_fields(self):
+        return field_names(self.request.query_params.get('expand', '')) if self.request else set()
+    
+    def wants(self, name):
+        fields = self.requested_fields()
+        return fields is None or name in fields
+    
+    def get_serializer(self, *args, **kwargs):
+        if issubclass(self.get_serializer_class(), DynamicFieldsMixin):
+            kwargs.setdefault('fields', self.requested_fields())
+        return super().get_serializer(*args, **kwargs)
+    
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['expand'] = self.expanded_fields()
+        return context
+    
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        fields = self.requested_fields()
+        serializer_class = self.get_serializer_class()
+        # writes and the extra actions, which serialize something else than the queryset's rows, are left alone
+        if fields is None or self.action not in ('list', 'retrieve'):
+            return queryset
+        if not issubclass(serializer_class, DynamicFieldsMixin) or serializer_class.Meta.model is not queryset.model:
+            return queryset
+        # pagination cursors are read from the ordering columns, they stay loaded
+        ordering = [*(getattr(self, 'ordering', None) or ()), *(getattr(self, 'ordering_fields', None) or ())]
+        deferred = serializer_class.deferrable_columns(fields) - {name.lstrip('-') for name in ordering}
+        return queryset.defer(*deferred) if deferred else queryset
+
+def cache_validators(version):
+    # version is an (etag, last_modified) pair, both parts may be None
+    etag, last_modified = version
+    etag = quote_etag(md5(etag.encode()).hexdigest()) if etag else None
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    return etag, timestamp
+
+def set_cache_validators(response, etag, timestamp):
+    if etag:
+        response['ETag'] = etag
+    if timestamp:
+        response['Last-Modified'] = http_date(timestamp)
+    return response
+
+def conditional_response(request, version, render):
+    """
+    Answer 304 Not Modified when the client already has this version, otherwise call render.
+    version is an (etag, last_modified) pair, both parts may be None.
+    """
+    etag, timestamp = cache_validators(version)
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = render()
+    return set_cache_validators(response, etag, timestamp)
+
+VERSION_AGGREGATES = {'last_modified': Max('updated_at'), 'total': Count('pk')}
+
+def stats_version(stats, extra):
+    etag = ':'.join(str(part) for part in (stats['total'], stats['last_modified'], *(e for e, _ in extra)))
+    last_modified = max(filter(None, (stats['last_modified'], *(l for _, l in extra))), default=None)
+    return etag, last_modified
+
+def queryset_version(queryset, *extra):
+    # newest updated_at and row count of the filtered rows, plus the versions it depends on
+    return stats_version(queryset.order_by().aggregate(**VERSION_AGGREGATES), extra)
+
 class UserRegisterView(generics.GenericAPIView):
     """
     API Endpoint for registering.
@@ -45,7 +183,7 @@ class UserRegisterView(generics.GenericAPIView):
             'refresh': tokens['refresh'],
         }, status=status.HTTP_201_CREATED)
            
-class UserViewSet(viewsets.ReadOnlyModelViewSet):
+class UserViewSet(FieldsMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing user profiles.
     
@@ -67,7 +205,7 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
         serializer = self.get_serializer(request.user)
         return Response(serializer.data)
     
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(FieldsMixin, viewsets.ModelViewSet):
     """
     API endpoint for managing product categories.
     
@@ -97,8 +235,13 @@ class CategoryViewSet(viewsets.ModelViewSet):
     ordering_fields = ['name', 'description']
     search_fields = ['name', 'created_at']
     ordering = ['name']
+    
+    # every category is in the category cache, so revalidating the list costs no query
+    def list(self, request, *args, **kwargs):
+        return conditional_response(
+            request, get_category_version(), lambda: super(CategoryViewSet, self).list(request, *args, **kwargs))
 
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(FieldsMixin, CursorPaginationMixin, viewsets.ModelViewSet):
     """
     API endpoint for managing products.
     
@@ -125,12 +268,18 @@ class ProductViewSet(viewsets.ModelViewSet):
     
     reviews:
     Get all reviews for a specific product.
+    
+    bulk_update:
+    Change price, stock and/or is_available of many products at once. Send a list of
+    {"id", "price", "stock", "is_available"} objects, every object gets a status back. Staff only.
     """
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     pagination_class = ProductPagination
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    cursor_pagination_class = ProductCursorPagination
+    # search runs last so it can put the best matches first when no ordering is asked for
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter, ProductSearchFilter]
     
     filterset_fields = {
         'category': ['exact'], #here i'm allowing users search for the exact category id
@@ -139,12 +288,22 @@ class ProductViewSet(viewsets.ModelViewSet):
         'stock': ['gte', 'lte'], #allows filtering by stock quantity
     }
     
-    ordering_fields = ['price','created_at','name','stock']
+    ordering_fields = ['price','created_at','name','stock','rating']
     search_fields = ['name', 'description']
     ordering = ['-created_at']
     
     def get_queryset(self):
-        queryset = super().get_queryset()
+        # everything the serializer reads is loaded here, so a page costs the same number of queries whatever its size
+        queryset = super().get_queryset().annotate(
+            # average from the stored totals, used for ?ordering=rating
+            rating=Coalesce(
+                Cast('rating_sum', FloatField()) / NullIf(F('rating_count'), 0), 0.0,
+                output_field=FloatField(),
+            ),
+        )
+        # the reviews action only needs the product row
+        if self.action != 'reviews' and self.wants('images'):
+            queryset = queryset.prefetch_related('images')
         # Custom filter to filter by price range
         min_price = self.request.query_params.get('min_price')
         max_price = self.request.query_params.get('max_price')
@@ -155,6 +314,12 @@ class ProductViewSet(viewsets.ModelViewSet):
         
         return queryset
     
+    # clients polling the list get a 304 without the page being serialized again
+    def list(self, request, *args, **kwargs):
+        version = queryset_version(self.filter_queryset(self.get_queryset()), get_category_version())
+        return conditional_response(
+            request, version, lambda: super(ProductViewSet, self).list(request, *args, **kwargs))
+    
     @action(detail=False, methods=['get'])
     # here i'm creating an endpoint 'featured', to return the 10 most recently added products
     def featured(self, request):
@@ -162,15 +327,80 @@ class ProductViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(featured_products, many=True)
         return Response(serializer.data)
     
+    # rows written by one UPDATE statement, keeps the CASE expressions within the database's parameter limits
+    bulk_update_batch_size = 250
+    bulk_update_max_rows = 5000
+    
+    @action(detail=False, methods=['post'], permission_classes=[permissions.IsAdminUser])
+    @transaction.atomic
+    def bulk_update(self, request):
+        rows = request.data
+        if not isinstance(rows, list):
+            return Response(
+                {'error': 'Send a list of {"id", "price", "stock", "is_available"} objects.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(rows) > self.bulk_update_max_rows:
+            return Response(
+                {'error': f'At most {self.bulk_update_max_rows} rows per request.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # every row is validated on its own, a bad row doesn't stop the others
+        validator = ProductBulkUpdateSerializer()
+        results = []
+        changes = {}
+        for index, row in enumerate(rows):
+            try:
+                data = validator.run_validation(row)
+            except ValidationError as exc:
+                row_id = row.get('id') if isinstance(row, dict) else None
+                results.append({'index': index, 'id': row_id, 'status': 'invalid', 'errors': exc.detail})
+                continue
+            product_id = data.pop('id')
+            # repeated ids are merged, later rows win
+            changes.setdefault(product_id, {}).update(data)
+            results.append({'index': index, 'id': product_id, 'status': None})
+        
+        existing = set(Product.objects.filter(pk__in=changes).values_list('pk', flat=True))
+        ids = sorted(existing)
+        now = timezone.now()
+        for start in range(0, len(ids), self.bulk_update_batch_size):
+            batch = ids[start:start + self.bulk_update_batch_size]
+            # one CASE per changed column, rows that don't send a column keep their value
+            columns = {}
+            for field in ('price', 'stock', 'is_available'):
+                whens = [When(pk=pk, then=Value(changes[pk][field])) for pk in batch if field in changes[pk]]
+                if whens:
+                    columns[field] = Case(*whens, default=F(field), output_field=Product._meta.get_field(field))
+            Product.objects.filter(pk__in=batch).update(updated_at=now, **columns)
+        
+        for result in results:
+            if result['status'] is None:
+                result['status'] = 'updated' if result['id'] in existing else 'not_found'
+        # availability feeds the category totals, the cache is dropped once for the whole request
+        if ids:
+            invalidate_categories()
+        
+        return Response({
+            'updated': sum(result['status'] == 'updated' for result in results),
+            'failed': sum(result['status'] != 'updated' for result in results),
+            'results': results,
+        })
+    
     @action(detail=True, methods=['get'])
     def reviews(self, request, pk=None):
         # here i'm getting all the reviews for a specific product
         product = self.get_object()
-        reviews = product.reviews.all()
-        serializer = ReviewSerializer(reviews, many=True)
-        return Response(serializer.data)
-    
-class ProductImageViewset(viewsets.ModelViewSet):
+        reviews = product.reviews.select_related('user', 'product')
+        if 'product' in self.expanded_fields():
+            reviews = reviews.prefetch_related('product__images')
+        version = queryset_version(reviews, (str(product.updated_at), product.updated_at))
+        serializer = ReviewSerializer(
+            reviews, many=True, fields=self.requested_fields(), context=self.get_serializer_context())
+        return conditional_response(request, version, lambda: Response(serializer.data))
+    
+class ProductImageViewset(FieldsMixin, viewsets.ModelViewSet):
     """
     API endpoint for managing product images.
     
@@ -198,7 +428,7 @@ class ProductImageViewset(viewsets.ModelViewSet):
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['product']
     
-class AddressViewSet(viewsets.ModelViewSet):
+class AddressViewSet(FieldsMixin, viewsets.ModelViewSet):
     """
     API endpoint for managing user addresses.
     
@@ -232,7 +462,7 @@ class AddressViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         return Address.objects.filter(user=self.request.user)
     
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(FieldsMixin, CursorPaginationMixin, viewsets.ModelViewSet):
     """
     API endpoint for managing orders.
     
@@ -244,6 +474,7 @@ class OrderViewSet(viewsets.ModelViewSet):
     create:
     Create a new order manually (alternative to checkout). Requires authentication.
     Automatically calculates totals and reduces stock.
+    Send an Idempotency-Key header to make retries return the first order instead of placing another.
     
     retrieve:
     Get details of a specific order including all items. Requires authentication and ownership.
@@ -259,10 +490,19 @@ class OrderViewSet(viewsets.ModelViewSet):
     
     cancel:
     Cancel an order and restore product stock. Only pending/processing orders can be cancelled.
+    
+    bulk_transition:
+    Staff only. Move many orders to one order_status or payment_status, {"ids": [...], "order_status": "shipped"}.
+    Only the moves of Order.TRANSITIONS are applied, every id gets a result, cancellations restore stock.
+    
+    export:
+    Download the whole order history as ?output=csv (one line per item) or ?output=ndjson (one order per line),
+    optionally between ?created_after= and ?created_before= dates. Staff can add ?all=true for every user's orders.
     """
     serializer_class = OrderSerializer
     permission_classes = [permissions.IsAuthenticated]
     pagination_class = ResultPagination
+    cursor_pagination_class = ResultCursorPagination
     filter_backends = [filters.OrderingFilter, DjangoFilterBackend]
     filterset_fields = ['order_status', 'payment_status']
     ordering_fields = ['created_at', 'total']
@@ -270,38 +510,128 @@ class OrderViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         # Users can only see their own orders
-        return Order.objects.filter(user=self.request.user)
+        queryset = Order.objects.filter(user=self.request.user)
+        # the export reads its own columns
+        if self.action == 'export':
+            return queryset
+        # everything the serializer shows is loaded here, so a page costs the same number of queries whatever its size
+        related = {'user_info': 'user', 'shipping_address': 'shipping_address', 'billing_address': 'billing_address'}
+        related = [relation for field, relation in related.items() if self.wants(field)]
+        if related:
+            queryset = queryset.select_related(*related)
+        if self.wants('items'):
+            items = OrderItem.objects.select_related('product', 'productimage').order_by('id')
+            if 'product' in self.expanded_fields():
+                items = items.prefetch_related('product__images')
+            queryset = queryset.prefetch_related(Prefetch('items', queryset=items))
+        if self.wants('item_count'):
+            queryset = queryset.annotate(item_count=Count('items'))
+        return queryset
+    
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
     
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
     
+    # streamed instead of paginated, the history can be any size
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        params = request.query_params
+        output = params.get('output', 'csv')
+        if output not in EXPORTERS:
+            return Response(
+                {'error': f'output must be one of {", ".join(EXPORTERS)}.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if params.get('all') == 'true':
+            if not request.user.is_staff:
+                return Response(
+                    {'error': 'Only staff can export every order.'},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            queryset = Order.objects.all()
+        else:
+            queryset = self.get_queryset()
+        
+        # whole days in the current time zone, both ends included
+        for param, lookup, days in (('created_after', 'created_at__gte', 0), ('created_before', 'created_at__lt', 1)):
+            if not params.get(param):
+                continue
+            try:
+                day = parse_date(params[param])
+            except ValueError:
+                day = None
+            if day is None:
+                return Response(
+                    {'error': f'{param} must be a date like 2024-11-28.'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            start = timezone.make_aware(datetime.combine(day + timedelta(days=days), datetime.min.time()))
+            queryset = queryset.filter(**{lookup: start})
+        
+        response = StreamingHttpResponse(EXPORTERS[output](queryset), content_type=CONTENT_TYPES[output])
+        extension = 'csv' if output == 'csv' else 'ndjson'
+        response['Content-Disposition'] = f'attachment; filename="orders-{timezone.localdate():%Y%m%d}.{extension}"'
+        return response
+    
+    @action(detail=False, methods=['post'], permission_classes=[permissions.IsAdminUser])
+    def bulk_transition(self, request):
+        serializer = OrderBulkTransitionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids, field, target = (serializer.validated_data[name] for name in ('ids', 'field', 'target'))
+        
+        # staff move any user's orders, one locking read and one conditional update for all of them
+        current, moved = Order.transition(ids, field, target)
+        if field == 'order_status' and target == 'cancelled' and moved:
+            orders_cancelled(moved)
+        
+        moved = set(moved)
+        results = []
+        for order_id in dict.fromkeys(ids):
+            if order_id in moved:
+                results.append({'id': order_id, 'status': 'updated', 'from': current[order_id]})
+            elif order_id in current:
+                results.append({
+                    'id': order_id, 'status': 'invalid', 'from': current[order_id],
+                    'error': f'An order can not go from {current[order_id]} to {target}.',
+                })
+            else:
+                results.append({'id': order_id, 'status': 'not_found'})
+        return Response({
+            'updated': len(moved),
+            'failed': len(results) - len(moved),
+            'results': results,
+        })
+    
     #here i'm creating a custom endpoint called cancel, accepting only PATCH requests
     @action(detail=True, methods=['patch'])
     def cancel(self, request, pk=None):
-        order = self.get_object()   
-        if order.order_status == 'cancelled':
+        order = self.get_object()
+        cancelled = Order.cancel([order.pk])
+        # the sales rollups drop the order, it is committed by now
+        if cancelled:
+            orders_cancelled(cancelled)
+        # a concurrent request may have changed the status since the order was read
+        order.refresh_from_db(fields=['order_status', 'updated_at'])
+        if not cancelled and order.order_status == 'cancelled':
             return Response(
                 {'message': 'Order is already cancelled.'},
                 status=status.HTTP_200_OK
-            )    
-        if order.order_status in ['shipped', 'delivered']:
+            )
+        if not cancelled:
             return Response(
                 {'error': 'You can not cancel an order that has been shipped or delivered.'},
                 status=status.HTTP_400_BAD_REQUEST
-            )       
-        order.order_status = 'cancelled'
-        order.save()
-        
-        # Restore cancelled order to the stock
-        for item in order.items.all():
-            item.product.stock = item.product.stock + item.quantity
-            item.product.save()
+            )
         
         serializer = self.get_serializer(order)
         return Response(serializer.data)
 
 
-class CartViewSet(viewsets.GenericViewSet):
+class CartViewSet(FieldsMixin, viewsets.GenericViewSet):
     """
     API endpoint for managing shopping cart.
     
@@ -312,9 +642,11 @@ class CartViewSet(viewsets.GenericViewSet):
     
     my_cart:
     Get the current user's cart with all items and totals.
+    Items show a short product summary, add ?expand=product to any cart endpoint for the full product.
     
     add_item:
     Add an item to the cart. If item already exists, increases quantity.
+    The quantity is held for the cart for a limited time so it can't be sold to someone else.
     
     update_item:
     Update the quantity of an item in the cart. Set quantity to 0 to remove.
@@ -322,11 +654,15 @@ class CartViewSet(viewsets.GenericViewSet):
     remove_item:
     Remove a specific item from the cart.
     
+    batch:
+    Apply a list of add/update/remove operations by product_id in one go, all of them or none.
+    
     clear:
     Remove all items from the cart.
     
     checkout:
     Create an order from cart items and clear the cart.
+    Send an Idempotency-Key header to make retries return the first order instead of placing another.
     """
     serializer_class = CartSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -339,19 +675,35 @@ class CartViewSet(viewsets.GenericViewSet):
         cart, created = Cart.objects.get_or_create(user=self.request.user)
         return cart
     
+    def cart_data(self, cart):
+        # the cart with its totals summed in SQL plus one query for all the lines, whatever the cart size
+        items = CartItem.objects.select_related('product').order_by('id')
+        if 'product' in self.expanded_fields():
+            items = items.prefetch_related('product__images')
+        cart = Cart.objects.annotate(
+            items_quantity=Coalesce(Sum('items__quantity'), 0),
+            items_price=Coalesce(
+                Sum(F('items__quantity') * F('items__product__price'), output_field=DecimalField()),
+                Value(0), output_field=DecimalField(),
+            ),
+        ).prefetch_related(Prefetch('items', queryset=items)).get(pk=cart.pk)
+        return self.get_serializer(cart).data
+    
     # Get current user's cart
     @action(detail=False, methods=['get'])
     def my_cart(self, request):
         cart = self.get_object()
-        serializer = self.get_serializer(cart)
-        return Response(serializer.data)
+        return Response(self.cart_data(cart))
     
     @action(detail=False, methods=['post'])
+    @transaction.atomic
     def add_item(self, request):
         """Add item to cart"""
         cart = self.get_object()
-        product_id = request.data.get('product_id')
-        quantity = request.data.get('quantity', 1)
+        serializer = CartAddItemSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        product_id = serializer.validated_data['product_id']
+        quantity = serializer.validated_data['quantity']
         
         try:
             product = Product.objects.get(id=product_id)
@@ -368,37 +720,38 @@ class CartViewSet(viewsets.GenericViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Check stock
-        if product.stock < quantity:
+        # Check stock by holding it, the hold covers the whole quantity of the product in the cart
+        cart_item = CartItem.objects.filter(cart=cart, product=product).first()
+        held_quantity = quantity + (cart_item.quantity if cart_item else 0)
+        if not StockReservation.reserve(cart, product, held_quantity):
+            product.refresh_from_db(fields=['stock', 'reserved_stock'])
             return Response(
-                {'error': f'Insufficient stock. Available: {product.stock}'},
+                {'error': f'Insufficient stock. Available: {product.available_stock}'},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
         # Add or update cart item
-        cart_item, created = CartItem.objects.get_or_create(
-            cart=cart,
-            product=product,
-            defaults={'quantity': quantity}
-        )
-        
-        if not created:
-            cart_item.quantity += quantity
+        if cart_item is None:
+            CartItem.objects.create(cart=cart, product=product, quantity=quantity)
+        else:
+            cart_item.quantity = held_quantity
             cart_item.save()
         
-        serializer = self.get_serializer(cart)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response(self.cart_data(cart), status=status.HTTP_200_OK)
     
     # Creating an ednpoint 'update_item' to change the quantity of an item in the cart
     @action(detail=False, methods=['patch'])
+    @transaction.atomic
     def update_item(self, request):
         cart = self.get_object()
-        item_id = request.data.get('item_id')
-        quantity = request.data.get('quantity')
+        serializer = CartUpdateItemSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        item_id = serializer.validated_data['item_id']
+        quantity = serializer.validated_data['quantity']
         
         # i included this try except block, to 
         try:
-            cart_item = CartItem.objects.get(cart=cart, id=item_id)
+            cart_item = CartItem.objects.select_related('product').get(cart=cart, id=item_id)
         except CartItem.DoesNotExist:
             return Response(
                 {'error': 'Cart item not found.'},
@@ -406,28 +759,31 @@ class CartViewSet(viewsets.GenericViewSet):
             )
         
         if quantity <= 0:
+            StockReservation.reserve(cart, cart_item.product, 0)
             cart_item.delete()
         else:
-            # Check stock
-            if cart_item.product.stock < quantity:
+            # Check stock by moving the hold to the new quantity
+            if not StockReservation.reserve(cart, cart_item.product, quantity):
+                cart_item.product.refresh_from_db(fields=['stock', 'reserved_stock'])
                 return Response(
-                    {'error': f'Insufficient stock. Available: {cart_item.product.stock}'},
+                    {'error': f'Insufficient stock. Available: {cart_item.product.available_stock}'},
                     status=status.HTTP_400_BAD_REQUEST
                 )
             cart_item.quantity = quantity
             cart_item.save()
         
-        serializer = self.get_serializer(cart)
-        return Response(serializer.data)
+        return Response(self.cart_data(cart))
     
     #creating an endpoint to delete an item from the cart, using it's item_id
     @action(detail=False, methods=['delete'])
+    @transaction.atomic
     def remove_item(self, request):
         cart = self.get_object()
         item_id = request.data.get('item_id')
         
         try:
-            cart_item = CartItem.objects.get(cart=cart, id=item_id)
+            cart_item = CartItem.objects.select_related('product').get(cart=cart, id=item_id)
+            StockReservation.reserve(cart, cart_item.product, 0)
             cart_item.delete()
         except CartItem.DoesNotExist:
             return Response(
@@ -435,41 +791,104 @@ class CartViewSet(viewsets.GenericViewSet):
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        serializer = self.get_serializer(cart)
-        return Response(serializer.data)
+        return Response(self.cart_data(cart))
+    
+    # one request for a whole list of cart changes, e.g. a client syncing an offline cart
+    @action(detail=False, methods=['post'])
+    @transaction.atomic
+    def batch(self, request):
+        cart = self.get_object()
+        serializer = CartBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        
+        items = {item.product_id: item for item in cart.items.all()}
+        current = {product_id: item.quantity for product_id, item in items.items()}
+        quantities = {
+            product_id: quantity
+            for product_id, quantity in serializer.get_quantities(current).items()
+            if quantity != current.get(product_id, 0)
+        }
+        
+        # every product the batch touches is checked at once, nothing is written if one of them fails
+        products = Product.objects.in_bulk(quantities)
+        errors = {}
+        for product_id, quantity in quantities.items():
+            product = products.get(product_id)
+            if product is None:
+                errors[product_id] = 'Product not found.'
+            elif quantity > current.get(product_id, 0) and not product.is_available:
+                errors[product_id] = 'Product is not available.'
+        if not errors:
+            shortages = StockReservation.reserve_many(cart, quantities)
+            errors = {
+                product_id: f'Insufficient stock. Available: {available}'
+                for product_id, available in shortages.items()
+            }
+        if errors:
+            return Response({'errors': errors}, status=status.HTTP_400_BAD_REQUEST)
+        
+        created, updated, removed = [], [], []
+        for product_id, quantity in quantities.items():
+            item = items.get(product_id)
+            if quantity <= 0:
+                removed.append(item.pk)
+            elif item is None:
+                created.append(CartItem(cart=cart, product_id=product_id, quantity=quantity))
+            else:
+                item.quantity = quantity
+                updated.append(item)
+        if removed:
+            CartItem.objects.filter(pk__in=removed).delete()
+        if updated:
+            # bulk_update skips auto_now, the timestamp is set by hand
+            now = timezone.now()
+            for item in updated:
+                item.updated_at = now
+            CartItem.objects.bulk_update(updated, ['quantity', 'updated_at'])
+        if created:
+            CartItem.objects.bulk_create(created)
+        
+        return Response(self.cart_data(cart))
     
     # creating an endpoint clear, accepting DELETE requests to delete every object in the cart
     @action(detail=False, methods=['delete'])
+    @transaction.atomic
     def clear(self, request):
         cart = self.get_object()
+        StockReservation.release(cart.reservations.all())
         cart.items.all().delete()
-        serializer = self.get_serializer(cart)
-        return Response(serializer.data)
+        return Response(self.cart_data(cart))
     
-    # an endoint to create order from current cart
+    # an endoint to create order from current cart, retries with the same Idempotency-Key get the first order back
     @action(detail=False, methods=['post'])
+    @idempotent
+    @transaction.atomic
     def checkout(self, request):
         cart = Cart.objects.get(user=request.user)
         # Convert cart items to order items format
         items_data = [
-            {'product': item.product.id, 'quantity': item.quantity}
-            for item in cart.items.all()
+            {'product': product_id, 'quantity': quantity}
+            for product_id, quantity in cart.items.values_list('product_id', 'quantity')
         ]
         order_data = {
             'shipping_address_id': request.data.get('shipping_address_id'),
-            'billing_address_id': request.data.get('billing_address_id'),
             'shipping_cost': request.data.get('shipping_cost', 0),
             'items_data': items_data
         }
-        serializer = OrderSerializer(data=order_data, context={'request': request})
+        # billing address is optional, the serializer falls back to the shipping address
+        if request.data.get('billing_address_id'):
+            order_data['billing_address_id'] = request.data.get('billing_address_id')
+        # passing the cart lets the serializer turn its holds into the order
+        serializer = OrderSerializer(data=order_data, context={'request': request, 'cart': cart})
         serializer.is_valid(raise_exception=True)
         order = serializer.save()
         # Clearing cart after checkout
+        StockReservation.release(cart.reservations.all())
         cart.items.all().delete()
         return Response(OrderSerializer(order).data, status=status.HTTP_201_CREATED)
 
 
-class ReviewViewSet(viewsets.ModelViewSet):
+class ReviewViewSet(FieldsMixin, CursorPaginationMixin, viewsets.ModelViewSet):
     """
     API endpoint for managing product reviews.
     
@@ -498,13 +917,21 @@ class ReviewViewSet(viewsets.ModelViewSet):
     serializer_class = ReviewSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     pagination_class = ResultPagination
+    cursor_pagination_class = ResultCursorPagination
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['product', 'rating']
     ordering_fields = ['created_at', 'rating']
     ordering = ['-created_at']
     
     def get_queryset(self):
+        # the serializer shows the author and the product name of every review
         queryset = super().get_queryset()
+        if self.wants('user_info'):
+            queryset = queryset.select_related('user')
+        if self.wants('product_name') or 'product' in self.expanded_fields():
+            queryset = queryset.select_related('product')
+        if 'product' in self.expanded_fields() and self.wants('product'):
+            queryset = queryset.prefetch_related('product__images')
         
         # Here i'm filtering reviews by product
         product_id = self.request.query_params.get('product_id', None)
@@ -513,5 +940,102 @@ class ReviewViewSet(viewsets.ModelViewSet):
         
         return queryset
     
+    # the product rating totals are updated in the same transaction as the review itself
+    @transaction.atomic
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
\ No newline at end of file
+        review = serializer.save(user=self.request.user)
+        Product.adjust_rating(review.product_id, review.rating, 1)
+    
+    @transaction.atomic
+    def perform_update(self, serializer):
+        old_product_id, old_rating = serializer.instance.product_id, serializer.instance.rating
+        review = serializer.save()
+        if (old_product_id, old_rating) != (review.product_id, review.rating):
+            Product.adjust_rating(old_product_id, old_rating, -1)
+            Product.adjust_rating(review.product_id, review.rating, 1)
+    
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        Product.adjust_rating(instance.product_id, instance.rating, -1)
+        instance.delete()
+
+
+class AnalyticsViewSet(viewsets.ViewSet):
+    """
+    Sales dashboards for staff, read from the daily rollups so no order is scanned.
+    
+    Every action covers ?start= to ?end= (dates, both included), the last 30 days by default.
+    Revenue is the sum of the order items, shipping excluded, and cancelled orders don't count.
+    
+    sales:
+    Orders, units and revenue of every day of the range and their totals. Add ?category=<id> for one category.
+    
+    categories:
+    Categories ranked by ?order_by=revenue (default), units or orders, at most ?limit= (default 10).
+    
+    top_products:
+    Best selling products ranked the same way.
+    """
+    permission_classes = [permissions.IsAdminUser]
+    default_days = 30
+    max_days = 366
+    max_limit = 100
+    
+    def date_range(self, request):
+        """(start, end, error) from the query string, error is None when both dates are usable."""
+        params = request.query_params
+        days = {}
+        for param in ('start', 'end'):
+            if not params.get(param):
+                continue
+            try:
+                days[param] = parse_date(params[param])
+            except ValueError:
+                days[param] = None
+            if days[param] is None:
+                return None, None, f'{param} must be a date like 2024-11-28.'
+        end = days.get('end') or timezone.localdate()
+        start = days.get('start') or end - timedelta(days=self.default_days - 1)
+        if start > end:
+            return None, None, 'start must not be after end.'
+        if (end - start).days >= self.max_days:
+            return None, None, f'At most {self.max_days} days per request.'
+        return start, end, None
+    
+    def ranking(self, request, model):
+        params = request.query_params
+        start, end, error = self.date_range(request)
+        order_by = params.get('order_by', 'revenue')
+        if not error and order_by not in analytics.TOTALS:
+            error = f'order_by must be one of {", ".join(analytics.TOTALS)}.'
+        try:
+            limit = min(max(int(params.get('limit', 10)), 1), self.max_limit)
+        except ValueError:
+            error = error or 'limit must be a number.'
+        if error:
+            return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'start': start,
+            'end': end,
+            'results': analytics.ranking(model, start, end, order_by, limit),
+        })
+    
+    @action(detail=False, methods=['get'])
+    def sales(self, request):
+        start, end, error = self.date_range(request)
+        category = request.query_params.get('category')
+        if not error and category is not None and not category.isdigit():
+            error = 'category must be a category id.'
+        if error:
+            return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+        days = analytics.daily(start, end, int(category) if category else None)
+        totals = {name: sum(day[name] for day in days) for name in analytics.TOTALS}
+        return Response({'start': start, 'end': end, 'totals': totals, 'days': days})
+    
+    @action(detail=False, methods=['get'])
+    def categories(self, request):
+        return self.ranking(request, DailyCategorySales)
+    
+    @action(detail=False, methods=['get'])
+    def top_products(self, request):
+        return self.ranking(request, DailyProductSales)